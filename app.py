@@ -1,7 +1,10 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS  # Import CORS
-from medical3 import ClinicalDecisionSupportSystem
+from medical3 import ClinicalDecisionSupportSystem, MAX_BATCH_CONCURRENCY, MAX_BATCH_SIZE
 import logging
+import json
+import os
+import threading
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -10,9 +13,15 @@ CORS(app)  # Allow all origins (for development)
 # Enable logging
 logging.basicConfig(level=logging.INFO)
 
-# Initialize the Clinical Decision Support System
+# Initialize the Clinical Decision Support System; patient contexts are kept in its session
+# registry, so requests for different patients can be served concurrently
 cdss = ClinicalDecisionSupportSystem()
 
+# Models and clients are created lazily; warm them in the background so the first request doesn't
+# pay for it (set CDSS_WARMUP=0 to skip, e.g. for short-lived workers)
+if os.getenv("CDSS_WARMUP", "1") == "1":
+    threading.Thread(target=cdss.warm_up, name="cdss-warm-up", daemon=True).start()
+
 @app.route("/", methods=["POST"])
 def process_request():
     try:
@@ -26,19 +35,104 @@ def process_request():
         if not patient_ehr or not clinical_question:
             return jsonify({"error": "Missing required fields"}), 400
 
-        logging.info(f"Received Patient EHR: {patient_ehr}")
-        logging.info(f"Received Clinical Question: {clinical_question}")
+        # Log sizes only; EHR text and questions are patient data
+        logging.info(f"Received request: EHR of {len(patient_ehr)} chars, question of {len(clinical_question)} chars")
+
+        # Clients can ask for a per-stage timing breakdown with "include_timings": true or ?timings=1
+        include_timings = bool(data.get("include_timings")) or request.args.get("timings") == "1"
+
+        with cdss.metrics.trace() as timings:
+            if not cdss.initialize_with_patient_ehr(patient_ehr):
+                return jsonify({"error": "Failed to initialize with EHR"}), 500
+
+            recommendation = cdss.get_clinical_recommendation(clinical_question)
+
+        response = {"recommendation": recommendation}
+        if include_timings:
+            response["timings"] = timings
+        return jsonify(response)
+
+    except Exception as e:
+        logging.error(f"Error: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/stream", methods=["POST"])
+def stream_request():
+    """Stream the recommendation as server-sent events while the model generates it."""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({"error": "Invalid JSON"}), 400
+
+        patient_ehr = data.get("patient_ehr")
+        clinical_question = data.get("clinical_question")
+
+        if not patient_ehr or not clinical_question:
+            return jsonify({"error": "Missing required fields"}), 400
 
         if not cdss.initialize_with_patient_ehr(patient_ehr):
             return jsonify({"error": "Failed to initialize with EHR"}), 500
 
-        recommendation = cdss.get_clinical_recommendation(clinical_question)
+        def generate():
+            for chunk in cdss.stream_clinical_recommendation(clinical_question):
+                yield f"data: {json.dumps({'token': chunk})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    except Exception as e:
+        logging.error(f"Error: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/batch", methods=["POST"])
+def batch_request():
+    """Answer many (patient_ehr, clinical_question) pairs, streaming one JSON line per result as it finishes.
+
+    Body: {"requests": [{"patient_ehr": ..., "clinical_question": ..., "id": optional}, ...],
+           "max_concurrency": optional}. Each line carries the request's "index" (and "id").
+    Batches are limited to MAX_BATCH_SIZE requests and max_concurrency to MAX_BATCH_CONCURRENCY.
+    """
+    try:
+        data = request.get_json()
+        if not data or not isinstance(data.get("requests"), list):
+            return jsonify({"error": "Invalid JSON"}), 400
+
+        requests = data["requests"]
+        if not requests:
+            return jsonify({"error": "Missing required fields"}), 400
+        if len(requests) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"At most {MAX_BATCH_SIZE} requests per batch"}), 400
 
-        return jsonify({"recommendation": recommendation})
+        # Client-chosen concurrency is clamped server-side; it also sizes the batch's thread pools
+        max_concurrency = data.get("max_concurrency", 8)
+        if isinstance(max_concurrency, bool) or not isinstance(max_concurrency, int) or max_concurrency < 1:
+            return jsonify({"error": "max_concurrency must be a positive integer"}), 400
+        max_concurrency = min(max_concurrency, MAX_BATCH_CONCURRENCY)
+
+        logging.info(f"Received batch of {len(requests)} requests")
+
+        def generate():
+            for result in cdss.batch_clinical_recommendations(requests, max_concurrency=max_concurrency):
+                yield json.dumps(result) + "\n"
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
 
     except Exception as e:
         logging.error(f"Error: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus metrics: per-stage latency histograms, token counts and cache statistics."""
+    return Response(cdss.render_metrics(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,123 @@
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+from medical3 import ClinicalDecisionSupportSystem
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import json
+import os
+
+# ASGI entry point: same endpoints as app.py, served with async handlers so a single worker
+# keeps many requests in flight while they wait on Mistral, PubMed and retrieval.
+# Run with: uvicorn asgi:app --workers 1
+
+# Enable logging
+logging.basicConfig(level=logging.INFO)
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    """Build the Clinical Decision Support System for this worker and release its clients on shutdown.
+
+    Models and clients are loaded before the worker starts accepting requests (CDSS_WARMUP=0 skips this).
+    """
+    cdss = ClinicalDecisionSupportSystem()
+    if os.getenv("CDSS_WARMUP", "1") == "1":
+        await asyncio.to_thread(cdss.warm_up)
+    app.state.cdss = cdss
+    try:
+        yield
+    finally:
+        await cdss.aclose()
+
+
+async def _read_request(request: Request):
+    """Parse and validate the request body; returns (patient_ehr, clinical_question) or an error response."""
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        data = None
+    if not data:
+        return None, JSONResponse({"error": "Invalid JSON"}, status_code=400)
+
+    patient_ehr = data.get("patient_ehr")
+    clinical_question = data.get("clinical_question")
+
+    if not patient_ehr or not clinical_question:
+        return None, JSONResponse({"error": "Missing required fields"}, status_code=400)
+
+    # Clients can ask for a per-stage timing breakdown with "include_timings": true or ?timings=1
+    include_timings = bool(data.get("include_timings")) or request.query_params.get("timings") == "1"
+    return (patient_ehr, clinical_question, include_timings), None
+
+
+async def process_request(request: Request):
+    try:
+        fields, error = await _read_request(request)
+        if error:
+            return error
+        patient_ehr, clinical_question, include_timings = fields
+        cdss = request.app.state.cdss
+
+        with cdss.metrics.trace() as timings:
+            if not await cdss.ainitialize_with_patient_ehr(patient_ehr):
+                return JSONResponse({"error": "Failed to initialize with EHR"}, status_code=500)
+
+            recommendation = await cdss.aget_clinical_recommendation(clinical_question)
+
+        response = {"recommendation": recommendation}
+        if include_timings:
+            response["timings"] = timings
+        return JSONResponse(response)
+
+    except Exception as e:
+        logging.error(f"Error: {str(e)}", exc_info=True)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def stream_request(request: Request):
+    """Stream the recommendation as server-sent events while the model generates it."""
+    try:
+        fields, error = await _read_request(request)
+        if error:
+            return error
+        patient_ehr, clinical_question, _ = fields
+        cdss = request.app.state.cdss
+
+        if not await cdss.ainitialize_with_patient_ehr(patient_ehr):
+            return JSONResponse({"error": "Failed to initialize with EHR"}, status_code=500)
+
+        async def generate():
+            async for chunk in cdss.astream_clinical_recommendation(clinical_question):
+                yield f"data: {json.dumps({'token': chunk})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+
+        return StreamingResponse(
+            generate(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    except Exception as e:
+        logging.error(f"Error: {str(e)}", exc_info=True)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def metrics(request: Request):
+    """Prometheus metrics: per-stage latency histograms, token counts and cache statistics."""
+    return PlainTextResponse(request.app.state.cdss.render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+app = Starlette(
+    routes=[
+        Route("/", process_request, methods=["POST"]),
+        Route("/stream", stream_request, methods=["POST"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])]  # Allow all origins (for development)
+)
@@ -0,0 +1,439 @@
+import medical3
+from medical3 import (
+    ClinicalDecisionSupportSystem, LocalEntityExtractor, RateLimiter, SemanticAnswerCache, get_embedding_engine,
+    set_chat_model_factory
+)
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+# Offline benchmark: runs initialize_with_patient_ehr and get_clinical_recommendation over a synthetic
+# EHR corpus with a fake chat model and a local PubMed stub server, so results are reproducible and
+# need no network. Every run is appended to a history file keyed by git commit for comparison.
+# Run with: python bench_offline.py --patients 20 --concurrency 8
+
+
+class FaceValueExtractor(LocalEntityExtractor):
+    """Rule-based extraction that takes historical and family-history mentions at face value.
+
+    Stands in for the LLM on the sentences the local tier defers, which it would otherwise skip again.
+    """
+
+    def _is_scoped(self, text, sentence, match_start) -> bool:
+        return bool(self.NEGATION_PATTERN.search(text[sentence[0]:match_start]))
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model stand-in with a configurable time to first token and token rate.
+
+    Entity extraction prompts get a rule-based extraction as JSON; everything else gets a
+    fixed-length synthetic recommendation.
+    """
+
+    first_token_latency: float = 0.5
+    tokens_per_second: float = 50.0
+    response_tokens: int = 200
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark"
+
+    def _respond(self, messages) -> str:
+        system = messages[0].content if messages else ""
+        if "entity extraction" in system:
+            entities, _, _ = FaceValueExtractor().extract(messages[-1].content)
+            return json.dumps(entities)
+        return " ".join(f"recommendation-{i}" for i in range(self.response_tokens))
+
+    def _delay(self, text: str) -> float:
+        return self.first_token_latency + len(text.split()) / self.tokens_per_second
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = self._respond(messages)
+        time.sleep(self._delay(text))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = self._respond(messages)
+        await asyncio.sleep(self._delay(text))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.first_token_latency)
+        for token in self._respond(messages).split():
+            time.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token + " "))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.first_token_latency)
+        for token in self._respond(messages).split():
+            await asyncio.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token + " "))
+
+    def with_structured_output(self, schema, *, include_raw: bool = False, **kwargs):
+        """Mimic tool-calling structured output by validating the JSON response against the schema."""
+        def result(text: str):
+            parsed = schema.model_validate_json(text)
+            return {"raw": AIMessage(content=text), "parsed": parsed, "parsing_error": None} if include_raw else parsed
+
+        def respond(prompt_value):
+            text = self._respond(prompt_value.to_messages())
+            time.sleep(self._delay(text))
+            return result(text)
+
+        async def arespond(prompt_value):
+            text = self._respond(prompt_value.to_messages())
+            await asyncio.sleep(self._delay(text))
+            return result(text)
+
+        return RunnableLambda(respond, afunc=arespond)
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic pseudo-embeddings, for benchmarking everything except the embedding model."""
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def embed_query(self, text: str):
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vector = [random.Random(seed).gauss(0, 1) for _ in range(self.dim)]
+        norm = sum(v * v for v in vector) ** 0.5
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+class PubMedStub:
+    """Local E-utilities stand-in serving canned esearch and efetch responses."""
+
+    def __init__(self, latency: float = 0.05):
+        stub = self
+        self.latency = latency
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._respond(parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                self._respond(parse_qs(body))
+
+            def _respond(self, params):
+                stub.requests += 1
+                time.sleep(stub.latency)
+                endpoint = urlparse(self.path).path.rsplit("/", 1)[-1]
+                if endpoint == "esearch.fcgi":
+                    body, content_type = stub.esearch(params), "application/json"
+                elif endpoint == "efetch.fcgi":
+                    body, content_type = stub.efetch(params), "text/xml"
+                else:
+                    self.send_error(404)
+                    return
+                payload = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    @staticmethod
+    def esearch(params) -> str:
+        term = params.get("term", [""])[0]
+        retmax = int(params.get("retmax", ["20"])[0])
+        # Deterministic PMIDs per query word, so queries sharing words share articles like real searches do
+        ids = []
+        for word in term.lower().split():
+            base = 10000000 + int(hashlib.md5(word.encode()).hexdigest()[:6], 16) % 1000000
+            ids.extend(str(base + i) for i in range(3) if str(base + i) not in ids)
+        return json.dumps({"esearchresult": {"idlist": ids[:retmax]}})
+
+    @staticmethod
+    def efetch(params) -> str:
+        ids = ",".join(params.get("id", [""])).split(",")
+        articles = []
+        for pmid in filter(None, ids):
+            rng = random.Random(pmid)
+            sentences = " ".join(
+                f"Finding {i} on {rng.choice(['hypertension', 'diabetes', 'COPD', 'osteoporosis', 'heart failure'])} "
+                f"management with {rng.choice(['metformin', 'lisinopril', 'tiotropium', 'alendronate', 'statins'])}."
+                for i in range(12)
+            )
+            articles.append(
+                "<PubmedArticle><MedlineCitation><PMID>{pmid}</PMID><Article>"
+                "<Journal><Title>Journal of Benchmark Medicine</Title><JournalIssue><PubDate><Year>{year}</Year>"
+                "<Month>Jan</Month></PubDate></JournalIssue></Journal>"
+                "<ArticleTitle>Synthetic article {pmid}</ArticleTitle>"
+                "<Abstract><AbstractText Label=\"BACKGROUND\">{abstract}</AbstractText>"
+                "<AbstractText Label=\"CONCLUSIONS\">Further study is warranted.</AbstractText></Abstract>"
+                "<AuthorList><Author><LastName>Doe</LastName><ForeName>Jane</ForeName></Author></AuthorList>"
+                "<PublicationTypeList><PublicationType>Journal Article</PublicationType></PublicationTypeList>"
+                "</Article><MeshHeadingList><MeshHeading><DescriptorName>Humans</DescriptorName></MeshHeading>"
+                "</MeshHeadingList></MedlineCitation></PubmedArticle>".format(
+                    pmid=pmid, year=2015 + rng.randrange(10), abstract=escape(sentences)
+                )
+            )
+        return "<?xml version=\"1.0\"?><PubmedArticleSet>" + "".join(articles) + "</PubmedArticleSet>"
+
+
+CONDITIONS = [
+    ("type 2 diabetes", "Metformin 1000 mg BID", "HbA1c of 8.1%"),
+    ("hypertension", "Lisinopril 20 mg daily", "creatinine of 1.1 mg/dL"),
+    ("chronic obstructive pulmonary disease (COPD)", "Tiotropium 18 mcg daily", "FEV1 of 55% predicted"),
+    ("osteoporosis", "Alendronate 70 mg weekly", "vitamin D level of 18 ng/mL"),
+    ("heart failure", "Carvedilol 12.5 mg BID", "BNP of 450 pg/mL"),
+    ("atrial fibrillation", "Apixaban 5 mg BID", "TSH of 2.1 mIU/L"),
+    ("chronic kidney disease", "Losartan 50 mg daily", "eGFR of 42 mL/min"),
+    ("hyperlipidemia", "Atorvastatin 40 mg daily", "LDL of 142 mg/dL"),
+]
+
+QUESTIONS = [
+    "What adjustments to the current treatment would you recommend?",
+    "Which diagnostic tests should be ordered next?",
+    "Are there drug interactions to watch for with the current medications?",
+    "What lifestyle modifications are most important for this patient?",
+    "Should any medication be de-escalated given the recent labs?",
+]
+
+
+def synthetic_ehrs(count: int, seed: int = 0):
+    """Generate a reproducible corpus of multi-section EHR notes."""
+    rng = random.Random(seed)
+    ehrs = []
+    for index in range(count):
+        picked = rng.sample(CONDITIONS, k=rng.randint(1, 3))
+        age = rng.randint(35, 85)
+        sex = rng.choice(["male", "female"])
+        sections = [
+            f"Patient {index} is a {age}-year-old {sex} with a history of "
+            + ", ".join(condition for condition, _, _ in picked) + ".",
+            "Current medications include " + ", ".join(drug for _, drug, _ in picked) + ".",
+            "Recent labs show " + ", ".join(lab for _, _, lab in picked)
+            + f". Blood pressure {rng.randint(110, 160)}/{rng.randint(65, 100)} mmHg, heart rate {rng.randint(55, 100)} bpm.",
+            "Patient reports " + rng.choice(["worsening fatigue", "shortness of breath on exertion", "mild back pain", "no new complaints"]) + ".",
+        ]
+        ehrs.append("\n\n".join(sections))
+    return ehrs
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def latency_summary(values):
+    return {
+        "n": len(values),
+        "mean_s": round(statistics.mean(values), 4) if values else 0.0,
+        "p50_s": round(percentile(values, 0.5), 4),
+        "p95_s": round(percentile(values, 0.95), 4),
+    }
+
+
+def make_cdss(args, stub: PubMedStub) -> ClinicalDecisionSupportSystem:
+    # Without --answer-cache no question ever matches, so every recommendation runs the full pipeline
+    embeddings = HashEmbeddings() if args.hash_embeddings else get_embedding_engine()
+    answer_cache = SemanticAnswerCache(embeddings) if args.answer_cache else SemanticAnswerCache(embeddings, similarity_threshold=2.0)
+    cdss = ClinicalDecisionSupportSystem(literature_concurrency=args.literature_concurrency, answer_cache=answer_cache)
+    cdss.data_processor.pubmed_base_url = stub.url
+    cdss.data_processor.rate_limiter = RateLimiter(args.pubmed_rate)
+    if args.hash_embeddings:
+        cdss.vector_store.embeddings.underlying = HashEmbeddings()
+        cdss.vector_store.embeddings.model_name = "hash-embeddings"
+    return cdss
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def run_benchmark(args):
+    ehrs = synthetic_ehrs(args.patients, seed=args.seed)
+    set_chat_model_factory(lambda model, temperature: FakeChatModel(
+        first_token_latency=args.llm_latency, tokens_per_second=args.token_rate, response_tokens=args.response_tokens
+    ))
+    stub = PubMedStub(latency=args.pubmed_latency).start()
+
+    # Relative persist directories keep every run's stores and caches isolated in a fresh directory
+    original_cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="cdss-bench-")
+    os.chdir(workdir)
+    results = {}
+    try:
+        # Cold: empty stores and caches, models loaded on the first request
+        cdss = make_cdss(args, stub)
+        cold = []
+        for ehr in ehrs:
+            start = time.perf_counter()
+            assert cdss.initialize_with_patient_ehr(ehr), "initialization failed"
+            cold.append(time.perf_counter() - start)
+        results["cold_init"] = dict(latency_summary(cold), first_s=round(cold[0], 4))
+
+        # Warm: a fresh system instance (empty session registry) over the persisted stores and caches
+        cdss = make_cdss(args, stub)
+        warm = []
+        for ehr in ehrs:
+            start = time.perf_counter()
+            assert cdss.initialize_with_patient_ehr(ehr), "initialization failed"
+            warm.append(time.perf_counter() - start)
+        results["warm_init"] = latency_summary(warm)
+
+        # Sequential recommendation latency for initialized patients
+        latencies = []
+        for index, ehr in enumerate(ehrs):
+            cdss.initialize_with_patient_ehr(ehr)
+            start = time.perf_counter()
+            cdss.get_clinical_recommendation(QUESTIONS[index % len(QUESTIONS)])
+            latencies.append(time.perf_counter() - start)
+        results["recommendation"] = latency_summary(latencies)
+
+        # Throughput: concurrent end-to-end requests (registry-hit initialization plus recommendation)
+        requests = [(ehr, question) for ehr in ehrs for question in QUESTIONS[:args.questions]]
+
+        def handle(item):
+            start = time.perf_counter()
+            cdss.initialize_with_patient_ehr(item[0])
+            cdss.get_clinical_recommendation(item[1])
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            request_latencies = list(executor.map(handle, requests))
+        elapsed = time.perf_counter() - start
+        results["throughput"] = dict(
+            latency_summary(request_latencies),
+            concurrency=args.concurrency,
+            requests_per_s=round(len(requests) / elapsed, 3)
+        )
+
+        results["stages"] = {
+            stage: {key: round(value, 4) for key, value in values.items()}
+            for stage, values in cdss.metrics.summary().items()
+        }
+        results["pubmed_requests"] = stub.requests
+        # ru_maxrss is in kilobytes on Linux
+        results["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    finally:
+        stub.stop()
+        set_chat_model_factory(None)
+        os.chdir(original_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def compare(previous, current, path=()):
+    """Lines describing how the numeric results changed since the previous run."""
+    lines = []
+    for key, value in current.items():
+        old = previous.get(key) if isinstance(previous, dict) else None
+        if isinstance(value, dict):
+            lines.extend(compare(old or {}, value, path + (key,)))
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            change = (value - old) / old * 100
+            lines.append(f"  {'.'.join(path + (key,))}: {old} -> {value} ({change:+.1f}%)")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark with a fake chat model and a local PubMed stub.")
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=3, help="questions per patient in the throughput phase")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="fake model time to first token (s)")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="fake model tokens per second")
+    parser.add_argument("--response-tokens", type=int, default=200)
+    parser.add_argument("--pubmed-latency", type=float, default=0.05, help="stub server delay per request (s)")
+    parser.add_argument("--pubmed-rate", type=float, default=0.0, help="client-side PubMed rate limit, 0 = none")
+    parser.add_argument("--literature-concurrency", type=int, default=4)
+    parser.add_argument("--hash-embeddings", action="store_true", help="skip the embedding model")
+    parser.add_argument("--answer-cache", action="store_true", help="let the semantic answer cache serve repeats")
+    parser.add_argument("--history", default="bench_history.jsonl", help="results appended per run, keyed by commit")
+    parser.add_argument("--output", default="bench_output.txt", help="human-readable report of this run")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    medical3.logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    history_path = os.path.abspath(args.history)
+    output_path = os.path.abspath(args.output)
+    config = {key: value for key, value in vars(args).items() if key not in ("history", "output", "verbose")}
+
+    results = run_benchmark(args)
+    entry = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": config,
+        "results": results
+    }
+
+    previous = None
+    if os.path.exists(history_path):
+        with open(history_path) as f:
+            for line in f:
+                if line.strip():
+                    past = json.loads(line)
+                    if past.get("config") == config:
+                        previous = past
+    with open(history_path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+    report = [f"Benchmark at commit {entry['commit']} ({entry['timestamp']})", json.dumps(results, indent=2)]
+    if previous:
+        report.append(f"Change since commit {previous['commit']} ({previous['timestamp']}), same configuration:")
+        report.extend(compare(previous["results"], results))
+    text = "\n".join(report)
+
+    with open(output_path, "w") as f:
+        f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Startup benchmark: measures, in fresh interpreters, how long importing medical3 takes, constructing
+# the system, the explicit warm-up and (optionally) the first request, each reported separately.
+# Run with: python bench_startup.py --runs 5 [--request]
+
+PROBE = r"""
+import json, sys, time
+start = time.perf_counter()
+import medical3
+timings = {"import": time.perf_counter() - start}
+
+start = time.perf_counter()
+cdss = medical3.ClinicalDecisionSupportSystem()
+timings["construct"] = time.perf_counter() - start
+
+if "--warm-up" in sys.argv:
+    start = time.perf_counter()
+    cdss.warm_up()
+    timings["warm_up"] = time.perf_counter() - start
+
+if "--request" in sys.argv:
+    ehr = "Patient is a 58-year-old male with type 2 diabetes and hypertension. Metformin 1000 mg BID."
+    start = time.perf_counter()
+    cdss.initialize_with_patient_ehr(ehr)
+    cdss.get_clinical_recommendation("Should the diabetes regimen be intensified?")
+    timings["first_request"] = time.perf_counter() - start
+
+print(json.dumps(timings))
+"""
+
+
+def run_probe(flags):
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE, *flags], capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold-start time of the clinical decision support system.")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--no-warm-up", action="store_true", help="measure the first request without warm-up")
+    parser.add_argument("--request", action="store_true", help="also time a first request (needs the Mistral API)")
+    args = parser.parse_args()
+    
+    flags = ([] if args.no_warm_up else ["--warm-up"]) + (["--request"] if args.request else [])
+    runs = [run_probe(flags) for _ in range(args.runs)]
+    
+    report = {}
+    for phase in runs[0]:
+        values = [run[phase] for run in runs]
+        report[phase] = {"median_s": round(statistics.median(values), 3), "max_s": round(max(values), 3)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
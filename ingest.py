@@ -0,0 +1,31 @@
+from medical3 import MedicalVectorStore
+import argparse
+import json
+import logging
+import os
+
+# Directory-level corpus ingestion for guideline PDFs and text files.
+# Run with: python ingest.py path/to/corpus --collection clinical_guidelines
+# Re-runs only process new or changed files and drop chunks of deleted ones.
+
+# Enable logging
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index a directory of guideline PDFs and text files.")
+    parser.add_argument("corpus_dir", help="directory to walk for .pdf, .txt and .md files")
+    parser.add_argument("--collection", default="clinical_guidelines", help="vector store collection to write to")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1), help="parse/split processes")
+    parser.add_argument("--batch-size", type=int, default=256, help="chunks embedded and written per batch")
+    args = parser.parse_args()
+    
+    vector_store = MedicalVectorStore()
+    stats = vector_store.ingest_directory(
+        args.corpus_dir, args.collection, workers=args.workers, batch_size=args.batch_size
+    )
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,43 @@
 import os
 from dotenv import load_dotenv
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, CSVLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
-from langchain.schema import Document
-from langchain_mistralai import ChatMistralAI
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains import create_retrieval_chain
-from langchain_community.retrievers import BM25Retriever
-from langchain_text_splitters import CharacterTextSplitter
+from langchain_core.utils.json import parse_partial_json
+from pydantic import BaseModel, Field
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
 import requests
-from bs4 import BeautifulSoup
-import pandas as pd
+import httpx
 import numpy as np
 import json
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, Optional, Union, Tuple, Iterator, AsyncIterator, TYPE_CHECKING
 import re
-from tqdm import tqdm
+import io
+from xml.etree import ElementTree
 import logging
 import hashlib
+import threading
+import time
+import asyncio
+import sqlite3
+import math
+import contextvars
+import queue
+import concurrent.futures
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# langchain_community, chromadb, sentence-transformers, the Mistral client and pandas
+# are imported where they are first used so importing this module stays fast
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import Chroma
+    from langchain_huggingface import HuggingFaceEmbeddings
+    from langchain_mistralai import ChatMistralAI
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,24 +47,307 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
 PUBMED_API_KEY = os.getenv("PUBMED_API_KEY")  # Optional for higher rate limits
+PUBMED_BASE_URL = os.getenv("PUBMED_BASE_URL", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils")
+
+# NCBI allows 3 requests/second without an API key and 10 with one
+PUBMED_RATE_LIMIT = 10.0 if PUBMED_API_KEY and PUBMED_API_KEY != "your_pubmed_key_optional" else 3.0
+PUBMED_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Root directory for persisted vector stores and the caches that live alongside them
+DEFAULT_PERSIST_DIRECTORY = "./medical_chroma_db"
+
+# Shared, deduplicated collection holding PubMed articles and guideline documents for all patients
+LITERATURE_COLLECTION = "medical_literature"
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+
+# Pre-quantized ONNX export used for backend="onnx", quantize=True. The default runs on any x86-64
+# CPU with AVX2; onnx/model_qint8_avx512_vnni.onnx is faster where AVX512-VNNI is available and
+# onnx/model_qint8_arm64.onnx is the ARM build
+EMBEDDING_ONNX_QUANTIZED_FILE = os.getenv("EMBEDDING_ONNX_QUANTIZED_FILE", "onnx/model_quint8_avx2.onnx")
+
+# Bound parameters per SQLite statement; builds before 3.32 allow at most 999, so IN (...) lists are chunked
+SQLITE_MAX_VARIABLES = 900
+
+# Upper bounds for batch recommendations: requests per batch, and concurrent generation calls
+# (which also sizes the batch's thread pools)
+MAX_BATCH_SIZE = int(os.getenv("CDSS_MAX_BATCH_SIZE", "100"))
+MAX_BATCH_CONCURRENCY = int(os.getenv("CDSS_MAX_BATCH_CONCURRENCY", "16"))
+
+
+_shared_lock = threading.Lock()
+_chat_models = {}
+_chat_model_factory = None
+
+
+def set_chat_model_factory(factory=None):
+    """Build chat clients with factory(model, temperature) instead of ChatMistralAI, e.g. a local stand-in.
+    
+    Clients created before the call are discarded; pass None to go back to Mistral.
+    """
+    global _chat_model_factory
+    with _shared_lock:
+        _chat_model_factory = factory
+        _chat_models.clear()
+
+
+def get_chat_model(model: str = "mistral-large-latest", temperature: float = 0.2) -> "ChatMistralAI":
+    """Shared Mistral chat client per model and temperature, created on first use."""
+    key = (model, temperature)
+    with _shared_lock:
+        if key not in _chat_models:
+            if _chat_model_factory is not None:
+                _chat_models[key] = _chat_model_factory(model, temperature)
+            else:
+                from langchain_mistralai import ChatMistralAI
+                _chat_models[key] = ChatMistralAI(
+                    temperature=temperature,
+                    model=model,
+                    mistral_api_key=MISTRAL_API_KEY
+                )
+        return _chat_models[key]
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces out calls to stay under a requests-per-second budget."""
+    
+    def __init__(self, rate_per_second: float):
+        self.min_interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_allowed = 0.0
+    
+    def _reserve(self) -> float:
+        """Claim the next slot and return how long to wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_allowed - now
+            self._next_allowed = max(now, self._next_allowed) + self.min_interval
+        return delay
+    
+    def wait(self):
+        """Block until the next call is allowed."""
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+    
+    async def async_wait(self):
+        """Wait for the next slot without blocking the event loop."""
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class PubMedCache:
+    """Persistent SQLite cache for PubMed search results and article records with TTL and LRU eviction."""
+    
+    def __init__(self,
+                 cache_dir: str = DEFAULT_PERSIST_DIRECTORY,
+                 ttl_seconds: float = 7 * 24 * 3600,
+                 empty_ttl_seconds: float = 3600,
+                 max_queries: int = 10000,
+                 max_articles: int = 50000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, "pubmed_cache.sqlite3")
+        self.ttl_seconds = ttl_seconds
+        # Empty results are often transient (new terms, a hiccup on NCBI's side), so they expire sooner
+        self.empty_ttl_seconds = empty_ttl_seconds
+        self.max_queries = max_queries
+        self.max_articles = max_articles
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS queries (key TEXT PRIMARY KEY, pmids TEXT, created_at REAL, last_access REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS articles (pmid TEXT PRIMARY KEY, content TEXT, metadata TEXT, created_at REAL, last_access REAL)"
+        )
+        self._conn.commit()
+        
+        # Hit/miss counters used to size the cache
+        self.query_hits = 0
+        self.query_misses = 0
+        self.article_hits = 0
+        self.article_misses = 0
+    
+    @staticmethod
+    def _query_key(query: str, max_results: int) -> str:
+        """Normalize a query so that case and whitespace differences share one entry."""
+        normalized = " ".join(query.lower().split())
+        return f"{normalized}|{max_results}"
+    
+    def get_query(self, query: str, max_results: int) -> Optional[List[str]]:
+        """Return the cached PMID list for a query, or None on a miss."""
+        key = self._query_key(query, max_results)
+        now = time.time()
+        
+        with self._lock:
+            row = self._conn.execute("SELECT pmids, created_at FROM queries WHERE key = ?", (key,)).fetchone()
+            pmids = json.loads(row[0]) if row is not None else None
+            ttl_seconds = self.ttl_seconds if pmids else self.empty_ttl_seconds
+            if row is None or now - row[1] > ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM queries WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.query_misses += 1
+                return None
+            
+            self._conn.execute("UPDATE queries SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.query_hits += 1
+            return pmids
+    
+    def put_query(self, query: str, max_results: int, pmids: List[str]):
+        """Store the PMID list returned for a query."""
+        key = self._query_key(query, max_results)
+        now = time.time()
+        
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO queries (key, pmids, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(pmids), now, now)
+            )
+            self._evict("queries", self.max_queries)
+            self._conn.commit()
+    
+    def get_articles(self, pmids: List[str]) -> Dict[str, Document]:
+        """Return cached article documents keyed by PMID; missing or expired PMIDs are omitted."""
+        if not pmids:
+            return {}
+        
+        now = time.time()
+        found = {}
+        
+        with self._lock:
+            pmids = list(pmids)
+            rows = []
+            for i in range(0, len(pmids), SQLITE_MAX_VARIABLES):
+                chunk = pmids[i:i + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" for _ in chunk)
+                rows.extend(self._conn.execute(
+                    f"SELECT pmid, content, metadata, created_at FROM articles WHERE pmid IN ({placeholders})", chunk
+                ).fetchall())
+            
+            expired = []
+            for pmid, content, metadata, created_at in rows:
+                if now - created_at > self.ttl_seconds:
+                    expired.append(pmid)
+                    continue
+                found[pmid] = Document(page_content=content, metadata=json.loads(metadata))
+            
+            if expired:
+                self._conn.executemany("DELETE FROM articles WHERE pmid = ?", [(pmid,) for pmid in expired])
+            if found:
+                self._conn.executemany(
+                    "UPDATE articles SET last_access = ? WHERE pmid = ?", [(now, pmid) for pmid in found]
+                )
+            self._conn.commit()
+            
+            self.article_hits += len(found)
+            self.article_misses += len(pmids) - len(found)
+        
+        return found
+    
+    def put_articles(self, documents: List[Document]):
+        """Store article documents keyed by their PMID."""
+        now = time.time()
+        rows = [
+            (doc.metadata["pmid"], doc.page_content, json.dumps(doc.metadata), now, now)
+            for doc in documents if doc.metadata.get("pmid")
+        ]
+        if not rows:
+            return
+        
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO articles (pmid, content, metadata, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._evict("articles", self.max_articles)
+            self._conn.commit()
+    
+    def _evict(self, table: str, max_entries: int):
+        """Drop least recently used rows once a table exceeds its size bound. Caller holds the lock."""
+        count = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        overflow = count - max_entries
+        if overflow > 0:
+            key_column = "key" if table == "queries" else "pmid"
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE {key_column} IN "
+                f"(SELECT {key_column} FROM {table} ORDER BY last_access ASC LIMIT ?)",
+                (overflow,)
+            )
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and current entry counts."""
+        with self._lock:
+            query_count = self._conn.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+            article_count = self._conn.execute("SELECT COUNT(*) FROM articles").fetchone()[0]
+        
+        return {
+            "query_hits": self.query_hits,
+            "query_misses": self.query_misses,
+            "article_hits": self.article_hits,
+            "article_misses": self.article_misses,
+            "query_entries": query_count,
+            "article_entries": article_count
+        }
+
 
 class MedicalDataProcessor:
     """Process medical data from various sources including EHRs, PubMed, and clinical guidelines."""
     
-    def __init__(self):
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", ".", " ", ""],
-            length_function=len,
-            is_separator_regex=False
-        )
+    def __init__(self,
+                 pubmed_base_url: str = PUBMED_BASE_URL,
+                 efetch_batch_size: int = 200,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 max_backoff: float = 30.0,
+                 rate_limit: float = PUBMED_RATE_LIMIT,
+                 cache_dir: Optional[str] = DEFAULT_PERSIST_DIRECTORY):
+        self._text_splitter = None
+        
+        # PubMed E-utilities settings; the base URL can point at a local stub server for testing
+        self.pubmed_base_url = pubmed_base_url.rstrip("/")
+        self.efetch_batch_size = efetch_batch_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.rate_limiter = RateLimiter(rate_limit)
+        
+        # Pooled session so repeated E-utilities calls reuse connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        
+        # Persistent query/article cache; pass cache_dir=None to always hit the network
+        self.pubmed_cache = PubMedCache(cache_dir) if cache_dir else None
+        
+        # Pooled async client for the asyncio serving path, created on first use per event loop
+        self._async_client = None
+        self._async_client_loop = None
+    
+    @property
+    def text_splitter(self):
+        """Chunk splitter, created on first use."""
+        if self._text_splitter is None:
+            from langchain.text_splitter import RecursiveCharacterTextSplitter
+            self._text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=1000,
+                chunk_overlap=200,
+                separators=["\n\n", "\n", ".", " ", ""],
+                length_function=len,
+                is_separator_regex=False
+            )
+        return self._text_splitter
     
     def process_ehr_data(self, ehr_path: str = None, ehr_text: str = None) -> List[Document]:
         """Process structured EHR data (CSV format or raw text)."""
         try:
             if ehr_path and os.path.exists(ehr_path):
                 if ehr_path.endswith('.csv'):
+                    from langchain_community.document_loaders import CSVLoader
                     loader = CSVLoader(file_path=ehr_path)
                     documents = loader.load()
                 else:
@@ -71,110 +370,327 @@ class MedicalDataProcessor:
             logger.error(f"Error processing EHR data: {e}")
             return []
     
-    def fetch_pubmed_articles(self, query: str, max_results: int = 20) -> List[Document]:
-        """Fetch articles from PubMed based on query."""
-        base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
-        
-        # Search for article IDs
-        search_url = f"{base_url}/esearch.fcgi"
-        params = {
+    def _pubmed_params(self, **params) -> Dict[str, Any]:
+        """Build E-utilities query parameters with the tool identification and optional API key."""
+        params.update({
             "db": "pubmed",
-            "term": query,
-            "retmax": max_results,
-            "retmode": "json",
             "tool": "ClinicalDecisionSystem",
             "email": "example@example.com"  # Replace with your email
-        }
+        })
         
         # Only add API key if it's actually provided and not a placeholder
         if PUBMED_API_KEY and PUBMED_API_KEY != "your_pubmed_key_optional":
             params["api_key"] = PUBMED_API_KEY
+        
+        return params
+    
+    def _retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Seconds to wait before a retry: Retry-After when NCBI sends it, otherwise exponential backoff.
+        
+        Either way the delay is capped at max_backoff so a large Retry-After can't stall a request.
+        """
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff_factor * (2 ** attempt)
+        return min(delay, self.max_backoff)
+    
+    def _pubmed_request(self, endpoint: str, params: Dict[str, Any], method: str = "GET") -> requests.Response:
+        """Send a throttled E-utilities request, retrying rate-limit and server errors with backoff."""
+        url = f"{self.pubmed_base_url}/{endpoint}"
+        
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            try:
+                if method == "POST":
+                    response = self.session.post(url, data=params, timeout=30)
+                else:
+                    response = self.session.get(url, params=params, timeout=30)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(f"PubMed request to {endpoint} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            
+            if response.status_code in PUBMED_RETRY_STATUSES and attempt < self.max_retries:
+                delay = self._retry_delay(attempt, response.headers.get("Retry-After"))
+                logger.warning(f"PubMed returned {response.status_code} for {endpoint}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
             
-        try:
-            logger.info(f"Searching PubMed for: {query}")
-            response = requests.get(search_url, params=params)
             response.raise_for_status()
+            return response
+    
+    @staticmethod
+    def _element_text(element) -> str:
+        """Full text of an element, including inline markup such as <i> or <sup>."""
+        return "".join(element.itertext()).strip() if element is not None else ""
+    
+    def _parse_pubmed_article(self, article) -> Document:
+        """Build a document from one PubmedArticle element."""
+        citation = article.find("MedlineCitation")
+        pmid = self._element_text(citation.find("PMID")) if citation is not None else ""
+        
+        # Extract title, abstract, and metadata
+        title_text = self._element_text(article.find(".//Article/ArticleTitle")) or "No title available"
+        
+        # Keep every section of structured abstracts, labelled as in the record
+        sections = []
+        for section in article.iterfind(".//Article/Abstract/AbstractText"):
+            text = self._element_text(section)
+            if text:
+                label = section.get("Label")
+                sections.append(f"{label}: {text}" if label else text)
+        abstract_text = "\n".join(sections) if sections else "No abstract available"
+        
+        # Extract publication date
+        pub_date = "Unknown date"
+        pub_date_elem = article.find(".//Article/Journal/JournalIssue/PubDate")
+        if pub_date_elem is not None:
+            medline_date = pub_date_elem.findtext("MedlineDate")
+            parts = [pub_date_elem.findtext(tag) or "" for tag in ("Year", "Month", "Day")]
+            pub_date = (medline_date or " ".join(parts)).strip() or pub_date
+        
+        # Extract authors
+        authors = []
+        for author in article.iterfind(".//Article/AuthorList/Author"):
+            author_name = " ".join(filter(None, [author.findtext("ForeName"), author.findtext("LastName")]))
+            author_name = author_name or author.findtext("CollectiveName") or ""
+            if author_name:
+                authors.append(author_name)
+        authors_text = ", ".join(authors) if authors else "Unknown authors"
+        
+        mesh_terms = [
+            self._element_text(descriptor) for descriptor in article.iterfind(".//MeshHeadingList/MeshHeading/DescriptorName")
+        ]
+        publication_types = [
+            self._element_text(publication_type)
+            for publication_type in article.iterfind(".//Article/PublicationTypeList/PublicationType")
+        ]
+        
+        # Create document
+        content = f"Title: {title_text}\nAuthors: {authors_text}\nPublication Date: {pub_date}\nPMID: {pmid}"
+        if publication_types:
+            content += f"\nPublication Types: {', '.join(publication_types)}"
+        if mesh_terms:
+            content += f"\nMeSH Terms: {', '.join(mesh_terms)}"
+        content += f"\n\nAbstract: {abstract_text}"
+        
+        # Chroma metadata values must be scalars, so lists are stored joined
+        metadata = {
+            "source": "pubmed",
+            "pmid": pmid,
+            "title": title_text,
+            "authors": authors_text,
+            "publication_date": pub_date,
+            "mesh_terms": "; ".join(mesh_terms),
+            "publication_types": "; ".join(publication_types)
+        }
+        return Document(page_content=content, metadata=metadata)
+    
+    def _parse_pubmed_articles(self, xml_content: bytes) -> List[Document]:
+        """Parse a multi-article efetch XML payload into documents.
+        
+        Articles are streamed with iterparse and freed once converted, so memory stays flat
+        however many articles a batch holds.
+        """
+        documents = []
+        root = None
+        try:
+            for event, element in ElementTree.iterparse(io.BytesIO(xml_content), events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        root = element
+                    continue
+                if element.tag == "PubmedArticle":
+                    documents.append(self._parse_pubmed_article(element))
+                    # Drop the parsed article (and any earlier siblings) from the partial tree
+                    root.clear()
+        except ElementTree.ParseError as e:
+            logger.error(f"Error parsing PubMed XML after {len(documents)} articles: {e}")
+        
+        return documents
+    
+    
+    def fetch_pubmed_by_ids(self, id_list: List[str]) -> List[Document]:
+        """Fetch article records for a list of PMIDs, serving cached records and batching the rest."""
+        cached = self.pubmed_cache.get_articles(id_list) if self.pubmed_cache else {}
+        missing = [pmid for pmid in id_list if pmid not in cached]
+        
+        fetched = []
+        batches = [missing[i:i + self.efetch_batch_size] for i in range(0, len(missing), self.efetch_batch_size)]
+        
+        from tqdm import tqdm
+        for batch in tqdm(batches, desc="Fetching PubMed articles", disable=len(batches) < 2):
+            # POST keeps long ID lists out of the URL, as recommended by NCBI
+            fetch_params = self._pubmed_params(id=",".join(batch), retmode="xml")
+            response = self._pubmed_request("efetch.fcgi", fetch_params, method="POST")
+            fetched.extend(self._parse_pubmed_articles(response.content))
+        
+        if self.pubmed_cache and fetched:
+            self.pubmed_cache.put_articles(fetched)
+        
+        # Return documents in the order of the requested PMIDs
+        by_pmid = dict(cached)
+        by_pmid.update({doc.metadata["pmid"]: doc for doc in fetched})
+        return [by_pmid[pmid] for pmid in id_list if pmid in by_pmid]
+    
+    def fetch_pubmed_articles(self, query: str, max_results: int = 20) -> List[Document]:
+        """Fetch articles from PubMed based on query."""
+        params = self._pubmed_params(term=query, retmax=max_results, retmode="json")
+            
+        try:
+            id_list = self.pubmed_cache.get_query(query, max_results) if self.pubmed_cache else None
             
-            search_results = response.json()
-            id_list = search_results.get("esearchresult", {}).get("idlist", [])
+            if id_list is None:
+                logger.info(f"Searching PubMed for: {query}")
+                response = self._pubmed_request("esearch.fcgi", params)
+                
+                search_results = response.json()
+                id_list = search_results.get("esearchresult", {}).get("idlist", [])
+                
+                if self.pubmed_cache:
+                    self.pubmed_cache.put_query(query, max_results, id_list)
+            else:
+                logger.info(f"Using cached PubMed search results for: {query}")
             
             if not id_list:
                 logger.warning(f"No PubMed articles found for query: {query}")
                 return []
                 
-            # Fetch article details
-            documents = []
-            for pmid in tqdm(id_list, desc="Fetching PubMed articles"):
-                fetch_url = f"{base_url}/efetch.fcgi"
-                fetch_params = {
-                    "db": "pubmed",
-                    "id": pmid,
-                    "retmode": "xml"
-                }
-                
-                # Only add API key if it's actually provided and not a placeholder
-                if PUBMED_API_KEY and PUBMED_API_KEY != "your_pubmed_key_optional":
-                    fetch_params["api_key"] = PUBMED_API_KEY
-                    
-                article_response = requests.get(fetch_url, params=fetch_params)
-                article_response.raise_for_status()
-                
-                soup = BeautifulSoup(article_response.content, "xml")
-                
-                # Extract title, abstract, and metadata
-                title = soup.find("ArticleTitle")
-                title_text = title.text if title else "No title available"
-                
-                abstract_text = "No abstract available"
-                abstract = soup.find("AbstractText")
-                if abstract:
-                    abstract_text = abstract.text
-                
-                # Extract publication date
-                pub_date = "Unknown date"
-                pub_date_elem = soup.find("PubDate")
-                if pub_date_elem:
-                    year = pub_date_elem.find("Year")
-                    month = pub_date_elem.find("Month")
-                    day = pub_date_elem.find("Day")
-                    
-                    year_text = year.text if year else ""
-                    month_text = month.text if month else ""
-                    day_text = day.text if day else ""
-                    
-                    pub_date = f"{year_text} {month_text} {day_text}".strip()
-                
-                # Extract authors
-                authors = []
-                author_list = soup.find("AuthorList")
-                if author_list:
-                    for author in author_list.find_all("Author"):
-                        last_name = author.find("LastName")
-                        fore_name = author.find("ForeName")
-                        
-                        author_name = ""
-                        if last_name:
-                            author_name += last_name.text
-                        if fore_name:
-                            author_name = f"{fore_name.text} {author_name}"
-                            
-                        if author_name:
-                            authors.append(author_name)
-                
-                authors_text = ", ".join(authors) if authors else "Unknown authors"
-                
-                # Create document
-                content = f"Title: {title_text}\nAuthors: {authors_text}\nPublication Date: {pub_date}\nPMID: {pmid}\n\nAbstract: {abstract_text}"
-                metadata = {
-                    "source": "pubmed",
-                    "pmid": pmid,
-                    "title": title_text,
-                    "authors": authors_text,
-                    "publication_date": pub_date
-                }
+            # Fetch article details in batched efetch calls
+            documents = self.fetch_pubmed_by_ids(id_list)
+            
+            logger.info(f"Fetched {len(documents)} PubMed articles")
+            return documents
+        
+        except Exception as e:
+            logger.error(f"Error fetching PubMed articles: {e}")
+            return []
+    
+    def fetch_pubmed_for_queries(self, queries: List[str], max_results: int = 5, max_workers: int = 4) -> List[Document]:
+        """Run several PubMed queries concurrently and merge the results, dropping duplicate PMIDs."""
+        if not queries:
+            return []
+        
+        # Bounded pool; the shared rate limiter keeps the combined request rate within NCBI limits
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(queries)))) as executor:
+            results = list(executor.map(lambda q: self.fetch_pubmed_articles(q, max_results=max_results), queries))
+        
+        return self._merge_query_results(queries, results)
+    
+    def _merge_query_results(self, queries: List[str], results: List[List[Document]]) -> List[Document]:
+        """Merge per-query results in query order, dropping duplicate PMIDs."""
+        # Merge in query order so the output is deterministic regardless of completion order
+        documents = []
+        seen_pmids = {}
+        for query, query_docs in zip(queries, results):
+            for doc in query_docs:
+                pmid = doc.metadata.get("pmid")
+                if pmid and pmid in seen_pmids:
+                    existing = seen_pmids[pmid]
+                    existing.metadata["queries"] = f"{existing.metadata['queries']}; {query}"
+                    continue
+                doc.metadata["queries"] = query
+                if pmid:
+                    seen_pmids[pmid] = doc
+                documents.append(doc)
+        
+        logger.info(f"Fetched {len(documents)} unique PubMed articles for {len(queries)} queries")
+        return documents
+    
+    def _get_async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop:
+            self._async_client = httpx.AsyncClient(
+                timeout=30,
+                limits=httpx.Limits(max_connections=16, max_keepalive_connections=4)
+            )
+            self._async_client_loop = loop
+        return self._async_client
+    
+    async def _apubmed_request(self, endpoint: str, params: Dict[str, Any], method: str = "GET") -> httpx.Response:
+        """Async variant of _pubmed_request."""
+        url = f"{self.pubmed_base_url}/{endpoint}"
+        client = self._get_async_client()
+        
+        attempt = 0
+        while True:
+            await self.rate_limiter.async_wait()
+            try:
+                if method == "POST":
+                    response = await client.post(url, data=params)
+                else:
+                    response = await client.get(url, params=params)
+            except httpx.TransportError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(f"PubMed request to {endpoint} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            
+            if response.status_code in PUBMED_RETRY_STATUSES and attempt < self.max_retries:
+                delay = self._retry_delay(attempt, response.headers.get("Retry-After"))
+                logger.warning(f"PubMed returned {response.status_code} for {endpoint}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            
+            response.raise_for_status()
+            return response
+    
+    async def aclose(self):
+        """Close the async HTTP client, if one was created."""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+            self._async_client_loop = None
+    
+    async def afetch_pubmed_by_ids(self, id_list: List[str]) -> List[Document]:
+        """Async variant of fetch_pubmed_by_ids; cache access and XML parsing run in worker threads."""
+        cached = await asyncio.to_thread(self.pubmed_cache.get_articles, id_list) if self.pubmed_cache else {}
+        missing = [pmid for pmid in id_list if pmid not in cached]
+        
+        fetched = []
+        for i in range(0, len(missing), self.efetch_batch_size):
+            batch = missing[i:i + self.efetch_batch_size]
+            fetch_params = self._pubmed_params(id=",".join(batch), retmode="xml")
+            response = await self._apubmed_request("efetch.fcgi", fetch_params, method="POST")
+            fetched.extend(await asyncio.to_thread(self._parse_pubmed_articles, response.content))
+        
+        if self.pubmed_cache and fetched:
+            await asyncio.to_thread(self.pubmed_cache.put_articles, fetched)
+        
+        by_pmid = dict(cached)
+        by_pmid.update({doc.metadata["pmid"]: doc for doc in fetched})
+        return [by_pmid[pmid] for pmid in id_list if pmid in by_pmid]
+    
+    async def afetch_pubmed_articles(self, query: str, max_results: int = 20) -> List[Document]:
+        """Async variant of fetch_pubmed_articles."""
+        params = self._pubmed_params(term=query, retmax=max_results, retmode="json")
+        
+        try:
+            id_list = await asyncio.to_thread(self.pubmed_cache.get_query, query, max_results) if self.pubmed_cache else None
+            
+            if id_list is None:
+                logger.info(f"Searching PubMed for: {query}")
+                response = await self._apubmed_request("esearch.fcgi", params)
+                id_list = response.json().get("esearchresult", {}).get("idlist", [])
                 
-                documents.append(Document(page_content=content, metadata=metadata))
+                if self.pubmed_cache:
+                    await asyncio.to_thread(self.pubmed_cache.put_query, query, max_results, id_list)
+            else:
+                logger.info(f"Using cached PubMed search results for: {query}")
+            
+            if not id_list:
+                logger.warning(f"No PubMed articles found for query: {query}")
+                return []
             
+            documents = await self.afetch_pubmed_by_ids(id_list)
             logger.info(f"Fetched {len(documents)} PubMed articles")
             return documents
         
@@ -182,12 +698,24 @@ class MedicalDataProcessor:
             logger.error(f"Error fetching PubMed articles: {e}")
             return []
     
+    async def afetch_pubmed_for_queries(self, queries: List[str], max_results: int = 5, max_concurrency: int = 4) -> List[Document]:
+        """Async variant of fetch_pubmed_for_queries with a bounded number of queries in flight."""
+        if not queries:
+            return []
+        
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        
+        async def fetch(query: str) -> List[Document]:
+            async with semaphore:
+                return await self.afetch_pubmed_articles(query, max_results=max_results)
+        
+        results = await asyncio.gather(*(fetch(query) for query in queries))
+        return self._merge_query_results(queries, list(results))
+    
     def process_clinical_guidelines(self, guidelines_path: str) -> List[Document]:
         """Process clinical guidelines from PDF files."""
         try:
-            loader = PyPDFLoader(file_path=guidelines_path)
-            documents = loader.load()
-            split_docs = self.text_splitter.split_documents(documents)
+            split_docs = list(self.iter_document_chunks(guidelines_path))
             logger.info(f"Processed clinical guidelines into {len(split_docs)} chunks")
             return split_docs
         except Exception as e:
@@ -197,15 +725,44 @@ class MedicalDataProcessor:
     def process_medical_texts(self, text_path: str) -> List[Document]:
         """Process medical text files."""
         try:
-            loader = TextLoader(file_path=text_path)
-            documents = loader.load()
-            split_docs = self.text_splitter.split_documents(documents)
+            split_docs = list(self.iter_document_chunks(text_path))
             logger.info(f"Processed medical texts into {len(split_docs)} chunks")
             return split_docs
         except Exception as e:
             logger.error(f"Error processing medical texts: {e}")
             return []
     
+    def iter_document_pages(self, path: str, block_chars: int = 20000) -> Iterator[Document]:
+        """Yield a PDF page by page, or a text file in paragraph-aligned blocks, without loading it whole."""
+        if path.lower().endswith(".pdf"):
+            from langchain_community.document_loaders import PyPDFLoader
+            yield from PyPDFLoader(file_path=path).lazy_load()
+            return
+        
+        block = []
+        block_size = 0
+        block_number = 0
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                block.append(line)
+                block_size += len(line)
+                # Cut at paragraph breaks so chunks rarely straddle two blocks
+                if block_size >= block_chars and not line.strip():
+                    yield Document(page_content="".join(block), metadata={"source": path, "block": block_number})
+                    block, block_size = [], 0
+                    block_number += 1
+        if block_size:
+            yield Document(page_content="".join(block), metadata={"source": path, "block": block_number})
+    
+    def iter_document_chunks(self, path: str) -> Iterator[Document]:
+        """Yield split chunks of a PDF or text file one page at a time, numbering them for resumable loads."""
+        chunk_index = 0
+        for page in self.iter_document_pages(path):
+            for chunk in self.text_splitter.split_documents([page]):
+                chunk.metadata["chunk_index"] = chunk_index
+                chunk_index += 1
+                yield chunk
+    
     def create_sample_documents(self) -> List[Document]:
         """Create sample medical documents when external data sources are unavailable."""
         logger.info("Creating sample medical documents as fallback")
@@ -267,88 +824,1271 @@ class MedicalDataProcessor:
         return documents
 
 
-class MedicalVectorStore:
-    """Create and manage vector stores for medical documents."""
+def _build_hf_embeddings(model_name: str, batch_size: int, backend: str, quantize: bool) -> "HuggingFaceEmbeddings":
+    """Build a CPU HuggingFaceEmbeddings model for the requested backend and precision."""
+    from langchain_huggingface import HuggingFaceEmbeddings
+    model_kwargs = {"device": "cpu"}
+    if backend == "onnx":
+        model_kwargs["backend"] = "onnx"
+        if quantize:
+            # Pre-quantized int8 export shipped with the sentence-transformers ONNX models
+            model_kwargs["model_kwargs"] = {"file_name": EMBEDDING_ONNX_QUANTIZED_FILE}
     
-    def __init__(self, persist_directory: str = "./medical_chroma_db"):
-        self.persist_directory = persist_directory
-        
-        # Use a more widely available model that's more likely to work
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name="all-MiniLM-L6-v2",
-            model_kwargs={"device": "cpu"}
+    embeddings = HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs=model_kwargs,
+        encode_kwargs={"batch_size": batch_size}
+    )
+    
+    if quantize and backend == "torch":
+        import torch
+        embeddings._client = torch.quantization.quantize_dynamic(
+            embeddings._client, {torch.nn.Linear}, dtype=torch.qint8
         )
     
-    def create_vector_store(self, documents: List[Document], collection_name: str) -> Chroma:
-        """Create a vector store from documents."""
-        try:
-            # Ensure the persist directory exists
-            os.makedirs(f"{self.persist_directory}/{collection_name}", exist_ok=True)
-            
-            vector_store = Chroma.from_documents(
-                documents=documents,
-                embedding=self.embeddings,
-                persist_directory=f"{self.persist_directory}/{collection_name}"
+    return embeddings
+
+
+# Per-process model used by EmbeddingEngine worker pools
+_worker_embeddings = None
+
+
+def _init_embedding_worker(config: Dict[str, Any], threads: int):
+    global _worker_embeddings
+    import torch
+    torch.set_num_threads(threads)
+    _worker_embeddings = _build_hf_embeddings(**config)
+
+
+def _embed_in_worker(texts: List[str]):
+    start = time.perf_counter()
+    vectors = _worker_embeddings.embed_documents(texts)
+    return vectors, time.perf_counter() - start
+
+
+class EmbeddingEngine(Embeddings):
+    """Configurable CPU embedding engine with batching, optional process-pool sharding and ONNX/quantized models."""
+    
+    def __init__(self,
+                 model_name: str = EMBEDDING_MODEL_NAME,
+                 batch_size: int = 64,
+                 num_workers: int = 1,
+                 backend: str = "torch",
+                 quantize: bool = False):
+        if backend not in ("torch", "onnx"):
+            raise ValueError(f"Unsupported embedding backend: {backend}")
+        
+        self.config = {"model_name": model_name, "batch_size": batch_size, "backend": backend, "quantize": quantize}
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._pool = None
+        
+        # Throughput of the batches from the most recent embed_documents call
+        self.batch_stats = []
+    
+    @property
+    def model(self) -> "HuggingFaceEmbeddings":
+        """The in-process model, loaded on first use."""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    self._model = _build_hf_embeddings(**self.config)
+                    logger.info(f"Loaded embedding model {self.config['model_name']} in {time.perf_counter() - start:.2f}s")
+        return self._model
+    
+    @property
+    def cache_namespace(self) -> str:
+        """Name to key cached vectors under; backends and quantized variants produce different vectors."""
+        namespace = self.config["model_name"]
+        if self.config["backend"] == "onnx":
+            namespace += "-onnx"
+            if self.config["quantize"]:
+                namespace += "-" + os.path.splitext(os.path.basename(EMBEDDING_ONNX_QUANTIZED_FILE))[0]
+        elif self.config["quantize"]:
+            namespace += "-torch-qint8"
+        return namespace
+    
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_embedding_worker,
+                initargs=(self.config, threads)
             )
-            vector_store.persist()  # Make sure to persist the data to disk
-            logger.info(f"Created vector store with {len(documents)} documents for collection: {collection_name}")
-            return vector_store
-        except Exception as e:
-            logger.error(f"Error creating vector store: {e}")
-            raise
+        return self._pool
     
-    def load_vector_store(self, collection_name: str) -> Optional[Chroma]:
-        """Load an existing vector store."""
-        try:
-            if os.path.exists(f"{self.persist_directory}/{collection_name}"):
-                vector_store = Chroma(
-                    persist_directory=f"{self.persist_directory}/{collection_name}",
-                    embedding_function=self.embeddings
-                )
-                logger.info(f"Loaded vector store for collection: {collection_name}")
-                return vector_store
-            else:
-                logger.warning(f"Vector store for collection {collection_name} does not exist")
-                return None
-        except Exception as e:
-            logger.error(f"Error loading vector store: {e}")
-            return None
+    def _record_batch(self, index: int, total: int, size: int, elapsed: float):
+        rate = size / elapsed if elapsed > 0 else float("inf")
+        self.batch_stats.append({"batch": index, "chunks": size, "seconds": elapsed, "chunks_per_sec": rate})
+        logger.info(f"Embedded batch {index}/{total}: {size} chunks in {elapsed:.2f}s ({rate:.1f} chunks/sec)")
     
-    def add_documents(self, vector_store: Chroma, documents: List[Document]) -> Chroma:
-        """Add documents to an existing vector store."""
-        try:
-            vector_store.add_documents(documents)
-            vector_store.persist()  # Persist changes to disk
-            logger.info(f"Added {len(documents)} documents to vector store")
-            return vector_store
-        except Exception as e:
-            logger.error(f"Error adding documents to vector store: {e}")
-            raise
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents in fixed-size batches, sharding across worker processes for bulk loads."""
+        self.batch_stats = []
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        vectors = []
+        
+        # Small inputs aren't worth the inter-process overhead
+        if self.num_workers > 1 and len(batches) > 1:
+            for index, (batch_vectors, elapsed) in enumerate(self._get_pool().map(_embed_in_worker, batches), 1):
+                self._record_batch(index, len(batches), len(batch_vectors), elapsed)
+                vectors.extend(batch_vectors)
+        else:
+            for index, batch in enumerate(batches, 1):
+                start = time.perf_counter()
+                vectors.extend(self.model.embed_documents(batch))
+                self._record_batch(index, len(batches), len(batch), time.perf_counter() - start)
+        
+        return vectors
+    
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a single query in-process."""
+        return self.model.embed_query(text)
+    
+    def close(self):
+        """Shut down the worker pool, if one was started."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
 
 
-class MedicalEntityExtractor:
-    """Extract medical entities from text using LLM."""
+_embedding_engines = {}
+
+
+def get_embedding_engine(model_name: str = EMBEDDING_MODEL_NAME,
+                         batch_size: int = 64,
+                         num_workers: int = 1,
+                         backend: str = "torch",
+                         quantize: bool = False) -> EmbeddingEngine:
+    """Shared embedding engine per configuration; the model itself loads on first use."""
+    key = (model_name, batch_size, num_workers, backend, quantize)
+    with _shared_lock:
+        if key not in _embedding_engines:
+            _embedding_engines[key] = EmbeddingEngine(model_name, batch_size, num_workers, backend, quantize)
+        return _embedding_engines[key]
+
+
+class CachedEmbeddings(Embeddings):
+    """Content-addressed embedding cache in front of another embedding model.
     
-    def __init__(self):
-        self.llm = ChatMistralAI(
-            temperature=0, 
-            model="mistral-large-latest", 
-            mistral_api_key=MISTRAL_API_KEY
-        )
+    Vectors are keyed by a hash of the model name and text and stored as rows of a float32
+    file that is read through a memory map; a small SQLite index maps keys to rows. Only
+    documents are cached: queries carry patient details and go straight to the model.
+    """
+    
+    def __init__(self, underlying: Embeddings, model_name: str, cache_dir: str):
+        self.underlying = underlying
+        self.model_name = model_name
         
-        self.prompt = ChatPromptTemplate.from_messages([
-            SystemMessagePromptTemplate.from_template(
-                """You are a medical entity extraction system. Extract the following entities from the input text:
-                1. Medical conditions/diseases
-                2. Medications/drugs
-                3. Treatments/procedures
-                4. Lab tests/results
-                5. Vital signs
-                6. Patient demographics
-                
-                Format your response as a JSON object with these categories as keys and arrays of extracted entities as values.
-                If a category has no entities, use an empty array.
-                
+        cache_path = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
+        os.makedirs(cache_path, exist_ok=True)
+        self.vectors_path = os.path.join(cache_path, "vectors.f32")
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(cache_path, "index.sqlite3"), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, row INTEGER)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        self._conn.commit()
+        
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self.dim = row[0] if row else None
+        
+        self._mmap = None
+        self._mapped_rows = 0
+        
+        self.hits = 0
+        self.misses = 0
+    
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\x00{text}".encode()).hexdigest()
+    
+    def _row_count(self) -> int:
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.dim * 4)
+    
+    def _read_rows(self, rows: List[int]) -> np.ndarray:
+        """Read vectors by row number, remapping the file if it has grown. Caller holds the lock."""
+        if self._mmap is None or max(rows) >= self._mapped_rows:
+            self._mapped_rows = self._row_count()
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self._mapped_rows, self.dim))
+        return np.asarray(self._mmap[rows])
+    
+    def _append(self, keys: List[str], vectors: np.ndarray):
+        """Append new vectors and index them. Caller holds the lock.
+        
+        Other processes (prewarm, ingest, other server workers) may share the cache directory, so
+        the file write and the index update happen inside one BEGIN IMMEDIATE transaction: SQLite's
+        write lock serializes writers across processes, and the next row is read from the index
+        while holding it.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+            self.dim = row[0] if row else vectors.shape[1]
+            if row is None:
+                self._conn.execute("INSERT INTO meta (name, value) VALUES ('dim', ?)", (self.dim,))
+            
+            # Anything past the indexed rows is a torn write; cut it so new rows land at the offsets recorded for them
+            start_row = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM embeddings").fetchone()[0]
+            end_offset = start_row * self.dim * 4
+            with open(self.vectors_path, "ab") as f:
+                if os.path.getsize(self.vectors_path) != end_offset:
+                    logger.warning(f"Embedding cache file has {os.path.getsize(self.vectors_path) - end_offset} "
+                                   f"unindexed bytes; truncating to {start_row} rows")
+                    self._mmap = None
+                    self._mapped_rows = 0
+                    f.truncate(end_offset)
+                f.write(vectors.astype(np.float32).tobytes())
+            
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, row) VALUES (?, ?)",
+                [(key, start_row + i) for i, key in enumerate(keys)]
+            )
+            self._conn.commit()
+        except BaseException:
+            self._conn.rollback()
+            raise
+    
+    def _embed(self, texts: List[str], embed_fn) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        
+        with self._lock:
+            rows = {}
+            for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                chunk = keys[i:i + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" for _ in chunk)
+                rows.update(self._conn.execute(
+                    f"SELECT key, row FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall())
+        
+        # Embed each distinct missing text once, outside the lock
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in rows and key not in missing:
+                missing[key] = text
+        
+        new_vectors = {}
+        if missing:
+            computed = np.asarray(embed_fn(list(missing.values())), dtype=np.float32)
+            new_vectors = dict(zip(missing, computed))
+        
+        with self._lock:
+            if new_vectors:
+                self._append(list(new_vectors), np.stack(list(new_vectors.values())))
+            
+            cached_keys = [key for key in keys if key in rows]
+            cached_vectors = dict(zip(cached_keys, self._read_rows([rows[key] for key in cached_keys]))) if cached_keys else {}
+            
+            miss_count = sum(1 for key in keys if key in new_vectors)
+            self.misses += miss_count
+            self.hits += len(keys) - miss_count
+        
+        return [
+            (new_vectors[key] if key in new_vectors else cached_vectors[key]).tolist()
+            for key in keys
+        ]
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents, serving cached vectors before calling the model."""
+        return self._embed(texts, self.underlying.embed_documents)
+    
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed several retrieval queries in one model call.
+        
+        Queries carry patient details and rarely repeat, so they bypass the on-disk cache.
+        """
+        return self.underlying.embed_documents(texts)
+    
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query with the model; like embed_queries, this bypasses the on-disk cache."""
+        return self.underlying.embed_query(text)
+    
+    def stats(self) -> Dict[str, int]:
+        """Return cache hit/miss counters."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class BM25Index:
+    """Persistent, incrementally updatable BM25 inverted index stored in SQLite.
+    
+    Postings, document lengths and the corpus size and total length all live on disk, so opening
+    an existing index is cheap, documents can be added or removed without rebuilding it, and
+    every instance sees documents added by other processes (prewarm, cohort runs, ingest).
+    """
+    
+    def __init__(self, db_path: str, k1: float = 1.5, b: float = 0.75):
+        self.db_path = db_path
+        self.k1 = k1
+        self.b = b
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs (doc_id TEXT PRIMARY KEY, content TEXT, metadata TEXT, length INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings (term TEXT, doc_id TEXT, tf INTEGER, PRIMARY KEY (term, doc_id))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id)")
+        # Corpus statistics, updated in the same transaction as the postings
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), doc_count INTEGER, total_length INTEGER)"
+        )
+        self._conn.execute(
+            "INSERT OR IGNORE INTO stats (id, doc_count, total_length) "
+            "SELECT 0, COUNT(*), COALESCE(SUM(length), 0) FROM docs"
+        )
+        self._conn.commit()
+    
+    def _corpus_stats(self) -> Tuple[int, int]:
+        """Return (document count, total length). Caller holds the lock."""
+        return self._conn.execute("SELECT doc_count, total_length FROM stats WHERE id = 0").fetchone()
+    
+    @property
+    def doc_count(self) -> int:
+        with self._lock:
+            return self._corpus_stats()[0]
+    
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return re.findall(r"\w+", text.lower())
+    
+    def missing_ids(self, doc_ids: List[str]) -> List[str]:
+        """Return the IDs that are not yet indexed."""
+        if not doc_ids:
+            return []
+        doc_ids = list(doc_ids)
+        present = set()
+        with self._lock:
+            for i in range(0, len(doc_ids), SQLITE_MAX_VARIABLES):
+                chunk = doc_ids[i:i + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" for _ in chunk)
+                present.update(row[0] for row in self._conn.execute(
+                    f"SELECT doc_id FROM docs WHERE doc_id IN ({placeholders})", chunk
+                ))
+        return [doc_id for doc_id in doc_ids if doc_id not in present]
+    
+    def add_documents(self, documents: List[Document], ids: List[str]):
+        """Index documents under the given IDs, skipping IDs that are already indexed.
+        
+        Runs as one write transaction, so concurrent writers (in this or another process) can
+        add overlapping documents without conflicts.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                added = 0
+                added_length = 0
+                for doc, doc_id in zip(documents, ids):
+                    term_counts = Counter(self.tokenize(doc.page_content))
+                    length = sum(term_counts.values())
+                    cursor = self._conn.execute(
+                        "INSERT OR IGNORE INTO docs (doc_id, content, metadata, length) VALUES (?, ?, ?, ?)",
+                        (doc_id, doc.page_content, json.dumps(doc.metadata), length)
+                    )
+                    if cursor.rowcount == 0:
+                        continue
+                    self._conn.executemany(
+                        "INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)",
+                        [(term, doc_id, tf) for term, tf in term_counts.items()]
+                    )
+                    added += 1
+                    added_length += length
+                
+                self._conn.execute(
+                    "UPDATE stats SET doc_count = doc_count + ?, total_length = total_length + ? WHERE id = 0",
+                    (added, added_length)
+                )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+    
+    def remove_documents(self, doc_ids: List[str]):
+        """Remove documents and their postings from the index."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                removed = 0
+                removed_length = 0
+                for doc_id in doc_ids:
+                    row = self._conn.execute("SELECT length FROM docs WHERE doc_id = ?", (doc_id,)).fetchone()
+                    if row is None:
+                        continue
+                    self._conn.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+                    self._conn.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+                    removed += 1
+                    removed_length += row[0]
+                
+                self._conn.execute(
+                    "UPDATE stats SET doc_count = doc_count - ?, total_length = total_length - ? WHERE id = 0",
+                    (removed, removed_length)
+                )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+    
+    def search(self, query: str, k: int = 5, doc_ids: Optional[List[str]] = None) -> List[Document]:
+        """Return the top-k documents by BM25 score, optionally restricted to a set of document IDs.
+        
+        A restriction is applied in SQL through a temporary ID table, so a patient's query over the
+        shared literature index only reads postings for that patient's slice.
+        """
+        scores = {}
+        
+        with self._lock:
+            # Read per search: other processes may have added documents since this index was opened
+            doc_count, total_length = self._corpus_stats()
+            if doc_count == 0:
+                return []
+            avg_length = total_length / doc_count
+            
+            if doc_ids is not None:
+                self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS search_ids (doc_id TEXT PRIMARY KEY)")
+                self._conn.execute("DELETE FROM search_ids")
+                self._conn.executemany("INSERT OR IGNORE INTO search_ids (doc_id) VALUES (?)", ((doc_id,) for doc_id in doc_ids))
+                self._conn.commit()
+                postings_sql = (
+                    # CROSS JOIN fixes the join order: walk the slice, then look up each ID's posting
+                    "SELECT p.doc_id, p.tf, d.length FROM search_ids s CROSS JOIN postings p CROSS JOIN docs d "
+                    "WHERE p.term = ? AND p.doc_id = s.doc_id AND d.doc_id = s.doc_id"
+                )
+            else:
+                postings_sql = "SELECT p.doc_id, p.tf, d.length FROM postings p JOIN docs d ON d.doc_id = p.doc_id WHERE p.term = ?"
+            
+            for term in set(self.tokenize(query)):
+                postings = self._conn.execute(postings_sql, (term,)).fetchall()
+                if not postings:
+                    continue
+                
+                # IDF uses corpus-wide statistics even when the results are restricted
+                df = len(postings) if doc_ids is None else self._conn.execute(
+                    "SELECT COUNT(*) FROM postings WHERE term = ?", (term,)
+                ).fetchone()[0]
+                idf = math.log((doc_count - df + 0.5) / (df + 0.5) + 1)
+                for doc_id, tf, length in postings:
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+            
+            top_ids = sorted(scores, key=scores.get, reverse=True)[:k]
+            documents = []
+            for doc_id in top_ids:
+                content, metadata = self._conn.execute(
+                    "SELECT content, metadata FROM docs WHERE doc_id = ?", (doc_id,)
+                ).fetchone()
+                documents.append(Document(page_content=content, metadata=json.loads(metadata)))
+        
+        return documents
+    
+    def as_retriever(self, k: int = 5, doc_ids: Optional[List[str]] = None) -> "BM25IndexRetriever":
+        return BM25IndexRetriever(index=self, k=k, doc_ids=doc_ids)
+
+
+class BM25IndexRetriever(BaseRetriever):
+    """LangChain retriever over a BM25Index."""
+    
+    index: Any
+    k: int = 5
+    doc_ids: Optional[List[str]] = None
+    
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.index.search(query, k=self.k, doc_ids=self.doc_ids)
+
+
+_worker_data_processor = None
+
+
+def _init_split_worker():
+    global _worker_data_processor
+    _worker_data_processor = MedicalDataProcessor(cache_dir=None)
+
+
+def _split_file_in_worker(path: str, out_queue: "queue.Queue", batch_size: int) -> int:
+    """Split a file, handing chunks back through out_queue in batches and ending with None.
+    
+    The queue is bounded, so a worker that gets ahead of the parent waits instead of holding
+    the whole file in memory. Returns the number of chunks.
+    """
+    count = 0
+    batch = []
+    for chunk in _worker_data_processor.iter_document_chunks(path):
+        batch.append(chunk)
+        count += 1
+        if len(batch) >= batch_size:
+            out_queue.put(batch)
+            batch = []
+    if batch:
+        out_queue.put(batch)
+    out_queue.put(None)
+    return count
+
+
+class MedicalVectorStore:
+    """Create and manage vector stores for medical documents."""
+    
+    def __init__(self,
+                 persist_directory: str = DEFAULT_PERSIST_DIRECTORY,
+                 embedding_batch_size: int = 64,
+                 embedding_workers: int = 1,
+                 embedding_backend: str = "torch",
+                 quantize_embeddings: bool = False):
+        self.persist_directory = persist_directory
+        
+        # Use a more widely available model that's more likely to work, behind an on-disk embedding cache
+        self.embedding_engine = get_embedding_engine(
+            batch_size=embedding_batch_size,
+            num_workers=embedding_workers,
+            backend=embedding_backend,
+            quantize=quantize_embeddings
+        )
+        self.embeddings = CachedEmbeddings(
+            self.embedding_engine,
+            model_name=self.embedding_engine.cache_namespace,
+            cache_dir=f"{self.persist_directory}/embedding_cache"
+        )
+        
+        self._literature_store = None
+        self._literature_lock = threading.Lock()
+        self._bm25_indexes = {}
+        self._bm25_lock = threading.Lock()
+    
+    @staticmethod
+    def document_id(document: Document) -> str:
+        """Stable ID for a literature document: the PMID when available, otherwise a content hash."""
+        pmid = document.metadata.get("pmid")
+        if pmid:
+            return f"pmid_{pmid}"
+        return "sha_" + hashlib.sha256(document.page_content.encode()).hexdigest()[:32]
+    
+    def get_literature_store(self) -> "Chroma":
+        """Open (or create) the shared literature collection."""
+        if self._literature_store is None:
+            persist_path = f"{self.persist_directory}/{LITERATURE_COLLECTION}"
+            os.makedirs(persist_path, exist_ok=True)
+            from langchain_community.vectorstores import Chroma
+            self._literature_store = Chroma(
+                collection_name=LITERATURE_COLLECTION,
+                persist_directory=persist_path,
+                embedding_function=self.embeddings
+            )
+        return self._literature_store
+    
+    def add_literature(self, documents: List[Document]) -> List[str]:
+        """Add documents to the shared literature collection, embedding only those not already indexed.
+        
+        Returns the IDs of all given documents so callers can scope retrieval to them.
+        """
+        unique_docs = {}
+        for doc in documents:
+            doc_id = self.document_id(doc)
+            if doc_id not in unique_docs:
+                doc.metadata["doc_id"] = doc_id
+                unique_docs[doc_id] = doc
+        
+        doc_ids = list(unique_docs)
+        if not doc_ids:
+            return []
+        
+        try:
+            # Serialize the existence check and insert so concurrent initializations don't embed twice
+            with self._literature_lock:
+                store = self.get_literature_store()
+                existing_ids = set(store.get(ids=doc_ids)["ids"])
+                new_ids = [doc_id for doc_id in doc_ids if doc_id not in existing_ids]
+                
+                if new_ids:
+                    store.add_documents([unique_docs[doc_id] for doc_id in new_ids], ids=new_ids)
+                    store.persist()
+                
+                # The BM25 index skips documents it already holds, which also backfills older collections
+                self.get_bm25_index(LITERATURE_COLLECTION).add_documents(list(unique_docs.values()), doc_ids)
+            
+            logger.info(f"Literature collection: {len(new_ids)} new documents embedded, {len(doc_ids) - len(new_ids)} already indexed")
+            return doc_ids
+        except Exception as e:
+            logger.error(f"Error adding documents to literature collection: {e}")
+            raise
+    
+    def get_literature_retriever(self, doc_ids: List[str], k: int = 5):
+        """Retriever over the shared literature collection restricted to the given document IDs."""
+        return self.get_literature_store().as_retriever(
+            search_type="similarity",
+            search_kwargs={"k": k, "filter": {"doc_id": {"$in": doc_ids}}}
+        )
+    
+    def get_bm25_index(self, collection_name: str) -> BM25Index:
+        """Open the persistent BM25 index stored alongside a collection."""
+        if collection_name not in self._bm25_indexes:
+            with self._bm25_lock:
+                if collection_name not in self._bm25_indexes:
+                    persist_path = f"{self.persist_directory}/{collection_name}"
+                    os.makedirs(persist_path, exist_ok=True)
+                    self._bm25_indexes[collection_name] = BM25Index(f"{persist_path}/bm25.sqlite3")
+        return self._bm25_indexes[collection_name]
+    
+    def sync_bm25_index(self, index: BM25Index, vector_store: "Chroma", doc_ids: Optional[List[str]] = None):
+        """Backfill a BM25 index from a Chroma collection that was built before the index existed."""
+        if doc_ids is None:
+            if index.doc_count > 0:
+                return
+            data = vector_store.get()
+        else:
+            missing = index.missing_ids(doc_ids)
+            if not missing:
+                return
+            data = vector_store.get(ids=missing)
+        
+        documents = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(data["documents"], data["metadatas"])
+        ]
+        index.add_documents(documents, [self.document_id(doc) for doc in documents])
+        logger.info(f"Backfilled BM25 index with {len(documents)} documents")
+    
+    def save_literature_ids(self, collection_name: str, doc_ids: List[str]):
+        """Record which shared literature documents belong to a patient collection."""
+        with open(f"{self.persist_directory}/{collection_name}/literature_ids.json", "w") as f:
+            json.dump(doc_ids, f)
+    
+    def load_literature_ids(self, collection_name: str) -> List[str]:
+        """Load the literature document IDs recorded for a patient collection."""
+        path = f"{self.persist_directory}/{collection_name}/literature_ids.json"
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return json.load(f)
+    
+    def create_vector_store(self, documents: List[Document], collection_name: str) -> "Chroma":
+        """Create a vector store from documents."""
+        try:
+            # Ensure the persist directory exists
+            os.makedirs(f"{self.persist_directory}/{collection_name}", exist_ok=True)
+            
+            from langchain_community.vectorstores import Chroma
+            vector_store = Chroma.from_documents(
+                documents=documents,
+                embedding=self.embeddings,
+                persist_directory=f"{self.persist_directory}/{collection_name}"
+            )
+            vector_store.persist()  # Make sure to persist the data to disk
+            logger.info(f"Created vector store with {len(documents)} documents for collection: {collection_name}")
+            return vector_store
+        except Exception as e:
+            logger.error(f"Error creating vector store: {e}")
+            raise
+    
+    def load_vector_store(self, collection_name: str) -> Optional["Chroma"]:
+        """Load an existing vector store."""
+        try:
+            if os.path.exists(f"{self.persist_directory}/{collection_name}"):
+                from langchain_community.vectorstores import Chroma
+                vector_store = Chroma(
+                    persist_directory=f"{self.persist_directory}/{collection_name}",
+                    embedding_function=self.embeddings
+                )
+                logger.info(f"Loaded vector store for collection: {collection_name}")
+                return vector_store
+            else:
+                logger.warning(f"Vector store for collection {collection_name} does not exist")
+                return None
+        except Exception as e:
+            logger.error(f"Error loading vector store: {e}")
+            return None
+    
+    @staticmethod
+    def chunk_id(source_key: str, chunk_index: int) -> str:
+        """Deterministic ID for a chunk of an ingested file."""
+        return "chunk_" + hashlib.sha256(f"{source_key}:{chunk_index}".encode()).hexdigest()[:32]
+    
+    def ingest_documents(self,
+                         chunks: Iterator[Document],
+                         collection_name: str,
+                         batch_size: int = 256,
+                         source_key: Optional[str] = None,
+                         id_key: Optional[str] = None) -> int:
+        """Embed and write a stream of chunks in fixed-size batches, so memory stays flat for any corpus size.
+        
+        Chunks need the "chunk_index" metadata set by MedicalDataProcessor.iter_document_chunks. With a
+        source_key, progress is recorded after every batch and a rerun skips the chunks already written.
+        Chunk IDs are derived from id_key (default: source_key) and the chunk index.
+        Returns the number of chunks written by this call.
+        """
+        persist_path = f"{self.persist_directory}/{collection_name}"
+        os.makedirs(persist_path, exist_ok=True)
+        from langchain_community.vectorstores import Chroma
+        vector_store = Chroma(persist_directory=persist_path, embedding_function=self.embeddings)
+        bm25_index = self.get_bm25_index(collection_name)
+        
+        progress = self._load_ingest_progress(collection_name)
+        done = progress.get(source_key, 0) if source_key else 0
+        if done:
+            logger.info(f"Resuming ingestion of {source_key} after {done} chunks")
+        
+        written = 0
+        batch = []
+        
+        def flush():
+            nonlocal written
+            ids = [
+                self.chunk_id(id_key or source_key or doc.metadata.get("source", ""), doc.metadata["chunk_index"])
+                for doc in batch
+            ]
+            vector_store.add_documents(batch, ids=ids)
+            vector_store.persist()
+            bm25_index.add_documents(batch, ids)
+            written += len(batch)
+            if source_key:
+                progress[source_key] = batch[-1].metadata["chunk_index"] + 1
+                self._save_ingest_progress(collection_name, progress)
+            batch.clear()
+        
+        for chunk in chunks:
+            if chunk.metadata["chunk_index"] < done:
+                continue
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                flush()
+                logger.info(f"Ingested {written} chunks into collection: {collection_name}")
+        if batch:
+            flush()
+        
+        logger.info(f"Finished ingesting {written} chunks into collection: {collection_name}")
+        return written
+    
+    def ingest_file(self,
+                    data_processor: MedicalDataProcessor,
+                    path: str,
+                    collection_name: str,
+                    batch_size: int = 256) -> int:
+        """Stream a guideline PDF or text file into a collection, resuming an interrupted load of the same file.
+        
+        Chunk IDs are keyed on the file's path, so ingesting a modified file replaces the chunks of
+        the version ingested before it.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        # A modified file starts over instead of resuming against stale chunk numbers
+        source_key = f"{path}:{stat.st_size}:{int(stat.st_mtime)}"
+        
+        progress = self._load_ingest_progress(collection_name)
+        superseded = [key for key in progress if key != source_key and key.rsplit(":", 2)[0] == path]
+        if superseded:
+            # Earlier versions' progress entries hold how many chunks they wrote; chunks written
+            # before IDs were keyed on the path used the versioned key, so drop those too
+            ids = [self.chunk_id(path, index) for index in range(max(progress[key] for key in superseded))]
+            for key in superseded:
+                ids.extend(self.chunk_id(key, index) for index in range(progress.pop(key)))
+            from langchain_community.vectorstores import Chroma
+            vector_store = Chroma(persist_directory=f"{self.persist_directory}/{collection_name}", embedding_function=self.embeddings)
+            vector_store.delete(ids=ids)
+            vector_store.persist()
+            self.get_bm25_index(collection_name).remove_documents(ids)
+            self._save_ingest_progress(collection_name, progress)
+            logger.info(f"Removed {len(superseded)} earlier version(s) of {path} from collection: {collection_name}")
+        
+        return self.ingest_documents(
+            data_processor.iter_document_chunks(path), collection_name, batch_size=batch_size,
+            source_key=source_key, id_key=path
+        )
+    
+    def ingest_directory(self,
+                         corpus_dir: str,
+                         collection_name: str,
+                         workers: int = max(1, (os.cpu_count() or 2) - 1),
+                         batch_size: int = 256,
+                         extensions: Tuple[str, ...] = (".pdf", ".txt", ".md")) -> Dict[str, int]:
+        """Index a corpus directory, re-processing only new or changed files and dropping deleted ones.
+        
+        A manifest of path, mtime, size and content hash per file lives next to the collection. Files
+        are parsed and split in a process pool while the parent embeds and writes the chunks; workers
+        hand chunks back in batch_size batches through bounded queues, so memory stays bounded even
+        for very large files.
+        """
+        manifest = self._load_corpus_manifest(collection_name)
+        from langchain_community.vectorstores import Chroma
+        vector_store = Chroma(persist_directory=f"{self.persist_directory}/{collection_name}", embedding_function=self.embeddings)
+        bm25_index = self.get_bm25_index(collection_name)
+        stats = {"unchanged": 0, "added": 0, "updated": 0, "deleted": 0, "failed": 0, "chunks": 0}
+        
+        paths = []
+        for dirpath, _, filenames in os.walk(corpus_dir):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(extensions):
+                    paths.append(os.path.join(dirpath, filename))
+        
+        # Deleted files: drop their chunks from the store and the BM25 index
+        current = {os.path.relpath(path, corpus_dir) for path in paths}
+        for rel_path in [rel_path for rel_path in manifest if rel_path not in current]:
+            self._remove_corpus_file(vector_store, bm25_index, rel_path, manifest.pop(rel_path))
+            stats["deleted"] += 1
+        if stats["deleted"]:
+            self._save_corpus_manifest(collection_name, manifest)
+        
+        # Changed files: mtime and size are checked first so unchanged files are never read
+        pending = []
+        for path in paths:
+            rel_path = os.path.relpath(path, corpus_dir)
+            stat = os.stat(path)
+            entry = manifest.get(rel_path)
+            if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                stats["unchanged"] += 1
+                continue
+            
+            content_hash = self._file_hash(path)
+            if entry and entry["sha256"] == content_hash:
+                entry.update(mtime=stat.st_mtime, size=stat.st_size)
+                stats["unchanged"] += 1
+                continue
+            pending.append((path, rel_path, stat, content_hash))
+        
+        if pending:
+            logger.info(f"Corpus ingestion: {len(pending)} new or changed files, {stats['unchanged']} unchanged")
+            mp_context = multiprocessing.get_context("spawn")
+            workers = max(1, min(workers, len(pending)))
+            manager = mp_context.Manager()
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_split_worker)
+            
+            def next_batch(out_queue, future) -> Optional[List[Document]]:
+                # Poll so a worker that died without sending the end marker surfaces as an error
+                while True:
+                    try:
+                        return out_queue.get(timeout=1.0)
+                    except queue.Empty:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+            
+            def file_chunks(out_queue, future, rel_path: str, counter: List[int]) -> Iterator[Document]:
+                while True:
+                    batch = next_batch(out_queue, future)
+                    if batch is None:
+                        return
+                    for chunk in batch:
+                        chunk.metadata["source"] = rel_path
+                        counter[0] += 1
+                        yield chunk
+            
+            try:
+                # One file per worker in flight; files are written in order while later ones are split ahead
+                queued = iter(pending)
+                in_flight = []
+                for item in queued:
+                    out_queue = manager.Queue(maxsize=2)
+                    in_flight.append((item, out_queue, pool.submit(_split_file_in_worker, item[0], out_queue, batch_size)))
+                    if len(in_flight) >= workers:
+                        break
+                
+                while in_flight:
+                    (path, rel_path, stat, content_hash), out_queue, future = in_flight.pop(0)
+                    next_item = next(queued, None)
+                    if next_item is not None:
+                        next_queue = manager.Queue(maxsize=2)
+                        in_flight.append(
+                            (next_item, next_queue, pool.submit(_split_file_in_worker, next_item[0], next_queue, batch_size))
+                        )
+                    
+                    counter = [0]
+                    chunks = file_chunks(out_queue, future, rel_path, counter)
+                    try:
+                        source_key = f"{rel_path}:{content_hash}"
+                        old_entry = manifest.get(rel_path)
+                        self.ingest_documents(chunks, collection_name, batch_size=batch_size, source_key=source_key)
+                        if old_entry:
+                            self._remove_corpus_file(vector_store, bm25_index, rel_path, old_entry)
+                        
+                        manifest[rel_path] = {
+                            "mtime": stat.st_mtime,
+                            "size": stat.st_size,
+                            "sha256": content_hash,
+                            "chunks": counter[0]
+                        }
+                        self._save_corpus_manifest(collection_name, manifest)
+                        self._clear_ingest_progress(collection_name, source_key)
+                        stats["updated" if old_entry else "added"] += 1
+                        stats["chunks"] += counter[0]
+                    except Exception as e:
+                        logger.error(f"Error ingesting {path}: {e}")
+                        stats["failed"] += 1
+                        # Drain what's left so the worker isn't stuck on a full queue
+                        try:
+                            for _ in chunks:
+                                pass
+                        except Exception:
+                            pass
+            finally:
+                pool.shutdown()
+                manager.shutdown()
+        
+        self._save_corpus_manifest(collection_name, manifest)
+        logger.info(f"Corpus ingestion finished for collection {collection_name}: {stats}")
+        return stats
+    
+    def _remove_corpus_file(self, vector_store: "Chroma", bm25_index: BM25Index, rel_path: str, entry: Dict[str, Any]):
+        """Delete the chunks a manifest entry recorded for a file."""
+        ids = [self.chunk_id(f"{rel_path}:{entry['sha256']}", index) for index in range(entry["chunks"])]
+        if ids:
+            vector_store.delete(ids=ids)
+            vector_store.persist()
+            bm25_index.remove_documents(ids)
+    
+    @staticmethod
+    def _file_hash(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def _load_corpus_manifest(self, collection_name: str) -> Dict[str, Dict[str, Any]]:
+        path = f"{self.persist_directory}/{collection_name}/corpus_manifest.json"
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+    
+    def _save_corpus_manifest(self, collection_name: str, manifest: Dict[str, Dict[str, Any]]):
+        path = f"{self.persist_directory}/{collection_name}/corpus_manifest.json"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{path}.tmp", path)
+    
+    def _clear_ingest_progress(self, collection_name: str, source_key: str):
+        progress = self._load_ingest_progress(collection_name)
+        if progress.pop(source_key, None) is not None:
+            self._save_ingest_progress(collection_name, progress)
+    
+    def _load_ingest_progress(self, collection_name: str) -> Dict[str, int]:
+        path = f"{self.persist_directory}/{collection_name}/ingest_progress.json"
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+    
+    def _save_ingest_progress(self, collection_name: str, progress: Dict[str, int]):
+        path = f"{self.persist_directory}/{collection_name}/ingest_progress.json"
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(progress, f)
+        os.replace(f"{path}.tmp", path)
+    
+    def add_documents(self, vector_store: "Chroma", documents: List[Document]) -> "Chroma":
+        """Add documents to an existing vector store."""
+        try:
+            vector_store.add_documents(documents)
+            vector_store.persist()  # Persist changes to disk
+            logger.info(f"Added {len(documents)} documents to vector store")
+            return vector_store
+        except Exception as e:
+            logger.error(f"Error adding documents to vector store: {e}")
+            raise
+
+
+class LocalEntityExtractor:
+    """Fast rule-based entity extraction using compiled patterns and a term trie.
+    
+    Handles the common, regular cases (vitals, labs, dosed medications, demographics and
+    dictionary conditions/drugs/treatments) in milliseconds, and reports which sentences it
+    could not account for so only those need the LLM. Negated, historical and family-history
+    mentions and symptoms are never extracted locally; their sentences are left to the LLM.
+    """
+    
+    # (term, canonical name) pairs; abbreviations map onto the full name so they deduplicate
+    CONDITION_TERMS = [
+        "hypertension", ("htn", "hypertension"), "high blood pressure", "hypotension",
+        "type 2 diabetes", "type 2 diabetes mellitus", ("t2dm", "type 2 diabetes mellitus"),
+        "type 1 diabetes", "diabetes", "diabetes mellitus", "prediabetes",
+        "chronic obstructive pulmonary disease", ("copd", "chronic obstructive pulmonary disease"),
+        "asthma", "pneumonia", "bronchitis", "emphysema", "pulmonary embolism", "sleep apnea",
+        "heart failure", "congestive heart failure", ("chf", "congestive heart failure"),
+        "coronary artery disease", ("cad", "coronary artery disease"), "myocardial infarction",
+        "atrial fibrillation", ("afib", "atrial fibrillation"), "angina", "stroke", "deep vein thrombosis",
+        "hyperlipidemia", "dyslipidemia", "hypercholesterolemia", "obesity",
+        "chronic kidney disease", ("ckd", "chronic kidney disease"), "acute kidney injury", "nephropathy",
+        "osteoporosis", "osteopenia", "osteoarthritis", "rheumatoid arthritis", "gout",
+        "gastroesophageal reflux disease", ("gerd", "gastroesophageal reflux disease"), "peptic ulcer disease",
+        "cirrhosis", "hepatitis", "pancreatitis", "crohn's disease", "ulcerative colitis",
+        "hypothyroidism", "hyperthyroidism", "anemia", "iron deficiency anemia", "vitamin d deficiency",
+        "depression", "major depressive disorder", "anxiety", "generalized anxiety disorder", "dementia",
+        "alzheimer's disease", "parkinson's disease", "epilepsy", "migraine", "neuropathy", "retinopathy",
+        "sepsis", "urinary tract infection", ("uti", "urinary tract infection"), "cellulitis", "cancer",
+        "breast cancer", "lung cancer", "prostate cancer", "colorectal cancer",
+    ]
+    
+    # Symptoms and exposures aren't conditions to look up guidelines for; they are only recognized
+    # so their sentences go to the LLM instead of being counted as covered
+    SYMPTOM_TERMS = [
+        "shortness of breath", "dyspnea", "cough", "chronic cough", "chest pain", "back pain", "heartburn",
+        "difficulty swallowing", "dysphagia", "fatigue", "edema", "smoking history", "tobacco use",
+    ]
+    
+    DRUG_TERMS = [
+        "metformin", "insulin", "insulin glargine", "glipizide", "glyburide", "sitagliptin", "empagliflozin",
+        "dapagliflozin", "canagliflozin", "liraglutide", "semaglutide", "dulaglutide", "pioglitazone",
+        "lisinopril", "enalapril", "ramipril", "losartan", "valsartan", "irbesartan", "amlodipine", "nifedipine",
+        "diltiazem", "verapamil", "hydrochlorothiazide", "chlorthalidone", "furosemide", "torsemide",
+        "spironolactone", "metoprolol", "carvedilol", "atenolol", "bisoprolol", "propranolol",
+        "atorvastatin", "rosuvastatin", "simvastatin", "pravastatin", "ezetimibe",
+        "aspirin", "clopidogrel", "ticagrelor", "warfarin", "apixaban", "rivaroxaban", "dabigatran", "heparin",
+        "enoxaparin", "digoxin", "amiodarone", "nitroglycerin",
+        "tiotropium", "spiriva", "albuterol", "salmeterol", "formoterol", "fluticasone", "budesonide",
+        "ipratropium", "montelukast", "prednisone", "methylprednisolone",
+        "alendronate", "risedronate", "denosumab", "calcium carbonate", "vitamin d", "cholecalciferol",
+        "omeprazole", "pantoprazole", "esomeprazole", "lansoprazole", "famotidine", "ondansetron",
+        "levothyroxine", "methimazole", "allopurinol", "colchicine",
+        "sertraline", "fluoxetine", "citalopram", "escitalopram", "bupropion", "venlafaxine", "duloxetine",
+        "trazodone", "gabapentin", "pregabalin", "acetaminophen", "ibuprofen", "naproxen", "tramadol",
+        "oxycodone", "morphine", "amoxicillin", "amoxicillin-clavulanate", "azithromycin", "doxycycline",
+        "ciprofloxacin", "levofloxacin", "ceftriaxone", "cephalexin", "vancomycin", "nitrofurantoin",
+        "trimethoprim-sulfamethoxazole",
+    ]
+    
+    TREATMENT_TERMS = [
+        "dialysis", "hemodialysis", "chemotherapy", "radiation therapy", "physical therapy",
+        "pulmonary rehabilitation", "cardiac rehabilitation", "oxygen therapy", "supplemental oxygen",
+        "cpap", "mechanical ventilation", "surgery", "appendectomy", "cholecystectomy", "hip replacement",
+        "knee replacement", "coronary artery bypass graft", ("cabg", "coronary artery bypass graft"),
+        "percutaneous coronary intervention", ("pci", "percutaneous coronary intervention"), "angioplasty",
+        "stent placement", "pacemaker", "blood transfusion", "smoking cessation", "lifestyle modification",
+        "dash diet", "colonoscopy", "endoscopy", "biopsy", "vaccination",
+    ]
+    
+    VITAL_PATTERNS = [
+        (re.compile(r"\b(?:blood pressure|BP)?\s*(?:of|was|is|:)?\s*(\d{2,3}/\d{2,3})\s*mm\s?Hg", re.I),
+         lambda m: f"blood pressure {m.group(1)} mmHg"),
+        (re.compile(r"\b(?:heart rate|HR|pulse)\s*(?:of|was|is|:)?\s*(\d{2,3})\s*(?:bpm|beats per minute)?", re.I),
+         lambda m: f"heart rate {m.group(1)} bpm"),
+        (re.compile(r"\b(?:respiratory rate|RR)\s*(?:of|was|is|:)?\s*(\d{1,2})\b", re.I),
+         lambda m: f"respiratory rate {m.group(1)}"),
+        (re.compile(r"\b(?:temperature|temp)\s*(?:of|was|is|:)?\s*(\d{2,3}(?:\.\d)?)\s*°?\s*([CF])\b", re.I),
+         lambda m: f"temperature {m.group(1)} °{m.group(2).upper()}"),
+        (re.compile(r"\b(?:SpO2|O2 sat(?:uration)?|oxygen saturation)\s*(?:of|was|is|:)?\s*(\d{2,3})\s*%", re.I),
+         lambda m: f"oxygen saturation {m.group(1)}%"),
+        (re.compile(r"\bBMI\s*(?:of|was|is|:)?\s*(\d{2}(?:\.\d)?)", re.I),
+         lambda m: f"BMI {m.group(1)}"),
+    ]
+    
+    LAB_PATTERN = re.compile(
+        r"\b(?P<name>HbA1c|A1c|glucose|creatinine|eGFR|LDL|HDL|total cholesterol|cholesterol|triglycerides|"
+        r"potassium|sodium|calcium|vitamin D|TSH|hemoglobin|WBC|platelets|INR|BNP|troponin|FEV1|FVC|ALT|AST|"
+        r"albumin|ferritin|T-score)\b\)?"
+        r"(?:\s*(?:level|levels|of|was|is|at|:|=))*\s*"
+        r"(?P<value>-?\d+(?:\.\d+)?)\s*"
+        r"(?P<unit>%(?:\s*predicted)?|mg/dL|mmol/L|ng/mL|g/dL|mEq/L|U/L|pg/mL|mL/min(?:/1\.73\s*m2)?)?",
+        re.I
+    )
+    
+    DOSE_PATTERN = re.compile(
+        r"\s*(?:\([^)]{0,40}\)\s*)?"
+        r"(\d+(?:\.\d+)?\s*(?:mg|mcg|µg|g|units?|IU|mL)\b"
+        r"(?:\s*(?:once daily|twice daily|daily|weekly|BID|TID|QID|QD|QHS|PRN|at bedtime|every \d+ hours))?)",
+        re.I
+    )
+    
+    DEMOGRAPHIC_PATTERN = re.compile(r"\b(\d{1,3})[- ]year[- ]old\s+(male|female|man|woman|boy|girl)\b", re.I)
+    
+    # Scope cues: negation and historical cues apply to what follows them in the sentence, a
+    # family-history cue to the whole sentence ("breast cancer in mother")
+    NEGATION_PATTERN = re.compile(r"\b(?:no|denies|denied|without|negative for|rules? out|r/o)\b[^.;]*$", re.I)
+    
+    HISTORICAL_PATTERN = re.compile(
+        r"(?:\b(?:history of|hx of|past (?:medical )?history|previous(?:ly)?|prior|former(?:ly)?|resolved|"
+        r"in the past)|\bh/o)\b[^.;]*$",
+        re.I
+    )
+    
+    FAMILY_HISTORY_PATTERN = re.compile(
+        r"\b(?:family (?:medical )?history|family hx|fhx|mother|father|parents?|sister|brother|siblings?|"
+        r"grandmother|grandfather|grandparents?|aunt|uncle|cousin|son|daughter)\b",
+        re.I
+    )
+    
+    TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:['-][a-z0-9]+)*")
+    
+    def __init__(self,
+                 extra_conditions: Optional[List[str]] = None,
+                 extra_drugs: Optional[List[str]] = None,
+                 extra_treatments: Optional[List[str]] = None):
+        self._trie = {}
+        for category, terms in (
+            ("medical_conditions", self.CONDITION_TERMS + (extra_conditions or [])),
+            ("medications", self.DRUG_TERMS + (extra_drugs or [])),
+            ("treatments", self.TREATMENT_TERMS + (extra_treatments or [])),
+            ("symptoms", self.SYMPTOM_TERMS),
+        ):
+            for term in terms:
+                term, canonical = term if isinstance(term, tuple) else (term, term)
+                self._add_term(term, category, canonical)
+    
+    def _add_term(self, term: str, category: str, canonical: str):
+        node = self._trie
+        for token in self.TOKEN_PATTERN.findall(term.lower()):
+            node = node.setdefault(token, {})
+        node["$"] = (category, canonical)
+    
+    @staticmethod
+    def _sentence_spans(text: str) -> List[Tuple[int, int]]:
+        """Sentence boundaries that don't split decimals like 8.2 or 1.73."""
+        spans = []
+        start = 0
+        for boundary in re.finditer(r"(?<=[.!?])\s+(?=[A-Z(])|\n\s*\n", text):
+            spans.append((start, boundary.start()))
+            start = boundary.end()
+        spans.append((start, len(text)))
+        return [(s, e) for s, e in spans if text[s:e].strip()]
+    
+    def _is_scoped(self, text: str, sentence: Tuple[int, int], match_start: int) -> bool:
+        """Whether a mention is negated, historical or about a family member rather than the patient."""
+        sentence_start, sentence_end = sentence
+        preceding = text[sentence_start:match_start]
+        return bool(
+            self.NEGATION_PATTERN.search(preceding)
+            or self.HISTORICAL_PATTERN.search(preceding)
+            or self.FAMILY_HISTORY_PATTERN.search(text[sentence_start:sentence_end])
+        )
+    
+    def extract(self, text: str) -> Tuple[Dict[str, List[str]], List[str], float]:
+        """Return the six-category entity dict, the sentences nothing was found in (or that contain
+        negated, historical, family-history or symptom mentions), and the fraction of sentences that
+        were fully accounted for."""
+        entities = {
+            "medical_conditions": [],
+            "medications": [],
+            "treatments": [],
+            "lab_tests": [],
+            "vital_signs": [],
+            "patient_demographics": []
+        }
+        seen = set()
+        
+        def add(category: str, value: str):
+            key = (category, value.lower())
+            if key not in seen:
+                seen.add(key)
+                entities[category].append(value)
+        
+        sentences = self._sentence_spans(text)
+        covered = [False] * len(sentences)
+        uncertain = [False] * len(sentences)
+        
+        def sentence_index(position: int) -> int:
+            for i, (start, end) in enumerate(sentences):
+                if start <= position < end:
+                    return i
+            return len(sentences) - 1
+        
+        # Character spans claimed by pattern matches, so e.g. "vitamin D level" isn't also a drug
+        claimed = []
+        
+        def record(category: str, value: str, position: int, end: Optional[int] = None):
+            if end is not None:
+                claimed.append((position, end))
+            index = sentence_index(position)
+            if category == "symptoms" or self._is_scoped(text, sentences[index], position):
+                uncertain[index] = True
+                return
+            covered[index] = True
+            add(category, value)
+        
+        # Pattern-based categories
+        for pattern, formatter in self.VITAL_PATTERNS:
+            for m in pattern.finditer(text):
+                record("vital_signs", formatter(m), m.start(), m.end())
+        
+        for m in self.LAB_PATTERN.finditer(text):
+            unit = m.group("unit") or ""
+            value = f"{m.group('value')}{unit}" if unit.startswith("%") else f"{m.group('value')} {unit}".strip()
+            record("lab_tests", f"{m.group('name')} {value}", m.start(), m.end())
+        
+        for m in self.DEMOGRAPHIC_PATTERN.finditer(text):
+            record("patient_demographics", f"{m.group(1)}-year-old {m.group(2).lower()}", m.start(), m.end())
+        
+        # Dictionary terms: longest match over the token trie
+        tokens = [(m.group(0), m.start(), m.end()) for m in self.TOKEN_PATTERN.finditer(text.lower())]
+        i = 0
+        while i < len(tokens):
+            node = self._trie
+            match = None
+            j = i
+            while j < len(tokens) and tokens[j][0] in node:
+                node = node[tokens[j][0]]
+                j += 1
+                if "$" in node:
+                    match = (j, node["$"])
+            
+            if match is None:
+                i += 1
+                continue
+            
+            end_index, (category, canonical) = match
+            start, end = tokens[i][1], tokens[end_index - 1][2]
+            i = end_index
+            if any(claimed_start <= start < claimed_end for claimed_start, claimed_end in claimed):
+                continue
+            
+            if category == "medications":
+                # Keep the dose and frequency with the drug, e.g. "Metformin 1000mg BID", and skip
+                # over a parenthesised brand name between the drug and its dose
+                dose = self.DOSE_PATTERN.match(text, end)
+                if dose:
+                    value = f"{text[start:end]} {dose.group(1)}"
+                    while i < len(tokens) and tokens[i][1] < dose.end():
+                        i += 1
+                else:
+                    value = text[start:end]
+            else:
+                value = canonical
+            record(category, value, start)
+        
+        uncovered = [
+            text[start:end].strip()
+            for (start, end), is_covered, is_uncertain in zip(sentences, covered, uncertain)
+            if not is_covered or is_uncertain
+        ]
+        coverage = 1 - len(uncovered) / len(sentences) if sentences else 0.0
+        return entities, uncovered, coverage
+
+
+class MedicalEntities(BaseModel):
+    """Schema for structured entity extraction output."""
+    
+    medical_conditions: List[str] = Field(default_factory=list, description="Medical conditions/diseases")
+    medications: List[str] = Field(default_factory=list, description="Medications/drugs, with dose and frequency")
+    treatments: List[str] = Field(default_factory=list, description="Treatments/procedures")
+    lab_tests: List[str] = Field(default_factory=list, description="Lab tests/results")
+    vital_signs: List[str] = Field(default_factory=list, description="Vital signs")
+    patient_demographics: List[str] = Field(default_factory=list, description="Patient demographics")
+
+
+class MedicalEntityExtractor:
+    """Extract medical entities from text, using a fast local tier first and the LLM for the rest."""
+    
+    def __init__(self,
+                 use_local_tier: bool = True,
+                 local_confidence_threshold: float = 0.8,
+                 structured_output: bool = True):
+        # Rule-based tier; the LLM is skipped when it finds conditions and accounts for enough of the note
+        self.local_extractor = LocalEntityExtractor() if use_local_tier else None
+        self.local_confidence_threshold = local_confidence_threshold
+        
+        self.prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(
+                """You are a medical entity extraction system. Extract the following entities from the input text:
+                1. Medical conditions/diseases
+                2. Medications/drugs
+                3. Treatments/procedures
+                4. Lab tests/results
+                5. Vital signs
+                6. Patient demographics
+                
+                Format your response as a JSON object with these categories as keys and arrays of extracted entities as values.
+                If a category has no entities, use an empty array.
+                
                 Example format:
                 {{
                 "medical_conditions": ["type 2 diabetes", "hypertension"],
@@ -363,73 +2103,878 @@ class MedicalEntityExtractor:
             HumanMessagePromptTemplate.from_template("{text}")
         ])
         
-    def extract_entities(self, text: str) -> Dict[str, List[str]]:
-        try:
-            chain = self.prompt | self.llm | StrOutputParser()
-            result = chain.invoke({"text": text})
+        self.structured_output = structured_output
+        self._chain = None
+    
+    @property
+    def llm(self) -> "ChatMistralAI":
+        return get_chat_model(temperature=0)
+    
+    @property
+    def chain(self):
+        """The LLM extraction chain, built on first use."""
+        if self._chain is None:
+            # Schema-constrained extraction via tool calling; include_raw keeps the raw message so a
+            # response that fails validation can still be salvaged without a second LLM call
+            if self.structured_output:
+                self._chain = self.prompt | self.llm.with_structured_output(MedicalEntities, include_raw=True)
+            else:
+                self._chain = self.prompt | self.llm | StrOutputParser()
+        return self._chain
+    
+    @staticmethod
+    def _empty_entities() -> Dict[str, List[str]]:
+        return {
+            "medical_conditions": [],
+            "medications": [],
+            "treatments": [],
+            "lab_tests": [],
+            "vital_signs": [],
+            "patient_demographics": []
+        }
+    
+    def _normalize_entities(self, data: Any) -> Dict[str, List[str]]:
+        """Coerce parsed output onto the six-category schema, dropping anything malformed."""
+        entities = self._empty_entities()
+        if not isinstance(data, dict):
+            return entities
+        
+        for key in entities:
+            value = data.get(key, [])
+            if isinstance(value, str):
+                value = [value]
+            if isinstance(value, list):
+                entities[key] = [str(item).strip() for item in value if item is not None and str(item).strip()]
+        return entities
+    
+    def _parse_entities(self, result: str) -> Dict[str, List[str]]:
+        """Tolerantly parse free-text JSON output, including fenced, prefixed or truncated responses."""
+        # Log the raw response for debugging
+        logger.debug(f"Raw API response: {result}")
+        
+        # Skip any prose or code fence before the JSON object
+        start = result.find("{")
+        if start == -1:
+            logger.error(f"No JSON object in entity extraction response: {result}")
+            return self._empty_entities()
+        candidate = result[start:]
+        
+        try:
+            # raw_decode ignores trailing text such as a closing code fence
+            data, _ = json.JSONDecoder().raw_decode(candidate)
+        except json.JSONDecodeError as json_err:
+            logger.warning(f"JSON parsing error: {json_err}; attempting tolerant parse")
+            try:
+                # Closes unterminated strings, arrays and objects left by a truncated response
+                data = parse_partial_json(candidate)
+            except json.JSONDecodeError:
+                data = None
+            
+            if data is None:
+                # Attempt to fix common JSON formatting issues
+                repaired = re.sub(r"'", '"', candidate)  # Replace single quotes with double quotes
+                repaired = re.sub(r"(?<![\"\w])(\w+):", r'"\1":', repaired)  # Ensure keys are quoted
+                try:
+                    data = parse_partial_json(repaired)
+                except json.JSONDecodeError:
+                    data = None
+        
+        if data is None:
+            logger.error(f"Failed to parse JSON even after attempted fixes")
+            return self._empty_entities()
+        
+        entities = self._normalize_entities(data)
+        logger.debug(f"Extracted entities from text: {entities}")
+        return entities
+    
+    def _run_chain(self, text: str) -> Any:
+        """Invoke the extraction chain; free-text output is streamed so an interrupted response is still parsed."""
+        if self.structured_output:
+            return self.chain.invoke({"text": text})
+        
+        chunks = []
+        try:
+            for chunk in self.chain.stream({"text": text}):
+                chunks.append(chunk)
+        except Exception as e:
+            if not chunks:
+                raise
+            logger.warning(f"Entity extraction stream interrupted ({e}); parsing partial output")
+        return "".join(chunks)
+    
+    async def _arun_chain(self, text: str) -> Any:
+        """Async variant of _run_chain."""
+        if self.structured_output:
+            return await self.chain.ainvoke({"text": text})
+        
+        chunks = []
+        try:
+            async for chunk in self.chain.astream({"text": text}):
+                chunks.append(chunk)
+        except Exception as e:
+            if not chunks:
+                raise
+            logger.warning(f"Entity extraction stream interrupted ({e}); parsing partial output")
+        return "".join(chunks)
+    
+    def _entities_from_output(self, output: Any) -> Dict[str, List[str]]:
+        """Turn chain output (structured result or free text) into an entity dict."""
+        if isinstance(output, str):
+            return self._parse_entities(output)
+        
+        if output.get("parsed") is not None:
+            return self._normalize_entities(output["parsed"].model_dump())
+        
+        # Validation failed: salvage the raw tool call arguments or message text
+        logger.warning(f"Structured entity output failed validation: {output.get('parsing_error')}")
+        raw = output.get("raw")
+        tool_calls = getattr(raw, "tool_calls", None)
+        if tool_calls:
+            return self._normalize_entities(tool_calls[0].get("args"))
+        
+        # Truncated or malformed tool arguments are left unparsed on invalid_tool_calls
+        for invalid_call in getattr(raw, "invalid_tool_calls", None) or []:
+            args = invalid_call.get("args")
+            if isinstance(args, str) and "{" in args:
+                entities = self._parse_entities(args)
+                if any(entities.values()):
+                    return entities
+        content = getattr(raw, "content", "")
+        return self._parse_entities(content if isinstance(content, str) else json.dumps(content))
+    
+    def _local_pass(self, text: str) -> Tuple[Dict[str, List[str]], Optional[str]]:
+        """Run the local tier; returns its entities and the text that still needs the LLM (None if nothing)."""
+        if self.local_extractor is None:
+            return self._empty_entities(), text
+        
+        start = time.perf_counter()
+        entities, uncovered, coverage = self.local_extractor.extract(text)
+        logger.info(f"Local entity extraction covered {coverage:.0%} of sentences in {(time.perf_counter() - start) * 1000:.1f}ms")
+        
+        if entities["medical_conditions"] and coverage >= self.local_confidence_threshold:
+            return entities, None
+        
+        # Without any local conditions the whole note goes to the LLM, otherwise only what's left
+        if entities["medical_conditions"] and uncovered:
+            return entities, "\n".join(uncovered)
+        return entities, text
+    
+    def extract_entities(self, text: str) -> Dict[str, List[str]]:
+        local_entities, remaining_text = self._local_pass(text)
+        if remaining_text is None:
+            return local_entities
+        
+        try:
+            output = self._run_chain(remaining_text)
+            return merge_entities(local_entities, self._entities_from_output(output))
+        except Exception as e:
+            logger.error(f"Error extracting entities: {e}")
+            return local_entities
+    
+    async def aextract_entities(self, text: str) -> Dict[str, List[str]]:
+        """Async variant of extract_entities."""
+        local_entities, remaining_text = self._local_pass(text)
+        if remaining_text is None:
+            return local_entities
+        
+        try:
+            output = await self._arun_chain(remaining_text)
+            return merge_entities(local_entities, self._entities_from_output(output))
+        except Exception as e:
+            logger.error(f"Error extracting entities: {e}")
+            return local_entities
+
+class EntityCache:
+    """Persistent cache of entity extraction results keyed by EHR hash.
+    
+    Each result also records the hashes of the EHR's sections (blank-line separated blocks), so
+    an EHR that extends a cached one only needs its new sections extracted.
+    """
+    
+    def __init__(self, cache_dir: str = DEFAULT_PERSIST_DIRECTORY):
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "entity_cache.sqlite3"), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entity_results (ehr_hash TEXT PRIMARY KEY, entities TEXT, section_count INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ehr_sections (ehr_hash TEXT, section_hash TEXT, PRIMARY KEY (ehr_hash, section_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ehr_sections_section ON ehr_sections (section_hash)")
+        self._conn.commit()
+        
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def split_sections(ehr_text: str) -> List[str]:
+        return [section.strip() for section in re.split(r"\n\s*\n", ehr_text) if section.strip()]
+    
+    @staticmethod
+    def section_hash(section: str) -> str:
+        return hashlib.sha256(" ".join(section.split()).encode()).hexdigest()
+    
+    def get(self, ehr_hash: str) -> Optional[Dict[str, List[str]]]:
+        """Return the cached entities for an exact EHR, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT entities FROM entity_results WHERE ehr_hash = ?", (ehr_hash,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def find_base(self, section_hashes: List[str]) -> Optional[Tuple[Dict[str, List[str]], set]]:
+        """Find the cached EHR covering the most of these sections without containing any others.
+        
+        Returns its entities and the set of section hashes it covers, or None.
+        """
+        if not section_hashes:
+            return None
+        
+        section_hashes = list(dict.fromkeys(section_hashes))
+        with self._lock:
+            # Count matching sections per cached EHR, in chunks that stay under SQLite's variable limit
+            matched = Counter()
+            for i in range(0, len(section_hashes), SQLITE_MAX_VARIABLES):
+                chunk = section_hashes[i:i + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" for _ in chunk)
+                matched.update(dict(self._conn.execute(
+                    f"SELECT ehr_hash, COUNT(*) FROM ehr_sections WHERE section_hash IN ({placeholders}) GROUP BY ehr_hash",
+                    chunk
+                ).fetchall()))
             
-            # Log the raw response for debugging
-            logger.debug(f"Raw API response: {result}")
+            # Keep only EHRs whose sections are all present, preferring the one covering the most
+            candidates = list(matched)
+            best = None
+            for i in range(0, len(candidates), SQLITE_MAX_VARIABLES):
+                chunk = candidates[i:i + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" for _ in chunk)
+                for ehr_hash, section_count in self._conn.execute(
+                    f"SELECT ehr_hash, section_count FROM entity_results WHERE ehr_hash IN ({placeholders})", chunk
+                ):
+                    if matched[ehr_hash] == section_count and (best is None or section_count > matched[best]):
+                        best = ehr_hash
+            if best is None:
+                return None
             
-            # Attempt to parse the JSON response
-            try:
-                entities = json.loads(result)
-                logger.info(f"Extracted entities from text: {entities}")
-                return entities
-            except json.JSONDecodeError as json_err:
-                logger.error(f"JSON parsing error: {json_err}. Raw response: {result}")
-                # Attempt to fix common JSON formatting issues
-                result = re.sub(r"'", '"', result)  # Replace single quotes with double quotes
-                result = re.sub(r"(\w+):", r'"\1":', result)  # Ensure keys are quoted
-                
-                try:
-                    entities = json.loads(result)
-                    logger.info(f"Successfully parsed JSON after fixing format issues")
-                    return entities
-                except json.JSONDecodeError:
-                    logger.error(f"Failed to parse JSON even after attempted fixes")
-                    # Return default structure
-                    return {
-                        "medical_conditions": [],
-                        "medications": [],
-                        "treatments": [],
-                        "lab_tests": [],
-                        "vital_signs": [],
-                        "patient_demographics": []
-                    }
-        except Exception as e:
-            logger.error(f"Error extracting entities: {e}")
+            entities = self._conn.execute("SELECT entities FROM entity_results WHERE ehr_hash = ?", (best,)).fetchone()[0]
+            covered = {
+                section_row[0] for section_row in
+                self._conn.execute("SELECT section_hash FROM ehr_sections WHERE ehr_hash = ?", (best,))
+            }
+        return json.loads(entities), covered
+    
+    def put(self, ehr_hash: str, section_hashes: List[str], entities: Dict[str, List[str]]):
+        """Store the entities extracted for an EHR."""
+        unique_sections = set(section_hashes)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entity_results (ehr_hash, entities, section_count) VALUES (?, ?, ?)",
+                (ehr_hash, json.dumps(entities), len(unique_sections))
+            )
+            self._conn.execute("DELETE FROM ehr_sections WHERE ehr_hash = ?", (ehr_hash,))
+            self._conn.executemany(
+                "INSERT INTO ehr_sections (ehr_hash, section_hash) VALUES (?, ?)",
+                [(ehr_hash, section_hash) for section_hash in unique_sections]
+            )
+            self._conn.commit()
+    
+    def record(self, hits: int = 0, partial_hits: int = 0, misses: int = 0):
+        """Add to the hit/partial-hit/miss counters; safe to call from concurrent requests."""
+        with self._lock:
+            self.hits += hits
+            self.partial_hits += partial_hits
+            self.misses += misses
+    
+    def stats(self) -> Dict[str, int]:
+        """Return hit/partial-hit/miss counters."""
+        with self._lock:
+            return {"hits": self.hits, "partial_hits": self.partial_hits, "misses": self.misses}
+
+
+def merge_entities(base: Dict[str, List[str]], new: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Union two entity dicts category by category, keeping order and dropping case-insensitive duplicates."""
+    merged = {}
+    for key in list(base) + [key for key in new if key not in base]:
+        values = list(base.get(key, []))
+        seen = {str(value).lower() for value in values}
+        for value in new.get(key, []):
+            if str(value).lower() not in seen:
+                seen.add(str(value).lower())
+                values.append(value)
+        merged[key] = values
+    return merged
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (about four characters per token for English text)."""
+    return max(1, len(text) // 4)
+
+
+def content_digest(text: str) -> str:
+    """Stable digest of normalized text, so chunks differing only in case or whitespace collapse together."""
+    normalized = " ".join(text.lower().split())
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+
+class HybridRanker:
+    """Fuse ranked result lists with weighted reciprocal rank fusion and select the top-k.
+    
+    token_budget optionally caps the selection's size as well. It is off by default, since the
+    ContextPacker budgets the whole prompt and trims long chunks instead of dropping them.
+    """
+    
+    def __init__(self,
+                 weights: Optional[Dict[str, float]] = None,
+                 rrf_k: int = 60,
+                 top_k: int = 8,
+                 token_budget: Optional[int] = None):
+        # Weights are keyed by retrieval method ("vector", "bm25")
+        self.weights = weights or {"vector": 1.0, "bm25": 1.0}
+        self.rrf_k = rrf_k
+        self.top_k = top_k
+        self.token_budget = token_budget
+    
+    def fuse(self, ranked_lists: List[Tuple[str, List[Document]]]) -> List[Document]:
+        """Fuse (method, documents) result lists into one ranked, deduplicated, budgeted list."""
+        scores = {}
+        documents = {}
+        
+        for method, docs in ranked_lists:
+            weight = self.weights.get(method, 1.0)
+            for rank, doc in enumerate(docs, 1):
+                digest = content_digest(doc.page_content)
+                scores[digest] = scores.get(digest, 0.0) + weight / (self.rrf_k + rank)
+                documents.setdefault(digest, doc)
+        
+        # Sort by fused score, breaking ties by digest so the order is deterministic
+        ranked = sorted(scores, key=lambda digest: (-scores[digest], digest))
+        
+        selected = []
+        tokens_used = 0
+        for digest in ranked:
+            if len(selected) >= self.top_k:
+                break
+            doc_tokens = estimate_tokens(documents[digest].page_content)
+            if self.token_budget is not None and tokens_used + doc_tokens > self.token_budget:
+                continue
+            documents[digest].metadata["fusion_score"] = scores[digest]
+            selected.append(documents[digest])
+            tokens_used += doc_tokens
+        
+        logger.info(f"Fused {len(ranked)} unique documents into {len(selected)} (~{tokens_used} tokens)")
+        return selected
+
+
+class ContextPacker:
+    """Fit the RAG prompt into a token budget, trimming long chunks down to their most relevant sentences."""
+    
+    def __init__(self,
+                 token_budget: int = 4000,
+                 patient_info_budget: int = 800,
+                 min_chunk_tokens: int = 50,
+                 token_counter=estimate_tokens):
+        self.token_budget = token_budget
+        self.patient_info_budget = patient_info_budget
+        self.min_chunk_tokens = min_chunk_tokens
+        self.count_tokens = token_counter
+    
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        """Cut text down to roughly max_tokens, keeping whole lines where possible.
+        
+        When the lines don't all fit, only the longest ones are cut, each to an equal share of what
+        the shorter lines leave, so no line (e.g. a patient info section) is dropped entirely.
+        """
+        if self.count_tokens(text) <= max_tokens:
+            return text
+        
+        lines = text.split("\n")
+        sizes = [self.count_tokens(line) for line in lines]
+        
+        # Per-line counts don't add up exactly to the joined text's (separators, rounding), so shrink
+        # the lines' budget by any overshoot until the result fits
+        lines_budget = max_tokens
+        while True:
+            # Largest per-line cap whose total fits the budget
+            cap = lines_budget
+            budget = lines_budget
+            for position, size in enumerate(sorted(sizes)):
+                share = budget // (len(sizes) - position)
+                if size > share:
+                    cap = share
+                    break
+                budget -= size
+            
+            truncated = "\n".join(line if size <= cap else self._cut(line, cap) for line, size in zip(lines, sizes))
+            overshoot = self.count_tokens(truncated) - max_tokens
+            if overshoot <= 0 or lines_budget <= 0:
+                return truncated
+            lines_budget = max(0, lines_budget - overshoot)
+    
+    def _cut(self, text: str, max_tokens: int) -> str:
+        """Longest prefix of text within max_tokens, cut at a word boundary unless a single word is too long."""
+        if max_tokens <= 0:
+            return ""
+        
+        def longest_prefix(parts: List[str], separator: str) -> int:
+            low, high = 0, len(parts)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if self.count_tokens(separator.join(parts[:middle])) <= max_tokens:
+                    low = middle
+                else:
+                    high = middle - 1
+            return low
+        
+        words = text.split(" ")
+        kept = longest_prefix(words, " ")
+        if kept:
+            return " ".join(words[:kept])
+        return text[:longest_prefix(list(text), "")]
+    
+    def _extract_relevant(self, text: str, question: str, max_tokens: int) -> str:
+        """Keep the sentences that best overlap the question, in their original order, within max_tokens."""
+        sentences = [sentence for sentence in re.split(r"(?<=[.!?])\s+", text.strip()) if sentence]
+        question_terms = set(re.findall(r"\w+", question.lower()))
+        
+        ranked = sorted(
+            range(len(sentences)),
+            key=lambda i: -len(question_terms & set(re.findall(r"\w+", sentences[i].lower())))
+        )
+        
+        chosen = []
+        for i in ranked:
+            candidate = sorted(chosen + [i])
+            if self.count_tokens(" ".join(sentences[j] for j in candidate)) <= max_tokens:
+                chosen = candidate
+        
+        return " ".join(sentences[i] for i in chosen)
+    
+    def pack(self,
+             question: str,
+             patient_info: str,
+             documents: List[Document],
+             system_prompt: str = "") -> Tuple[str, List[Document], Dict[str, int]]:
+        """Return the (possibly truncated) patient info, the packed documents and a per-section token report."""
+        patient_info = self._truncate(patient_info, self.patient_info_budget)
+        
+        report = {
+            "system_prompt": self.count_tokens(system_prompt) if system_prompt else 0,
+            "question": self.count_tokens(question),
+            "patient_info": self.count_tokens(patient_info),
+            "context": 0,
+            "documents": 0,
+            "trimmed_documents": 0
+        }
+        remaining = self.token_budget - report["system_prompt"] - report["question"] - report["patient_info"]
+        
+        # Documents arrive ranked, so fill the budget from the top
+        packed = []
+        for doc in documents:
+            doc_tokens = self.count_tokens(doc.page_content)
+            if doc_tokens <= remaining:
+                packed.append(doc)
+            elif remaining >= self.min_chunk_tokens:
+                # A chunk that is one long sentence has no excerpt that fits, so cut it instead
+                excerpt = (
+                    self._extract_relevant(doc.page_content, question, remaining)
+                    or self._truncate(doc.page_content, remaining)
+                )
+                if not excerpt:
+                    continue
+                doc = Document(page_content=excerpt, metadata={**doc.metadata, "trimmed": True})
+                doc_tokens = self.count_tokens(excerpt)
+                packed.append(doc)
+                report["trimmed_documents"] += 1
+            else:
+                break
+            remaining -= doc_tokens
+            report["context"] += doc_tokens
+        
+        report["documents"] = len(packed)
+        report["total"] = report["system_prompt"] + report["question"] + report["patient_info"] + report["context"]
+        report["budget"] = self.token_budget
+        return patient_info, packed, report
+
+
+# Rough per-session memory overhead (Chroma client handles, retriever objects) used for the registry's memory cap
+PATIENT_CONTEXT_OVERHEAD_BYTES = 512 * 1024
+
+
+class PatientContext:
+    """Initialized retrieval state for one patient EHR."""
+    
+    def __init__(self, ehr_hash: str, patient_data: Dict[str, Any], ehr_length: int = 0):
+        self.ehr_hash = ehr_hash
+        self.patient_data = patient_data
+        
+        # vector_retriever and bm25_retriever cover the patient's EHR collection, the
+        # literature_* retrievers the patient's slice of the shared literature collection
+        self.vector_retriever = None
+        self.literature_retriever = None
+        self.bm25_retriever = None
+        self.literature_bm25_retriever = None
+        
+        self.estimated_bytes = ehr_length + len(json.dumps(patient_data)) + PATIENT_CONTEXT_OVERHEAD_BYTES
+        self.last_access = time.monotonic()
+
+
+class SessionRegistry:
+    """Thread-safe LRU registry of initialized patient contexts with idle TTL and a memory cap."""
+    
+    def __init__(self, max_sessions: int = 64, ttl_seconds: float = 3600, max_memory_mb: float = 256):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = int(max_memory_mb * 1024 * 1024)
+        
+        self._sessions = OrderedDict()
+        self._lock = threading.RLock()
+        self._build_locks = {}
+        self.total_bytes = 0
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _remove(self, ehr_hash: str):
+        context = self._sessions.pop(ehr_hash)
+        self.total_bytes -= context.estimated_bytes
+    
+    def _expire(self):
+        now = time.monotonic()
+        expired = [key for key, context in self._sessions.items() if now - context.last_access > self.ttl_seconds]
+        for key in expired:
+            self._remove(key)
+            self.evictions += 1
+    
+    def get(self, ehr_hash: str) -> Optional[PatientContext]:
+        """Return the context for an EHR hash, refreshing its LRU position, or None."""
+        with self._lock:
+            self._expire()
+            context = self._sessions.get(ehr_hash)
+            if context is None:
+                self.misses += 1
+                return None
+            
+            context.last_access = time.monotonic()
+            self._sessions.move_to_end(ehr_hash)
+            self.hits += 1
+            return context
+    
+    def put(self, context: PatientContext):
+        """Register a context, evicting the least recently used ones to respect the size and memory caps."""
+        with self._lock:
+            if context.ehr_hash in self._sessions:
+                self._remove(context.ehr_hash)
+            
+            self._sessions[context.ehr_hash] = context
+            self.total_bytes += context.estimated_bytes
+            
+            self._expire()
+            while len(self._sessions) > 1 and (
+                len(self._sessions) > self.max_sessions or self.total_bytes > self.max_bytes
+            ):
+                oldest = next(iter(self._sessions))
+                self._remove(oldest)
+                self.evictions += 1
+                logger.info(f"Evicted patient session {oldest[:8]} from registry")
+    
+    def get_or_create(self, ehr_hash: str, factory) -> Optional[PatientContext]:
+        """Return a registered context or build it once, even if several threads ask at the same time."""
+        context = self.get(ehr_hash)
+        if context is not None:
+            return context
+        
+        with self._lock:
+            build_lock = self._build_locks.setdefault(ehr_hash, threading.Lock())
+        
+        with build_lock:
+            with self._lock:
+                context = self._sessions.get(ehr_hash)
+            if context is None:
+                context = factory()
+                if context is not None:
+                    self.put(context)
+        
+        with self._lock:
+            self._build_locks.pop(ehr_hash, None)
+        return context
+    
+    def invalidate(self, ehr_hash: str):
+        """Drop a context from the registry."""
+        with self._lock:
+            if ehr_hash in self._sessions:
+                self._remove(ehr_hash)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return registry size and hit/miss/eviction counters."""
+        with self._lock:
             return {
-                "medical_conditions": [],
-                "medications": [],
-                "treatments": [],
-                "lab_tests": [],
-                "vital_signs": [],
-                "patient_demographics": []
+                "sessions": len(self._sessions),
+                "estimated_bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
             }
 
-class ClinicalDecisionSupportSystem:
-    """RAG-based Clinical Decision Support System."""
+
+class SemanticAnswerCache:
+    """Cache of generated recommendations per patient, matched by cosine similarity of question embeddings.
+    
+    Embeddings barely separate questions that differ in direction or negation ("increase" vs
+    "decrease the dose"), so a similar question only counts as a hit if it also has the same
+    direction/negation words and numbers.
+    """
     
-    def __init__(self):
-        self.llm = ChatMistralAI(
-            temperature=0.2, 
-            model="mistral-large-latest", 
-            mistral_api_key=MISTRAL_API_KEY
+    # Words that flip a clinical question's meaning while barely moving its embedding
+    DIRECTION_TERMS = frozenset({
+        "increase", "increasing", "decrease", "decreasing", "raise", "lower", "higher", "reduce", "reducing",
+        "more", "less", "up", "down", "above", "below", "over", "under", "maximum", "minimum", "max", "min",
+        "start", "starting", "initiate", "begin", "stop", "stopping", "discontinue", "continue", "hold",
+        "add", "adding", "remove", "switch", "taper", "titrate", "before", "after",
+        "not", "no", "never", "without", "avoid", "contraindicated", "safe", "unsafe",
+    })
+    
+    def __init__(self,
+                 embeddings: Embeddings,
+                 similarity_threshold: float = 0.95,
+                 ttl_seconds: float = 3600,
+                 max_entries_per_patient: int = 100):
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries_per_patient = max_entries_per_patient
+        
+        # ehr_hash -> list of (normalized question vector, question, answer, created_at)
+        self._entries = {}
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+    
+    @classmethod
+    def _signature(cls, question: str) -> frozenset:
+        """The question's direction/negation words and numbers, which must match for a cache hit."""
+        tokens = re.findall(r"[a-z]+n't|[a-z]+|\d+(?:\.\d+)?", question.lower())
+        return frozenset(
+            "not" if token.endswith("n't") else token
+            for token in tokens
+            if token in cls.DIRECTION_TERMS or token.endswith("n't") or token[0].isdigit()
         )
+    
+    def embed(self, question: str) -> np.ndarray:
+        """Embed and L2-normalize a question so a dot product gives cosine similarity."""
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+    
+    def embed_many(self, questions: List[str]) -> List[np.ndarray]:
+        """Embed and normalize several questions in one model call."""
+        # Questions are patient data; embeddings with an on-disk cache embed them uncached
+        embed = getattr(self.embeddings, "embed_queries", self.embeddings.embed_documents)
+        vectors = np.asarray(embed(questions), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return list(vectors / np.where(norms > 0, norms, 1.0))
+    
+    def lookup(self, ehr_hash: str, question: str, question_vector: np.ndarray) -> Optional[str]:
+        """Return the stored answer for the most similar question above the threshold, or None."""
+        now = time.time()
+        signature = self._signature(question)
+        
+        with self._lock:
+            entries = [entry for entry in self._entries.get(ehr_hash, []) if now - entry[3] <= self.ttl_seconds]
+            self._entries[ehr_hash] = entries
+            
+            best_answer = None
+            best_similarity = self.similarity_threshold
+            for vector, stored_question, answer, _ in entries:
+                similarity = float(np.dot(vector, question_vector))
+                if similarity >= best_similarity and self._signature(stored_question) == signature:
+                    best_answer, best_similarity = answer, similarity
+            
+            if best_answer is None:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+        
+        logger.info(f"Answer cache hit (similarity {best_similarity:.3f})")
+        return best_answer
+    
+    def store(self, ehr_hash: str, question: str, question_vector: np.ndarray, answer: str):
+        """Remember an answer for a patient's question."""
+        with self._lock:
+            entries = self._entries.setdefault(ehr_hash, [])
+            entries.append((question_vector, question, answer, time.time()))
+            if len(entries) > self.max_entries_per_patient:
+                del entries[0]
+    
+    def invalidate(self, ehr_hash: str):
+        """Forget all answers for a patient, e.g. after its EHR was reprocessed."""
+        with self._lock:
+            self._entries.pop(ehr_hash, None)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and the hit rate."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": sum(len(entries) for entries in self._entries.values())
+            }
+
+
+class StageMetrics:
+    """Per-stage latency histograms, counters and optional per-request timing traces.
+    
+    Stages are timed with span(); durations feed a Prometheus-style histogram and, while a
+    trace() is active for the current request, are also summed into that request's breakdown.
+    """
+    
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._trace = contextvars.ContextVar(f"cdss_trace_{id(self)}", default=None)
+    
+    def observe(self, stage: str, seconds: float):
+        """Record one stage duration."""
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["counts"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+        
+        trace = self._trace.get()
+        if trace is not None:
+            trace[stage] = round(trace.get(stage, 0.0) + seconds, 4)
+    
+    @contextmanager
+    def span(self, stage: str):
+        """Time the enclosed block as one occurrence of a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+    
+    def increment(self, name: str, value: float = 1, **labels):
+        """Add to a counter, e.g. increment("tokens", 120, kind="prompt")."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    @contextmanager
+    def trace(self):
+        """Collect the stage timings of the enclosed request into the yielded dict."""
+        timings = {}
+        token = self._trace.set(timings)
+        start = time.perf_counter()
+        try:
+            yield timings
+        finally:
+            timings["total"] = round(time.perf_counter() - start, 4)
+            self._trace.reset(token)
+    
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Count, mean and total seconds per stage."""
+        with self._lock:
+            return {
+                stage: {
+                    "count": histogram["count"],
+                    "mean_s": histogram["sum"] / histogram["count"] if histogram["count"] else 0.0,
+                    "total_s": histogram["sum"]
+                }
+                for stage, histogram in self._histograms.items()
+            }
+    
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+    
+    def render(self, gauges: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
+        """Prometheus text exposition of the histograms, counters and the given gauge groups."""
+        lines = ["# TYPE cdss_stage_seconds histogram"]
+        with self._lock:
+            for stage, histogram in sorted(self._histograms.items()):
+                for bound, count in zip(self.buckets, histogram["counts"]):
+                    lines.append(f'cdss_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'cdss_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'cdss_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+                lines.append(f'cdss_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+            
+            names = sorted({name for name, _ in self._counters})
+            for name in names:
+                lines.append(f"# TYPE cdss_{name}_total counter")
+                for (counter_name, labels), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append(f"cdss_{name}_total{self._labels(labels)} {value}")
         
+        for group, values in sorted((gauges or {}).items()):
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE cdss_{group}_{key} gauge")
+                    lines.append(f"cdss_{group}_{key} {value}")
+        
+        return "\n".join(lines) + "\n"
+
+
+class ClinicalDecisionSupportSystem:
+    """RAG-based Clinical Decision Support System."""
+    
+    def __init__(self,
+                 literature_concurrency: int = 4,
+                 hybrid_ranker: Optional[HybridRanker] = None,
+                 context_packer: Optional[ContextPacker] = None,
+                 session_registry: Optional[SessionRegistry] = None,
+                 answer_cache: Optional[SemanticAnswerCache] = None,
+                 incremental_extraction: bool = True,
+                 metrics: Optional[StageMetrics] = None):
+        # Models, clients and chains are created on first use (or by warm_up), so construction is cheap
         self.data_processor = MedicalDataProcessor()
         self.vector_store = MedicalVectorStore()
         self.entity_extractor = MedicalEntityExtractor()
         
-        # Hybrid retriever components
-        self.bm25_retriever = None
-        self.vector_retriever = None
+        # Persisted extraction results so known EHRs skip the LLM; with incremental extraction an
+        # EHR that extends a known one only has its new sections sent to the model
+        self.entity_cache = EntityCache(self.vector_store.persist_directory)
+        self.incremental_extraction = incremental_extraction
+        
+        # Maximum number of PubMed condition queries run in parallel
+        self.literature_concurrency = literature_concurrency
+        
+        # Fuses vector and BM25 results into the final context
+        self.hybrid_ranker = hybrid_ranker or HybridRanker()
         
-        # Keep track of patient data
-        self.patient_data = None
-        self.patient_ehr_hash = None
-        self.is_initialized = False
+        # Keeps the RAG prompt within a token budget
+        self.context_packer = context_packer or ContextPacker()
+        
+        # Initialized patient contexts, shared across requests; the patient a request works on is
+        # tracked per thread/task so concurrent requests never see each other's patient
+        self.sessions = session_registry or SessionRegistry()
+        self._current_context = contextvars.ContextVar(f"cdss_patient_{id(self)}", default=None)
+        self._inflight_builds = {}
+        
+        # Reuses the vector store's embedding model to match repeated questions per patient
+        self.answer_cache = answer_cache or SemanticAnswerCache(self.vector_store.embeddings)
+        
+        # Stage latency histograms, counters and opt-in per-request timing breakdowns
+        self.metrics = metrics or StageMetrics()
+        
+        # Batch recommendations in progress, keyed by (ehr_hash, normalized question), so
+        # identical requests from concurrent batches share one computation
+        self._inflight_recommendations = {}
+        self._inflight_lock = threading.Lock()
         
         # System prompt for the RAG chain
         self.system_prompt = """You are an advanced Clinical Decision Support System designed to assist healthcare professionals.
@@ -446,100 +2991,430 @@ class ClinicalDecisionSupportSystem:
         Your response should be comprehensive yet concise, organized into clear sections, and follow evidence-based medicine principles. 
         Always emphasize that the final decision rests with the healthcare provider and that your suggestions are meant to support, not replace, clinical judgment.
         
-        IMPORTANT: If you are unsure or the information is insufficient, clearly state the limitations and recommend consulting additional resources or specialists.
-        """
-    
-    def _generate_unique_id(self, text: str) -> str:
-        """Generate a unique ID for the EHR text to track changes."""
-        return hashlib.md5(text.encode()).hexdigest()
+        IMPORTANT: If you are unsure or the information is insufficient, clearly state the limitations and recommend consulting additional resources or specialists.
+        """
+        
+        # Prompts for the generation chains; retrieval happens separately in _hybrid_retrieval
+        self.rag_prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(self.system_prompt),
+            HumanMessagePromptTemplate.from_template(
+                """Clinical Question: {question}
+                
+                {patient_info}
+                
+                Context: {context}
+                
+                Please provide evidence-based recommendations based on the retrieved medical literature."""
+            )
+        ])
+        
+        self.direct_prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(self.system_prompt),
+            HumanMessagePromptTemplate.from_template(
+                """Clinical Question: {question}
+                
+                {patient_info}
+                
+                Please provide evidence-based recommendations based on your medical knowledge."""
+            )
+        ])
+        self._document_chain = None
+        self._direct_chain = None
+    
+    @property
+    def llm(self) -> "ChatMistralAI":
+        return get_chat_model(temperature=0.2)
+    
+    @property
+    def document_chain(self):
+        """RAG generation chain, built once on first use."""
+        if self._document_chain is None:
+            from langchain.chains.combine_documents import create_stuff_documents_chain
+            self._document_chain = create_stuff_documents_chain(self.llm, self.rag_prompt)
+        return self._document_chain
+    
+    @property
+    def direct_chain(self):
+        """Generation chain without retrieved context, built once on first use."""
+        if self._direct_chain is None:
+            self._direct_chain = self.direct_prompt | self.llm | StrOutputParser()
+        return self._direct_chain
+    
+    def render_metrics(self) -> str:
+        """Prometheus text exposition of stage latencies, token counts and cache statistics."""
+        gauges = {
+            "entity_cache": self.entity_cache.stats(),
+            "embedding_cache": self.vector_store.embeddings.stats(),
+            "answer_cache": self.answer_cache.stats(),
+            "sessions": self.sessions.stats()
+        }
+        if self.data_processor.pubmed_cache:
+            gauges["pubmed_cache"] = self.data_processor.pubmed_cache.stats()
+        return self.metrics.render(gauges)
+    
+    def warm_up(self) -> Dict[str, float]:
+        """Create the lazily constructed models, clients and stores ahead of the first request.
+        
+        Returns the seconds spent per component.
+        """
+        timings = {}
+        
+        start = time.perf_counter()
+        self.document_chain
+        self.direct_chain
+        self.entity_extractor.chain
+        timings["llm_clients"] = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        # Straight to the engine so the embedding cache can't skip loading the model
+        self.vector_store.embedding_engine.embed_query("warm up")
+        timings["embedding_model"] = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        self.vector_store.get_literature_store()
+        self.data_processor.text_splitter
+        timings["vector_store"] = time.perf_counter() - start
+        
+        logger.info("Warm-up finished: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+        return timings
+    
+    async def aclose(self):
+        """Release the async clients; call when the ASGI app shuts down."""
+        await self.data_processor.aclose()
+    
+    @property
+    def current_context(self) -> Optional[PatientContext]:
+        """The patient context selected for the current request."""
+        return self._current_context.get()
+    
+    @property
+    def is_initialized(self) -> bool:
+        return self.current_context is not None
+    
+    @property
+    def patient_ehr_hash(self) -> Optional[str]:
+        context = self.current_context
+        return context.ehr_hash if context else None
+    
+    @property
+    def patient_data(self) -> Optional[Dict[str, Any]]:
+        context = self.current_context
+        return context.patient_data if context else None
+    
+    @property
+    def vector_retriever(self):
+        context = self.current_context
+        return context.vector_retriever if context else None
+    
+    @property
+    def literature_retriever(self):
+        context = self.current_context
+        return context.literature_retriever if context else None
+    
+    @property
+    def bm25_retriever(self):
+        context = self.current_context
+        return context.bm25_retriever if context else None
+    
+    @property
+    def literature_bm25_retriever(self):
+        context = self.current_context
+        return context.literature_bm25_retriever if context else None
+    
+    def use_patient(self, ehr_hash: str) -> bool:
+        """Select an already initialized patient for the current request."""
+        context = self.sessions.get(ehr_hash)
+        if context is None:
+            return False
+        self._current_context.set(context)
+        return True
+    
+    def _generate_unique_id(self, text: str) -> str:
+        """Generate a unique ID for the EHR text to track changes."""
+        return hashlib.md5(text.encode()).hexdigest()
+        
+    def initialize_with_patient_ehr(self, 
+                                   patient_ehr: str,
+                                   medical_conditions: Optional[List[str]] = None,
+                                   force_reinitialize: bool = False) -> bool:
+        """Initialize the system with patient EHR data and relevant medical knowledge."""
+        with self.metrics.span("initialize"):
+            return self._initialize_with_patient_ehr(patient_ehr, medical_conditions, force_reinitialize)
+    
+    def _initialize_with_patient_ehr(self,
+                                     patient_ehr: str,
+                                     medical_conditions: Optional[List[str]],
+                                     force_reinitialize: bool) -> bool:
+        # Generate a hash for the EHR text to check if it's the same
+        new_ehr_hash = self._generate_unique_id(patient_ehr)
+        
+        if force_reinitialize:
+            self.answer_cache.invalidate(new_ehr_hash)
+            context = self._build_patient_context(patient_ehr, new_ehr_hash, medical_conditions, True)
+            if context is not None:
+                self.sessions.put(context)
+        else:
+            # Reuse a registered context, or build it once even under concurrent requests
+            context = self.sessions.get_or_create(
+                new_ehr_hash,
+                lambda: self._build_patient_context(patient_ehr, new_ehr_hash, medical_conditions, False)
+            )
+        
+        if context is None:
+            return False
+        
+        self._current_context.set(context)
+        return True
+    
+    def _build_patient_context(self,
+                               patient_ehr: str,
+                               new_ehr_hash: str,
+                               medical_conditions: Optional[List[str]],
+                               force_reinitialize: bool) -> Optional[PatientContext]:
+        """Process an EHR and build its retrievers; returns None on failure."""
+        # Process the EHR data
+        logger.info("Processing patient EHR data")
+        context = PatientContext(new_ehr_hash, self.process_patient_ehr(patient_ehr), len(patient_ehr))
+        
+        # Create a unique collection name based on the EHR content
+        collection_name = f"patient_{new_ehr_hash[:8]}"
+        
+        # First, check if we already have a vector store for this patient
+        with self.metrics.span("vector_store_load"):
+            existing_vector_store = self.vector_store.load_vector_store(collection_name)
+        
+        if existing_vector_store and not force_reinitialize:
+            self._attach_existing_retrievers(context, collection_name, existing_vector_store)
+            return context
+        
+        # Process and store documents
+        try:
+            # Start with patient EHR document
+            ehr_documents = self.data_processor.process_ehr_data(ehr_text=patient_ehr)
+            
+            # Dynamically fetch relevant medical literature based on patient conditions
+            conditions = medical_conditions if medical_conditions else context.patient_data.get("medical_conditions", [])
+            
+            if conditions:
+                # Fetch PubMed articles for all conditions concurrently
+                with self.metrics.span("pubmed_fetch"):
+                    literature_documents = self.data_processor.fetch_pubmed_for_queries(
+                        self._literature_queries(conditions), max_results=5, max_workers=self.literature_concurrency
+                    )
+            else:
+                # If no conditions found, use sample documents
+                logger.info("No medical conditions found, using sample documents")
+                literature_documents = self.data_processor.create_sample_documents()
+            
+            return self._index_patient_documents(context, collection_name, ehr_documents, literature_documents)
+        except Exception as e:
+            logger.error(f"Error initializing the system: {e}")
+            return None
+    
+    @staticmethod
+    def _literature_queries(conditions: List[str]) -> List[str]:
+        return [f"{condition} treatment guidelines" for condition in conditions]
+    
+    def _attach_existing_retrievers(self, context: PatientContext, collection_name: str, existing_vector_store: "Chroma"):
+        """Point a context at an already persisted patient collection and its literature."""
+        with self.metrics.span("attach_existing"):
+            self._attach_existing_collection(context, collection_name, existing_vector_store)
+    
+    def _attach_existing_collection(self, context: PatientContext, collection_name: str, existing_vector_store: "Chroma"):
+        logger.info(f"Using existing vector store for patient {collection_name}")
+        context.vector_retriever = existing_vector_store.as_retriever(
+            search_type="similarity",
+            search_kwargs={"k": 5}
+        )
+        literature_ids = self.vector_store.load_literature_ids(collection_name)
+        context.literature_retriever = (
+            self.vector_store.get_literature_retriever(literature_ids) if literature_ids else None
+        )
+        
+        # Restore the persisted BM25 indexes, backfilling collections created before they existed
+        patient_bm25 = self.vector_store.get_bm25_index(collection_name)
+        self.vector_store.sync_bm25_index(patient_bm25, existing_vector_store)
+        context.bm25_retriever = patient_bm25.as_retriever(k=5)
+        
+        if literature_ids:
+            literature_bm25 = self.vector_store.get_bm25_index(LITERATURE_COLLECTION)
+            self.vector_store.sync_bm25_index(
+                literature_bm25, self.vector_store.get_literature_store(), literature_ids
+            )
+            context.literature_bm25_retriever = literature_bm25.as_retriever(k=5, doc_ids=literature_ids)
+    
+    def _index_patient_documents(self,
+                                 context: PatientContext,
+                                 collection_name: str,
+                                 ehr_documents: List[Document],
+                                 literature_documents: List[Document]) -> Optional[PatientContext]:
+        """Embed and index a patient's documents and attach the resulting retrievers to the context."""
+        # Create vector stores: a small per-patient EHR collection plus the shared literature collection
+        if len(ehr_documents) == 0:
+            logger.error("No documents were loaded")
+            return None
+        
+        with self.metrics.span("ehr_embedding"):
+            vector_store = self.vector_store.create_vector_store(ehr_documents, collection_name)
+        
+        # Initialize vector retrievers
+        context.vector_retriever = vector_store.as_retriever(
+            search_type="similarity",
+            search_kwargs={"k": 5}
+        )
+        
+        with self.metrics.span("literature_embedding"):
+            literature_ids = self.vector_store.add_literature(literature_documents)
+            self.vector_store.save_literature_ids(collection_name, literature_ids)
+        context.literature_retriever = (
+            self.vector_store.get_literature_retriever(literature_ids) if literature_ids else None
+        )
+        
+        # Initialize BM25 retrievers for hybrid search from the persistent indexes
+        with self.metrics.span("bm25_indexing"):
+            patient_bm25 = self.vector_store.get_bm25_index(collection_name)
+            patient_bm25.add_documents(
+                ehr_documents, [self.vector_store.document_id(doc) for doc in ehr_documents]
+            )
+        context.bm25_retriever = patient_bm25.as_retriever(k=5)
+        context.literature_bm25_retriever = (
+            self.vector_store.get_bm25_index(LITERATURE_COLLECTION).as_retriever(k=5, doc_ids=literature_ids)
+            if literature_ids else None
+        )
         
-    def initialize_with_patient_ehr(self, 
-                                   patient_ehr: str,
-                                   medical_conditions: Optional[List[str]] = None,
-                                   force_reinitialize: bool = False) -> bool:
-        """Initialize the system with patient EHR data and relevant medical knowledge."""
-        # Generate a hash for the EHR text to check if it's the same
+        logger.info("Clinical Decision Support System initialized successfully with patient EHR")
+        return context
+    
+    async def ainitialize_with_patient_ehr(self,
+                                           patient_ehr: str,
+                                           medical_conditions: Optional[List[str]] = None,
+                                           force_reinitialize: bool = False) -> bool:
+        """Async variant of initialize_with_patient_ehr that doesn't block the event loop."""
+        with self.metrics.span("initialize"):
+            return await self._ainitialize_with_patient_ehr(patient_ehr, medical_conditions, force_reinitialize)
+    
+    async def _ainitialize_with_patient_ehr(self,
+                                            patient_ehr: str,
+                                            medical_conditions: Optional[List[str]],
+                                            force_reinitialize: bool) -> bool:
         new_ehr_hash = self._generate_unique_id(patient_ehr)
         
-        # Check if we already processed this EHR
-        if self.patient_ehr_hash == new_ehr_hash and self.is_initialized and not force_reinitialize:
-            logger.info("System already initialized with this EHR data")
-            return True
+        if force_reinitialize:
+            await asyncio.to_thread(self.answer_cache.invalidate, new_ehr_hash)
         
-        # Process the EHR data
-        logger.info("Processing patient EHR data")
-        self.patient_data = self.process_patient_ehr(patient_ehr)
+        context = None if force_reinitialize else self.sessions.get(new_ehr_hash)
+        if context is None:
+            # Share one in-flight build between concurrent requests for the same EHR
+            build = self._inflight_builds.get(new_ehr_hash)
+            if build is None or force_reinitialize:
+                build = asyncio.ensure_future(
+                    self._abuild_patient_context(patient_ehr, new_ehr_hash, medical_conditions, force_reinitialize)
+                )
+                self._inflight_builds[new_ehr_hash] = build
+                build.add_done_callback(
+                    lambda done: self._inflight_builds.pop(new_ehr_hash)
+                    if self._inflight_builds.get(new_ehr_hash) is done else None
+                )
+            
+            context = await asyncio.shield(build)
+            if context is not None:
+                self.sessions.put(context)
         
-        # Create a unique collection name based on the EHR content
-        collection_name = f"patient_{new_ehr_hash[:8]}"
+        if context is None:
+            return False
         
-        # First, check if we already have a vector store for this patient
-        existing_vector_store = self.vector_store.load_vector_store(collection_name)
+        self._current_context.set(context)
+        return True
+    
+    async def _abuild_patient_context(self,
+                                      patient_ehr: str,
+                                      new_ehr_hash: str,
+                                      medical_conditions: Optional[List[str]],
+                                      force_reinitialize: bool) -> Optional[PatientContext]:
+        """Async variant of _build_patient_context; CPU and disk bound steps run in worker threads."""
+        logger.info("Processing patient EHR data")
+        context = PatientContext(new_ehr_hash, await self.aprocess_patient_ehr(patient_ehr), len(patient_ehr))
+        collection_name = f"patient_{new_ehr_hash[:8]}"
         
+        with self.metrics.span("vector_store_load"):
+            existing_vector_store = await asyncio.to_thread(self.vector_store.load_vector_store, collection_name)
         if existing_vector_store and not force_reinitialize:
-            logger.info(f"Using existing vector store for patient {collection_name}")
-            self.vector_retriever = existing_vector_store.as_retriever(
-                search_type="similarity",
-                search_kwargs={"k": 5}
-            )
-            self.patient_ehr_hash = new_ehr_hash
-            self.is_initialized = True
-            return True
+            await asyncio.to_thread(self._attach_existing_retrievers, context, collection_name, existing_vector_store)
+            return context
         
-        # Process and store documents
         try:
-            # Start with patient EHR document
-            documents = self.data_processor.process_ehr_data(ehr_text=patient_ehr)
-            
-            # Dynamically fetch relevant medical literature based on patient conditions
-            conditions = medical_conditions if medical_conditions else self.patient_data.get("medical_conditions", [])
+            ehr_documents = self.data_processor.process_ehr_data(ehr_text=patient_ehr)
             
+            conditions = medical_conditions if medical_conditions else context.patient_data.get("medical_conditions", [])
             if conditions:
-                for condition in conditions:
-                    # Fetch PubMed articles for each condition
-                    query = f"{condition} treatment guidelines"
-                    pubmed_docs = self.data_processor.fetch_pubmed_articles(query, max_results=5)
-                    documents.extend(pubmed_docs)
+                with self.metrics.span("pubmed_fetch"):
+                    literature_documents = await self.data_processor.afetch_pubmed_for_queries(
+                        self._literature_queries(conditions), max_results=5, max_concurrency=self.literature_concurrency
+                    )
             else:
-                # If no conditions found, use sample documents
                 logger.info("No medical conditions found, using sample documents")
-                sample_docs = self.data_processor.create_sample_documents()
-                documents.extend(sample_docs)
+                literature_documents = self.data_processor.create_sample_documents()
             
-            # Create vector store
-            if len(documents) > 0:
-                vector_store = self.vector_store.create_vector_store(documents, collection_name)
-                
-                # Initialize vector retriever
-                self.vector_retriever = vector_store.as_retriever(
-                    search_type="similarity",
-                    search_kwargs={"k": 5}
-                )
-                
-                # Initialize BM25 retriever for hybrid search
-                texts = [doc.page_content for doc in documents]
-                text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-                split_texts = text_splitter.split_text(" ".join(texts))
-                self.bm25_retriever = BM25Retriever.from_texts(split_texts)
-                self.bm25_retriever.k = 5
-                
-                self.patient_ehr_hash = new_ehr_hash
-                self.is_initialized = True
-                logger.info("Clinical Decision Support System initialized successfully with patient EHR")
-                return True
-            else:
-                logger.error("No documents were loaded")
-                return False
-                
+            return await asyncio.to_thread(
+                self._index_patient_documents, context, collection_name, ehr_documents, literature_documents
+            )
         except Exception as e:
             logger.error(f"Error initializing the system: {e}")
-            return False
+            return None
         
     def process_patient_ehr(self, ehr_text: str) -> Dict[str, Any]:
         """Extract structured information from patient EHR text."""
-        entities = self.entity_extractor.extract_entities(ehr_text)
+        with self.metrics.span("entity_extraction"):
+            plan = self._plan_entity_extraction(ehr_text)
+            if plan["entities"] is None:
+                plan["entities"] = self.entity_extractor.extract_entities(plan["text"])
+            return self._format_patient_data(self._finish_entity_extraction(plan))
+    
+    def _plan_entity_extraction(self, ehr_text: str) -> Dict[str, Any]:
+        """Decide what needs to go to the extractor: nothing (cached), only new sections, or the whole EHR."""
+        ehr_hash = self._generate_unique_id(ehr_text)
+        plan = {"ehr_hash": ehr_hash, "section_hashes": [], "base": None, "text": ehr_text, "entities": None}
+        
+        cached = self.entity_cache.get(ehr_hash)
+        if cached is not None:
+            logger.info("Using cached entity extraction for this EHR")
+            self.entity_cache.record(hits=1)
+            plan["entities"] = cached
+            return plan
+        
+        sections = EntityCache.split_sections(ehr_text)
+        plan["section_hashes"] = [EntityCache.section_hash(section) for section in sections]
+        
+        base = self.entity_cache.find_base(plan["section_hashes"]) if self.incremental_extraction else None
+        if base is not None:
+            base_entities, covered = base
+            new_sections = [
+                section for section, section_hash in zip(sections, plan["section_hashes"]) if section_hash not in covered
+            ]
+            logger.info(f"Incremental entity extraction: {len(new_sections)} of {len(sections)} sections changed")
+            self.entity_cache.record(partial_hits=1)
+            plan["base"] = base_entities
+            plan["text"] = "\n\n".join(new_sections)
+            if not new_sections:
+                plan["entities"] = {}
+        else:
+            self.entity_cache.record(misses=1)
         
-        # Format patient data
+        return plan
+    
+    def _finish_entity_extraction(self, plan: Dict[str, Any]) -> Dict[str, List[str]]:
+        """Merge incremental results and persist new extraction results."""
+        if plan["base"] is not None:
+            plan["entities"] = merge_entities(plan["base"], plan["entities"])
+        
+        # Don't persist an all-empty result; it usually means the extraction failed
+        if plan["section_hashes"] and any(plan["entities"].values()):
+            self.entity_cache.put(plan["ehr_hash"], plan["section_hashes"], plan["entities"])
+        
+        return plan["entities"]
+    
+    def _format_patient_data(self, entities: Dict[str, List[str]]) -> Dict[str, Any]:
+        """Map extracted entity categories onto the patient data structure."""
         patient_data = {
             "medical_conditions": entities.get("medical_conditions", []),
             "medications": entities.get("medications", []),
@@ -549,97 +3424,472 @@ class ClinicalDecisionSupportSystem:
             "demographics": entities.get("patient_demographics", [])
         }
         
-        logger.info(f"Processed patient EHR data: {patient_data}")
+        logger.info(
+            "Processed patient EHR data: "
+            + ", ".join(f"{len(values)} {category}" for category, values in patient_data.items())
+        )
+        logger.debug(f"Patient data: {patient_data}")
         return patient_data
     
-    def _hybrid_retrieval(self, query: str) -> List[Document]:
-        """Perform hybrid retrieval combining BM25 and vector search results."""
+    async def aprocess_patient_ehr(self, ehr_text: str) -> Dict[str, Any]:
+        """Async variant of process_patient_ehr; entity cache access runs in worker threads."""
+        with self.metrics.span("entity_extraction"):
+            plan = await asyncio.to_thread(self._plan_entity_extraction, ehr_text)
+            if plan["entities"] is None:
+                plan["entities"] = await self.entity_extractor.aextract_entities(plan["text"])
+            return self._format_patient_data(await asyncio.to_thread(self._finish_entity_extraction, plan))
+    
+    def _enhanced_query(self, query: str, patient_data: Optional[Dict[str, Any]] = None) -> str:
+        """Enhance the query with patient data (by default the current patient's) if available."""
+        patient_data = self.patient_data if patient_data is None else patient_data
+        if not patient_data:
+            return query
+        
+        patient_info = []
+        for key, value in patient_data.items():
+            if value:
+                patient_info.append(f"{key}: {', '.join(value)}")
+        
+        patient_text = "\n".join(patient_info)
+        return f"{query}\nPatient Information:\n{patient_text}"
+    
+    def _active_retrievers(self) -> List[Tuple[str, Any]]:
+        """(method, retriever) pairs for the patient EHR and shared literature retrievers."""
+        retrievers = [("vector", self.vector_retriever)]
+        if self.literature_retriever is not None:
+            retrievers.append(("vector", self.literature_retriever))
+        if self.bm25_retriever is not None:
+            retrievers.append(("bm25", self.bm25_retriever))
+        if self.literature_bm25_retriever is not None:
+            retrievers.append(("bm25", self.literature_bm25_retriever))
+        return retrievers
+    
+    @staticmethod
+    def _retrieve(method: str, retriever, query: str, query_vector: List[float]) -> List[Document]:
+        """Run one retriever; vector retrievers search by the precomputed query embedding."""
+        if method == "vector":
+            return retriever.vectorstore.similarity_search_by_vector(query_vector, **retriever.search_kwargs)
+        return retriever.invoke(query)
+    
+    def _hybrid_retrieval(self, query: str, query_vector: Optional[List[float]] = None) -> List[Document]:
+        """Perform hybrid retrieval combining BM25 and vector search results.
+        
+        query_vector is the embedding of the enhanced query, when the caller computed it already
+        (e.g. for a whole batch); otherwise it is embedded once here for all vector retrievers.
+        """
         # Check if retrievers are initialized
         if self.vector_retriever is None:
             logger.error("Vector retriever not initialized. Make sure to call initialize_with_patient_ehr() first.")
             return []
-            
-        # Enhance query with patient data if available
-        enhanced_query = query
-        if self.patient_data:
-            patient_info = []
-            for key, value in self.patient_data.items():
-                if value:
-                    patient_info.append(f"{key}: {', '.join(value)}")
-            
-            patient_text = "\n".join(patient_info)
-            enhanced_query = f"{query}\nPatient Information:\n{patient_text}"
-            
-        # Get results from vector retriever
-        vector_docs = self.vector_retriever.get_relevant_documents(enhanced_query)
         
-        # Add results from BM25 retriever if available
-        bm25_docs = []
-        if self.bm25_retriever is not None:
-            bm25_docs = self.bm25_retriever.get_relevant_documents(enhanced_query)
+        # Collect ranked lists from the patient EHR and shared literature retrievers
+        enhanced_query = self._enhanced_query(query)
+        if query_vector is None:
+            with self.metrics.span("query_embedding"):
+                query_vector = self.vector_store.embeddings.embed_queries([enhanced_query])[0]
+        ranked_lists = []
+        for method, retriever in self._active_retrievers():
+            with self.metrics.span(f"retrieval_{method}"):
+                ranked_lists.append((method, self._retrieve(method, retriever, enhanced_query, query_vector)))
         
-        # Combine and deduplicate results
-        all_docs = vector_docs + bm25_docs
-        unique_docs = {}
+        # Fuse, deduplicate and trim the results to the context budget
+        with self.metrics.span("fusion"):
+            fused_docs = self.hybrid_ranker.fuse(ranked_lists)
+        logger.info(f"Retrieved {len(fused_docs)} documents from hybrid search")
+        return fused_docs
+    
+    async def _ahybrid_retrieval(self, query: str) -> List[Document]:
+        """Async variant of _hybrid_retrieval that queries all retrievers concurrently."""
+        if self.vector_retriever is None:
+            logger.error("Vector retriever not initialized. Make sure to call initialize_with_patient_ehr() first.")
+            return []
         
-        for doc in all_docs:
-            # Create a hash based on content to identify duplicates
-            content_hash = hash(doc.page_content)
-            if content_hash not in unique_docs:
-                unique_docs[content_hash] = doc
-                
-        logger.info(f"Retrieved {len(unique_docs)} unique documents from hybrid search")
-        return list(unique_docs.values())
+        enhanced_query = self._enhanced_query(query)
+        retrievers = self._active_retrievers()
+        with self.metrics.span("query_embedding"):
+            query_vector = (await asyncio.to_thread(self.vector_store.embeddings.embed_queries, [enhanced_query]))[0]
+        
+        async def retrieve(method: str, retriever) -> List[Document]:
+            with self.metrics.span(f"retrieval_{method}"):
+                if method == "vector":
+                    return await retriever.vectorstore.asimilarity_search_by_vector(
+                        query_vector, **retriever.search_kwargs
+                    )
+                return await retriever.ainvoke(enhanced_query)
+        
+        results = await asyncio.gather(*(retrieve(method, retriever) for method, retriever in retrievers))
+        
+        with self.metrics.span("fusion"):
+            fused_docs = self.hybrid_ranker.fuse([(method, docs) for (method, _), docs in zip(retrievers, results)])
+        logger.info(f"Retrieved {len(fused_docs)} documents from hybrid search")
+        return fused_docs
+    
+    def _lookup_answer_cache(self, clinical_question: str, question_vector: np.ndarray) -> Optional[str]:
+        cached_answer = self.answer_cache.lookup(self.patient_ehr_hash, clinical_question, question_vector)
+        self.metrics.increment("answer_cache_requests", result="miss" if cached_answer is None else "hit")
+        return cached_answer
+    
+    def _record_generation(self, generation_time: float, recommendation: str):
+        self.metrics.observe("generation", generation_time)
+        self.metrics.increment("tokens", estimate_tokens(recommendation), kind="completion")
     
     def get_clinical_recommendation(self, clinical_question: str) -> str:
         """Get clinical recommendations for a specific patient case."""
+        with self.metrics.span("recommendation"):
+            return self._get_clinical_recommendation(clinical_question)
+    
+    def _get_clinical_recommendation(self, clinical_question: str) -> str:
         # Check if system is initialized
         if not self.is_initialized or self.vector_retriever is None:
             error_msg = "Error: System not initialized with patient EHR data. Please call initialize_with_patient_ehr() first."
             logger.error(error_msg)
             return error_msg
         
-        # Retrieve relevant documents
-        retrieved_docs = self._hybrid_retrieval(clinical_question)
+        # Serve near-identical questions about this patient from the answer cache
+        with self.metrics.span("answer_cache"):
+            question_vector = self.answer_cache.embed(clinical_question)
+            cached_answer = self._lookup_answer_cache(clinical_question, question_vector)
+        if cached_answer is not None:
+            return cached_answer
         
-        if not retrieved_docs:
-            logger.warning("No relevant documents found. Falling back to direct LLM approach.")
-            return self._direct_llm_recommendation(clinical_question)
+        return self._recommend_uncached(clinical_question, question_vector)
+    
+    def _recommend_uncached(self,
+                            clinical_question: str,
+                            question_vector: np.ndarray,
+                            generation_slots: Optional[threading.Semaphore] = None,
+                            query_vector: Optional[List[float]] = None) -> str:
+        """Retrieve, generate and cache a recommendation for the current patient.
         
-        # Create prompt with context variable
-        prompt_template = ChatPromptTemplate.from_messages([
-            SystemMessagePromptTemplate.from_template(self.system_prompt),
-            HumanMessagePromptTemplate.from_template(
-                """Clinical Question: {question}
-                
-                {patient_info}
-                
-                Context: {context}
+        generation_slots, when given, bounds how many LLM calls run at once across callers;
+        query_vector is the precomputed retrieval query embedding, if any.
+        """
+        # Retrieve and pack relevant documents (the only retrieval pass for this request)
+        retrieval_start = time.perf_counter()
+        rag_inputs = self._prepare_rag_inputs(clinical_question, query_vector)
+        retrieval_time = time.perf_counter() - retrieval_start
+        
+        with generation_slots or nullcontext():
+            if rag_inputs is None:
+                logger.warning("No relevant documents found. Falling back to direct LLM approach.")
+                return self._direct_llm_recommendation(clinical_question)
+            
+            # Generate recommendation from the hybrid retrieval results
+            try:
+                generation_start = time.perf_counter()
+                recommendation = self.document_chain.invoke(rag_inputs)
+                generation_time = time.perf_counter() - generation_start
+                self._record_generation(generation_time, recommendation)
+                self.answer_cache.store(self.patient_ehr_hash, clinical_question, question_vector, recommendation)
                 
-                Please provide evidence-based recommendations based on the retrieved medical literature."""
+                logger.info(
+                    f"Generated clinical recommendation successfully "
+                    f"(retrieval: {retrieval_time:.2f}s, generation: {generation_time:.2f}s, documents: {len(rag_inputs['context'])})"
+                )
+                return recommendation
+            except Exception as e:
+                logger.error(f"Error generating recommendation: {e}")
+                return self._direct_llm_recommendation(clinical_question)
+    
+    def batch_clinical_recommendations(self,
+                                       requests: List[Dict[str, Any]],
+                                       max_concurrency: int = 8,
+                                       retrieval_workers: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Answer many (patient_ehr, clinical_question) requests, yielding each result as it finishes.
+        
+        Identical requests, within the batch or already in flight from another batch, share one
+        computation. Question embeddings and retrieval query embeddings for the batch are each
+        computed in a single model call, retrievals run in parallel and at most max_concurrency generation calls run at once.
+        Each result carries the request's "index" (and "id", if one was given).
+        
+        max_concurrency and retrieval_workers are clamped to MAX_BATCH_CONCURRENCY; batches larger
+        than MAX_BATCH_SIZE raise ValueError.
+        """
+        if not requests:
+            return
+        if len(requests) > MAX_BATCH_SIZE:
+            raise ValueError(f"Batch of {len(requests)} requests exceeds the maximum of {MAX_BATCH_SIZE}")
+        
+        max_concurrency = max(1, min(max_concurrency, MAX_BATCH_CONCURRENCY))
+        retrieval_workers = max(1, min(retrieval_workers or max(max_concurrency, 4), MAX_BATCH_CONCURRENCY))
+        generation_slots = threading.BoundedSemaphore(max_concurrency)
+        batch_start = time.perf_counter()
+        
+        def result_for(index: int, **fields) -> Dict[str, Any]:
+            result = {"index": index}
+            if isinstance(requests[index], dict) and requests[index].get("id") is not None:
+                result["id"] = requests[index]["id"]
+            result.update(fields)
+            return result
+        
+        # Validate each item up front, so a bad item gets its own error line instead of ending the stream
+        valid = {}
+        for index, request in enumerate(requests):
+            if not isinstance(request, dict):
+                yield result_for(index, error="Invalid request")
+                continue
+            patient_ehr = request.get("patient_ehr")
+            question = request.get("clinical_question")
+            if not patient_ehr or not question:
+                yield result_for(index, error="Missing required fields")
+            elif not isinstance(patient_ehr, str) or not isinstance(question, str):
+                yield result_for(index, error="patient_ehr and clinical_question must be strings")
+            elif not question.strip():
+                yield result_for(index, error="Missing required fields")
+            else:
+                valid[index] = (self._generate_unique_id(patient_ehr), patient_ehr, question.strip())
+        
+        # Initialize each distinct patient once, in parallel
+        patient_ehrs = {}
+        for ehr_hash, patient_ehr, _ in valid.values():
+            patient_ehrs.setdefault(ehr_hash, patient_ehr)
+        
+        def initialize(patient_ehr: str) -> Optional[PatientContext]:
+            # One patient failing to initialize only fails that patient's requests
+            try:
+                return self.current_context if self.initialize_with_patient_ehr(patient_ehr) else None
+            except Exception as e:
+                logger.error(f"Error initializing patient in batch: {e}")
+                return None
+        
+        with ThreadPoolExecutor(max_workers=min(retrieval_workers, len(patient_ehrs) or 1)) as executor:
+            contexts = dict(zip(patient_ehrs, executor.map(initialize, patient_ehrs.values())))
+        
+        # Coalesce identical requests; each distinct (patient, question) is answered once
+        groups = {}
+        for index, (ehr_hash, _, question) in valid.items():
+            if contexts.get(ehr_hash) is None:
+                yield result_for(index, error="Failed to initialize with EHR")
+            else:
+                groups.setdefault((ehr_hash, " ".join(question.lower().split())), (question, []))[1].append(index)
+        
+        if not groups:
+            return
+        
+        # One embedding call for all distinct questions (answer-cache lookups) and one for their
+        # patient-enhanced retrieval queries
+        keys = list(groups)
+        with self.metrics.span("answer_cache"):
+            question_vectors = self.answer_cache.embed_many([groups[key][0] for key in keys])
+        with self.metrics.span("query_embedding"):
+            query_vectors = self.vector_store.embeddings.embed_queries(
+                [self._enhanced_query(groups[key][0], contexts[key[0]].patient_data) for key in keys]
             )
-        ])
         
-        # Format patient information if available
-        patient_info_text = self._format_patient_info()
+        def answer(key, question_vector: np.ndarray, query_vector: List[float]) -> Tuple[str, bool]:
+            # Worker threads don't inherit the caller's context, so select the patient explicitly
+            self._current_context.set(contexts[key[0]])
+            cached_answer = self._lookup_answer_cache(groups[key][0], question_vector)
+            if cached_answer is not None:
+                return cached_answer, True
+            return self._recommend_uncached(groups[key][0], question_vector, generation_slots, query_vector), False
+        
+        futures = {}
+        owned = []
+        shared = set()
+        executor = ThreadPoolExecutor(max_workers=retrieval_workers)
+        try:
+            with self._inflight_lock:
+                for key, question_vector, query_vector in zip(keys, question_vectors, query_vectors):
+                    future = self._inflight_recommendations.get(key)
+                    if future is None:
+                        future = executor.submit(answer, key, question_vector, query_vector)
+                        self._inflight_recommendations[key] = future
+                        owned.append((key, future))
+                    else:
+                        shared.add(key)
+                    futures[future] = key
+            
+            coalesced = sum(len(groups[key][1]) - (0 if key in shared else 1) for key in keys)
+            if coalesced:
+                self.metrics.increment("coalesced_requests", coalesced)
+            
+            for future in concurrent.futures.as_completed(futures):
+                key = futures[future]
+                indices = groups[key][1]
+                try:
+                    recommendation, cached = future.result()
+                    for position, index in enumerate(indices):
+                        yield result_for(
+                            index, recommendation=recommendation, cached=cached, coalesced=position > 0 or key in shared
+                        )
+                except Exception as e:
+                    logger.error(f"Error in batch recommendation: {e}")
+                    for index in indices:
+                        yield result_for(index, error=str(e))
+        finally:
+            with self._inflight_lock:
+                for key, future in owned:
+                    if self._inflight_recommendations.get(key) is future:
+                        del self._inflight_recommendations[key]
+            executor.shutdown(wait=False)
+            self.metrics.observe("batch_recommendation", time.perf_counter() - batch_start)
+    
+    def stream_clinical_recommendation(self, clinical_question: str) -> Iterator[str]:
+        """Stream a clinical recommendation chunk by chunk as the LLM generates it."""
+        if not self.is_initialized or self.vector_retriever is None:
+            error_msg = "Error: System not initialized with patient EHR data. Please call initialize_with_patient_ehr() first."
+            logger.error(error_msg)
+            yield error_msg
+            return
+        
+        with self.metrics.span("answer_cache"):
+            question_vector = self.answer_cache.embed(clinical_question)
+            cached_answer = self._lookup_answer_cache(clinical_question, question_vector)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+        
+        request_start = time.perf_counter()
+        rag_inputs = self._prepare_rag_inputs(clinical_question)
         
-        # Create RAG chain
-        document_chain = create_stuff_documents_chain(self.llm, prompt_template)
-        rag_chain = create_retrieval_chain(self.vector_retriever, document_chain)
+        if rag_inputs is None:
+            logger.warning("No relevant documents found. Falling back to direct LLM approach.")
+            yield from self._stream_direct_llm_recommendation(clinical_question)
+            return
         
-        # Generate recommendation
+        first_chunk_time = None
+        chunks = []
         try:
-            response = rag_chain.invoke({
-                "question": clinical_question,
-                "patient_info": patient_info_text
-            })
+            generation_start = time.perf_counter()
+            for chunk in self.document_chain.stream(rag_inputs):
+                if first_chunk_time is None:
+                    first_chunk_time = time.perf_counter() - request_start
+                    self.metrics.observe("time_to_first_token", first_chunk_time)
+                    logger.info(f"Time to first token: {first_chunk_time:.2f}s")
+                chunks.append(chunk)
+                yield chunk
             
-            recommendation = response["answer"]
-            logger.info("Generated clinical recommendation successfully")
+            self._record_generation(time.perf_counter() - generation_start, "".join(chunks))
+            self.answer_cache.store(self.patient_ehr_hash, clinical_question, question_vector, "".join(chunks))
+            logger.info(f"Streamed clinical recommendation successfully in {time.perf_counter() - request_start:.2f}s")
+        except Exception as e:
+            logger.error(f"Error streaming recommendation: {e}")
+            # Only fall back if nothing has been sent yet, otherwise the client would get two answers
+            if first_chunk_time is None:
+                yield from self._stream_direct_llm_recommendation(clinical_question)
+            else:
+                yield "\n\nAn error occurred while generating the clinical recommendation. The response above may be incomplete."
+    
+    async def aget_clinical_recommendation(self, clinical_question: str) -> str:
+        """Async variant of get_clinical_recommendation using the async LangChain interfaces."""
+        with self.metrics.span("recommendation"):
+            return await self._aget_clinical_recommendation(clinical_question)
+    
+    async def _aget_clinical_recommendation(self, clinical_question: str) -> str:
+        if not self.is_initialized or self.vector_retriever is None:
+            error_msg = "Error: System not initialized with patient EHR data. Please call initialize_with_patient_ehr() first."
+            logger.error(error_msg)
+            return error_msg
+        
+        with self.metrics.span("answer_cache"):
+            question_vector = await asyncio.to_thread(self.answer_cache.embed, clinical_question)
+            cached_answer = await asyncio.to_thread(self._lookup_answer_cache, clinical_question, question_vector)
+        if cached_answer is not None:
+            return cached_answer
+        
+        retrieval_start = time.perf_counter()
+        rag_inputs = await self._aprepare_rag_inputs(clinical_question)
+        retrieval_time = time.perf_counter() - retrieval_start
+        
+        if rag_inputs is None:
+            logger.warning("No relevant documents found. Falling back to direct LLM approach.")
+            return await self._adirect_llm_recommendation(clinical_question)
+        
+        try:
+            generation_start = time.perf_counter()
+            recommendation = await self.document_chain.ainvoke(rag_inputs)
+            generation_time = time.perf_counter() - generation_start
+            self._record_generation(generation_time, recommendation)
+            await asyncio.to_thread(
+                self.answer_cache.store, self.patient_ehr_hash, clinical_question, question_vector, recommendation
+            )
+            
+            logger.info(
+                f"Generated clinical recommendation successfully "
+                f"(retrieval: {retrieval_time:.2f}s, generation: {generation_time:.2f}s, documents: {len(rag_inputs['context'])})"
+            )
             return recommendation
         except Exception as e:
             logger.error(f"Error generating recommendation: {e}")
-            return self._direct_llm_recommendation(clinical_question)
+            return await self._adirect_llm_recommendation(clinical_question)
+    
+    async def astream_clinical_recommendation(self, clinical_question: str) -> AsyncIterator[str]:
+        """Async variant of stream_clinical_recommendation."""
+        if not self.is_initialized or self.vector_retriever is None:
+            error_msg = "Error: System not initialized with patient EHR data. Please call initialize_with_patient_ehr() first."
+            logger.error(error_msg)
+            yield error_msg
+            return
+        
+        with self.metrics.span("answer_cache"):
+            question_vector = await asyncio.to_thread(self.answer_cache.embed, clinical_question)
+            cached_answer = await asyncio.to_thread(self._lookup_answer_cache, clinical_question, question_vector)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+        
+        request_start = time.perf_counter()
+        rag_inputs = await self._aprepare_rag_inputs(clinical_question)
+        
+        if rag_inputs is None:
+            logger.warning("No relevant documents found. Falling back to direct LLM approach.")
+            async for chunk in self._astream_direct_llm_recommendation(clinical_question):
+                yield chunk
+            return
+        
+        first_chunk_time = None
+        chunks = []
+        try:
+            generation_start = time.perf_counter()
+            async for chunk in self.document_chain.astream(rag_inputs):
+                if first_chunk_time is None:
+                    first_chunk_time = time.perf_counter() - request_start
+                    self.metrics.observe("time_to_first_token", first_chunk_time)
+                    logger.info(f"Time to first token: {first_chunk_time:.2f}s")
+                chunks.append(chunk)
+                yield chunk
+            
+            self._record_generation(time.perf_counter() - generation_start, "".join(chunks))
+            await asyncio.to_thread(
+                self.answer_cache.store, self.patient_ehr_hash, clinical_question, question_vector, "".join(chunks)
+            )
+            logger.info(f"Streamed clinical recommendation successfully in {time.perf_counter() - request_start:.2f}s")
+        except Exception as e:
+            logger.error(f"Error streaming recommendation: {e}")
+            if first_chunk_time is None:
+                async for chunk in self._astream_direct_llm_recommendation(clinical_question):
+                    yield chunk
+            else:
+                yield "\n\nAn error occurred while generating the clinical recommendation. The response above may be incomplete."
+    
+    def _prepare_rag_inputs(self,
+                            clinical_question: str,
+                            query_vector: Optional[List[float]] = None) -> Optional[Dict[str, Any]]:
+        """Retrieve and pack the context for a question; returns None when nothing relevant was found."""
+        return self._pack_rag_inputs(clinical_question, self._hybrid_retrieval(clinical_question, query_vector))
+    
+    async def _aprepare_rag_inputs(self, clinical_question: str) -> Optional[Dict[str, Any]]:
+        """Async variant of _prepare_rag_inputs."""
+        return self._pack_rag_inputs(clinical_question, await self._ahybrid_retrieval(clinical_question))
+    
+    def _pack_rag_inputs(self, clinical_question: str, retrieved_docs: List[Document]) -> Optional[Dict[str, Any]]:
+        if not retrieved_docs:
+            return None
+        
+        # Format patient information if available and pack everything into the prompt budget
+        with self.metrics.span("context_packing"):
+            patient_info_text, context_docs, token_report = self.context_packer.pack(
+                clinical_question, self._format_patient_info(), retrieved_docs, system_prompt=self.system_prompt
+            )
+        logger.info(f"Prompt token usage: {token_report}")
+        self.metrics.increment("tokens", token_report["total"], kind="prompt")
+        
+        return {
+            "context": context_docs,
+            "question": clinical_question,
+            "patient_info": patient_info_text
+        }
     
     def _format_patient_info(self) -> str:
         """Format patient information into a readable string."""
@@ -677,24 +3927,13 @@ class ClinicalDecisionSupportSystem:
     def _direct_llm_recommendation(self, clinical_question: str) -> str:
         """Fallback method to generate recommendations directly using LLM without retrieval."""
         logger.info("Using direct LLM approach for recommendation")
+        self.metrics.increment("direct_fallbacks")
         
         # Format patient information
         patient_info_text = self._format_patient_info()
         
-        prompt = ChatPromptTemplate.from_messages([
-            SystemMessagePromptTemplate.from_template(self.system_prompt),
-            HumanMessagePromptTemplate.from_template(
-                """Clinical Question: {question}
-                
-                {patient_info}
-                
-                Please provide evidence-based recommendations based on your medical knowledge."""
-            )
-        ])
-        
         try:
-            chain = prompt | self.llm | StrOutputParser()
-            recommendation = chain.invoke({
+            recommendation = self.direct_chain.invoke({
                 "question": clinical_question,
                 "patient_info": patient_info_text
             })
@@ -704,16 +3943,344 @@ class ClinicalDecisionSupportSystem:
         except Exception as e:
             logger.error(f"Error generating direct LLM recommendation: {e}")
             return "An error occurred while generating the clinical recommendation. Please try again or refine your query."
+    
+    async def _adirect_llm_recommendation(self, clinical_question: str) -> str:
+        """Async variant of _direct_llm_recommendation."""
+        logger.info("Using direct LLM approach for recommendation")
+        self.metrics.increment("direct_fallbacks")
+        
+        try:
+            recommendation = await self.direct_chain.ainvoke({
+                "question": clinical_question,
+                "patient_info": self._format_patient_info()
+            })
+            
+            logger.info("Generated direct LLM recommendation successfully")
+            return recommendation
+        except Exception as e:
+            logger.error(f"Error generating direct LLM recommendation: {e}")
+            return "An error occurred while generating the clinical recommendation. Please try again or refine your query."
+    
+    def _stream_direct_llm_recommendation(self, clinical_question: str) -> Iterator[str]:
+        """Streaming variant of the direct LLM fallback."""
+        logger.info("Using direct LLM approach for recommendation")
+        self.metrics.increment("direct_fallbacks")
+        
+        try:
+            yield from self.direct_chain.stream({
+                "question": clinical_question,
+                "patient_info": self._format_patient_info()
+            })
+        except Exception as e:
+            logger.error(f"Error streaming direct LLM recommendation: {e}")
+            yield "An error occurred while generating the clinical recommendation. Please try again or refine your query."
+    
+    async def _astream_direct_llm_recommendation(self, clinical_question: str) -> AsyncIterator[str]:
+        """Async variant of _stream_direct_llm_recommendation."""
+        logger.info("Using direct LLM approach for recommendation")
+        self.metrics.increment("direct_fallbacks")
+        
+        try:
+            async for chunk in self.direct_chain.astream({
+                "question": clinical_question,
+                "patient_info": self._format_patient_info()
+            }):
+                yield chunk
+        except Exception as e:
+            logger.error(f"Error streaming direct LLM recommendation: {e}")
+            yield "An error occurred while generating the clinical recommendation. Please try again or refine your query."
+
+class CohortInitializer:
+    """Staged pipeline that initializes many patients at once, e.g. to pre-warm a clinic list overnight.
+    
+    Records flow through three stages, each with its own worker pool and connected by bounded queues:
+    entity extraction, literature fetch (each distinct query is fetched and embedded once for the whole
+    cohort) and patient indexing. Completed records are written to a checkpoint file so an interrupted
+    run resumes where it stopped; the persisted collections and caches make later initializations cheap.
+    """
+    
+    STAGES = ("extraction", "literature", "indexing")
+    _DONE = object()
+    
+    def __init__(self,
+                 cdss: "ClinicalDecisionSupportSystem",
+                 checkpoint_path: Optional[str] = None,
+                 extraction_workers: int = 4,
+                 literature_workers: int = 4,
+                 indexing_workers: int = 2,
+                 queue_size: int = 32,
+                 progress_interval: float = 10.0,
+                 progress_callback=None):
+        self.cdss = cdss
+        self.checkpoint_path = checkpoint_path
+        self.workers = {
+            "extraction": max(1, extraction_workers),
+            "literature": max(1, literature_workers),
+            "indexing": max(1, indexing_workers)
+        }
+        self.queue_size = max(1, queue_size)
+        self.progress_interval = progress_interval
+        self.progress_callback = progress_callback
+        
+        self._lock = threading.Lock()
+        self._query_results = {}
+        self._checkpoint = {"completed": {}, "failed": {}}
+        self._progress = {}
+    
+    @staticmethod
+    def load_records(path: str) -> Iterator[Dict[str, Any]]:
+        """Read cohort records from a CSV or JSONL file.
+        
+        Each record needs the EHR text in a "patient_ehr" (or "ehr") field; "patient_id" and
+        "medical_conditions" (a list, or a ";"-separated string) are optional.
+        """
+        if path.endswith(".jsonl"):
+            with open(path, "r") as f:
+                rows = (json.loads(line) for line in f if line.strip())
+                yield from CohortInitializer._normalize_records(rows)
+        else:
+            import pandas as pd
+            rows = pd.read_csv(path, dtype=str, keep_default_na=False).to_dict("records")
+            yield from CohortInitializer._normalize_records(rows)
+    
+    @staticmethod
+    def _normalize_records(rows) -> Iterator[Dict[str, Any]]:
+        for index, row in enumerate(rows):
+            patient_ehr = row.get("patient_ehr") or row.get("ehr")
+            if not patient_ehr:
+                logger.warning(f"Skipping cohort record {index}: no EHR text")
+                continue
+            
+            conditions = row.get("medical_conditions") or None
+            if isinstance(conditions, str):
+                conditions = [c.strip() for c in conditions.split(";") if c.strip()] or None
+            
+            ehr_hash = hashlib.md5(patient_ehr.encode()).hexdigest()
+            yield {
+                "patient_id": str(row.get("patient_id") or ehr_hash),
+                "patient_ehr": patient_ehr,
+                "ehr_hash": ehr_hash,
+                "medical_conditions": conditions
+            }
+    
+    def _load_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            try:
+                with open(self.checkpoint_path, "r") as f:
+                    self._checkpoint = json.load(f)
+                self._checkpoint.setdefault("completed", {})
+                self._checkpoint.setdefault("failed", {})
+                logger.info(f"Resuming cohort from checkpoint: {len(self._checkpoint['completed'])} patients already done")
+            except Exception as e:
+                logger.warning(f"Could not read cohort checkpoint {self.checkpoint_path}: {e}")
+    
+    def _save_checkpoint(self):
+        """Write the checkpoint atomically; called with self._lock held."""
+        if not self.checkpoint_path:
+            return
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+    
+    def _record_result(self, record: Dict[str, Any], error: Optional[str] = None):
+        with self._lock:
+            if error is None:
+                self._checkpoint["completed"][record["patient_id"]] = record["ehr_hash"]
+                self._checkpoint["failed"].pop(record["patient_id"], None)
+                self._progress["completed"] += 1
+            else:
+                self._checkpoint["failed"][record["patient_id"]] = error
+                self._progress["failed"] += 1
+            self._save_checkpoint()
+    
+    def _is_completed(self, record: Dict[str, Any]) -> bool:
+        # A changed EHR under the same patient ID has to be initialized again
+        return self._checkpoint["completed"].get(record["patient_id"]) == record["ehr_hash"]
+    
+    def _extract(self, record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Stage 1: entity extraction, or reuse of an already persisted patient collection."""
+        cdss = self.cdss
+        context = PatientContext(record["ehr_hash"], cdss.process_patient_ehr(record["patient_ehr"]), len(record["patient_ehr"]))
+        collection_name = f"patient_{record['ehr_hash'][:8]}"
+        
+        existing_vector_store = cdss.vector_store.load_vector_store(collection_name)
+        if existing_vector_store:
+            cdss._attach_existing_retrievers(context, collection_name, existing_vector_store)
+            cdss.sessions.put(context)
+            self._record_result(record)
+            return None
+        
+        record["context"] = context
+        record["collection_name"] = collection_name
+        return record
+    
+    def _fetch_query(self, query: str) -> List[Document]:
+        """Fetch and embed one literature query, sharing the result with every patient that needs it."""
+        with self._lock:
+            future = self._query_results.get(query)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._query_results[query] = future
+        
+        if not owner:
+            return future.result()
+        
+        try:
+            documents = self.cdss.data_processor.fetch_pubmed_articles(query, max_results=5)
+            # Embed as soon as the query is fetched so indexing only has to link the patient to it
+            self.cdss.vector_store.add_literature(documents)
+            future.set_result(documents)
+        except Exception as e:
+            future.set_exception(e)
+        return future.result()
+    
+    def _fetch_literature(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """Stage 2: literature for the patient's conditions, deduplicated across the cohort."""
+        context = record["context"]
+        conditions = record["medical_conditions"] or context.patient_data.get("medical_conditions", [])
+        
+        if conditions:
+            queries = self.cdss._literature_queries(conditions)
+            results = [
+                # Copies, because merging annotates document metadata per patient
+                [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in self._fetch_query(query)]
+                for query in queries
+            ]
+            record["literature_documents"] = self.cdss.data_processor._merge_query_results(queries, results)
+        else:
+            record["literature_documents"] = self.cdss.data_processor.create_sample_documents()
+        return record
+    
+    def _index(self, record: Dict[str, Any]) -> None:
+        """Stage 3: embed the EHR, link the shared literature and register the patient session."""
+        ehr_documents = self.cdss.data_processor.process_ehr_data(ehr_text=record["patient_ehr"])
+        context = self.cdss._index_patient_documents(
+            record["context"], record["collection_name"], ehr_documents, record["literature_documents"]
+        )
+        if context is None:
+            raise RuntimeError("no documents were indexed")
+        
+        self.cdss.sessions.put(context)
+        self._record_result(record)
+        return None
+    
+    def _stage_worker(self, stage: str, func, in_queue: "queue.Queue", out_queue: Optional["queue.Queue"], remaining: List[int]):
+        """Process records from in_queue; the last worker of a stage to finish closes the next queue."""
+        try:
+            while True:
+                record = in_queue.get()
+                if record is self._DONE:
+                    # Let the other workers of this stage see the end marker too
+                    in_queue.put(self._DONE)
+                    break
+                
+                try:
+                    result = func(record)
+                except Exception as e:
+                    logger.error(f"Cohort {stage} failed for patient {record['patient_id']}: {e}")
+                    try:
+                        self._record_result(record, f"{stage}: {e}")
+                    except Exception as record_error:
+                        logger.error(f"Could not record cohort failure for patient {record['patient_id']}: {record_error}")
+                    result = None
+                
+                with self._lock:
+                    self._progress[stage] += 1
+                if result is not None and out_queue is not None:
+                    out_queue.put(result)
+        finally:
+            # Even if this worker dies, the next stage must get its end marker or run() never returns
+            with self._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and out_queue is not None:
+                out_queue.put(self._DONE)
+    
+    def _report_progress(self, started: float):
+        with self._lock:
+            progress = dict(self._progress)
+        progress["elapsed_seconds"] = round(time.perf_counter() - started, 1)
+        progress["unique_queries"] = len(self._query_results)
+        
+        logger.info(
+            f"Cohort progress: {progress['completed']}/{progress['total']} done, {progress['failed']} failed "
+            f"(extracted {progress['extraction']}, literature {progress['literature']}, indexed {progress['indexing']}; "
+            f"{progress['unique_queries']} unique literature queries, {progress['elapsed_seconds']}s)"
+        )
+        if self.progress_callback:
+            self.progress_callback(progress)
+    
+    def run(self, records) -> Dict[str, Any]:
+        """Initialize every record (an iterable of dicts, or a CSV/JSONL path) and return a summary."""
+        if isinstance(records, str):
+            records = self.load_records(records)
+        
+        self._load_checkpoint()
+        self._progress = {stage: 0 for stage in self.STAGES}
+        self._progress.update({"total": 0, "skipped": 0, "completed": 0, "failed": 0})
+        
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.STAGES]
+        funcs = [self._extract, self._fetch_literature, self._index]
+        threads = []
+        for position, stage in enumerate(self.STAGES):
+            out_queue = queues[position + 1] if position + 1 < len(queues) else None
+            remaining = [self.workers[stage]]
+            for worker in range(self.workers[stage]):
+                thread = threading.Thread(
+                    target=self._stage_worker,
+                    args=(stage, funcs[position], queues[position], out_queue, remaining),
+                    name=f"cohort-{stage}-{worker}",
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+        
+        started = time.perf_counter()
+        last_report = started
+        seen = set()
+        # The bounded first queue applies backpressure, so large cohort files are never fully in memory
+        for record in records:
+            if record["patient_id"] in seen:
+                continue
+            seen.add(record["patient_id"])
+            
+            with self._lock:
+                self._progress["total"] += 1
+            if self._is_completed(record):
+                with self._lock:
+                    self._progress["skipped"] += 1
+                    self._progress["completed"] += 1
+                continue
+            
+            queues[0].put(record)
+            if time.perf_counter() - last_report >= self.progress_interval:
+                self._report_progress(started)
+                last_report = time.perf_counter()
+        queues[0].put(self._DONE)
+        
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=self.progress_interval)
+                if thread.is_alive():
+                    self._report_progress(started)
+        
+        self._report_progress(started)
+        with self._lock:
+            summary = dict(self._progress)
+            summary["failed_patients"] = dict(self._checkpoint["failed"])
+        summary["unique_queries"] = len(self._query_results)
+        summary["elapsed_seconds"] = round(time.perf_counter() - started, 1)
+        self._query_results = {}
+        return summary
+
 
 def verify_api_connectivity():
     """Verify Mistral API connectivity before proceeding."""
     try:
         # Simple test call to verify API access
-        test_llm = ChatMistralAI(
-            temperature=0,
-            model="mistral-small", 
-            mistral_api_key=MISTRAL_API_KEY
-        )
+        test_llm = get_chat_model(model="mistral-small", temperature=0)
         
         test_message = [{"role": "user", "content": "Hello"}]
         response = test_llm.invoke(test_message)
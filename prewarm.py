@@ -0,0 +1,40 @@
+from medical3 import ClinicalDecisionSupportSystem, CohortInitializer
+import argparse
+import json
+import logging
+
+# Batch entry point for pre-warming a cohort, e.g. tomorrow's clinic list, overnight.
+# Run with: python prewarm.py cohort.jsonl --checkpoint cohort.checkpoint.json
+# Re-running with the same checkpoint skips patients that already completed.
+
+# Enable logging
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Initialize a cohort of patient EHRs from a CSV or JSONL file.")
+    parser.add_argument("cohort", help="CSV or JSONL file with a patient_ehr column/field")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file used to resume an interrupted run")
+    parser.add_argument("--extraction-workers", type=int, default=4)
+    parser.add_argument("--literature-workers", type=int, default=4)
+    parser.add_argument("--indexing-workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=32)
+    parser.add_argument("--progress-interval", type=float, default=10.0)
+    args = parser.parse_args()
+    
+    cdss = ClinicalDecisionSupportSystem()
+    initializer = CohortInitializer(
+        cdss,
+        checkpoint_path=args.checkpoint,
+        extraction_workers=args.extraction_workers,
+        literature_workers=args.literature_workers,
+        indexing_workers=args.indexing_workers,
+        queue_size=args.queue_size,
+        progress_interval=args.progress_interval
+    )
+    summary = initializer.run(args.cohort)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+from langchain_core.documents import Document
+
+from medical3 import BM25Index
+
+DOCUMENTS = {
+    "asthma": "Inhaled corticosteroids are first-line controller therapy for persistent asthma.",
+    "copd": "Long-acting bronchodilators reduce exacerbations in COPD.",
+    "diabetes": "Metformin remains first-line therapy for type 2 diabetes.",
+    "hypertension": "Thiazide diuretics and ACE inhibitors lower blood pressure in hypertension.",
+}
+
+
+def add_all(index: BM25Index):
+    index.add_documents([Document(page_content=text, metadata={"topic": key}) for key, text in DOCUMENTS.items()], list(DOCUMENTS))
+
+
+def test_search_ranks_matching_documents(tmp_path):
+    index = BM25Index(str(tmp_path / "bm25.sqlite3"))
+    add_all(index)
+
+    results = index.search("first-line therapy for asthma", k=2)
+    assert [doc.metadata["topic"] for doc in results] == ["asthma", "diabetes"]
+    assert index.search("unrelated words") == []
+
+
+def test_adding_existing_ids_is_a_no_op(tmp_path):
+    index = BM25Index(str(tmp_path / "bm25.sqlite3"))
+    add_all(index)
+    add_all(index)
+    assert index.doc_count == len(DOCUMENTS)
+    assert index.missing_ids(["asthma", "gout"]) == ["gout"]
+
+
+def test_instances_see_each_others_writes(tmp_path):
+    path = str(tmp_path / "bm25.sqlite3")
+    server = BM25Index(path)
+    assert server.search("asthma") == []
+
+    # e.g. a prewarm or ingest process writing to the index the server already opened
+    add_all(BM25Index(path))
+    assert [doc.metadata["topic"] for doc in server.search("asthma", k=1)] == ["asthma"]
+    assert server.doc_count == len(DOCUMENTS)
+
+
+def test_search_restricted_to_doc_ids(tmp_path):
+    index = BM25Index(str(tmp_path / "bm25.sqlite3"))
+    add_all(index)
+
+    results = index.search("first-line therapy", k=5, doc_ids=["diabetes", "hypertension"])
+    assert [doc.metadata["topic"] for doc in results] == ["diabetes"]
+    assert index.search("asthma", doc_ids=[]) == []
+
+
+def test_remove_documents(tmp_path):
+    index = BM25Index(str(tmp_path / "bm25.sqlite3"))
+    add_all(index)
+    index.remove_documents(["asthma", "not-indexed"])
+
+    assert index.doc_count == len(DOCUMENTS) - 1
+    assert [doc.metadata["topic"] for doc in index.search("asthma therapy")] == ["diabetes"]
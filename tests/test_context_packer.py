@@ -0,0 +1,71 @@
+from langchain_core.documents import Document
+
+from medical3 import ContextPacker, estimate_tokens
+
+
+def document(sentences: int, topic: str) -> Document:
+    return Document(
+        page_content=" ".join(f"Sentence {i} about {topic} management in adults." for i in range(sentences)),
+        metadata={"topic": topic},
+    )
+
+
+def context_tokens(documents) -> int:
+    return sum(estimate_tokens(doc.page_content) for doc in documents)
+
+
+def test_packs_ranked_documents_within_budget():
+    packer = ContextPacker(token_budget=300, patient_info_budget=50)
+    documents = [document(5, "asthma"), document(5, "copd"), document(40, "diabetes"), document(5, "gout")]
+
+    patient_info, packed, report = packer.pack("How to manage diabetes?", "Patient Information:\nAge: 58", documents)
+
+    assert report["total"] <= 300
+    assert report["total"] == report["question"] + report["patient_info"] + report["context"]
+    assert report["context"] == context_tokens(packed)
+    assert [doc.metadata["topic"] for doc in packed][:2] == ["asthma", "copd"]
+    assert packed[2].metadata["topic"] == "diabetes"
+    assert packed[2].metadata["trimmed"]
+    assert report["trimmed_documents"] == 1
+
+
+def test_counts_system_prompt_against_the_budget():
+    packer = ContextPacker(token_budget=200, patient_info_budget=50)
+    documents = [document(10, "asthma") for _ in range(5)]
+
+    _, without_prompt, _ = packer.pack("question", "info", documents)
+    _, with_prompt, report = packer.pack("question", "info", documents, system_prompt="x" * 400)
+
+    assert report["system_prompt"] == 100
+    assert report["total"] <= 200
+    assert context_tokens(with_prompt) < context_tokens(without_prompt)
+
+
+def test_stops_when_remaining_budget_is_below_minimum_chunk():
+    packer = ContextPacker(token_budget=40, patient_info_budget=10, min_chunk_tokens=50)
+    _, packed, report = packer.pack("q", "info", [document(5, "asthma")])
+    assert packed == []
+    assert report["context"] == 0
+
+
+def test_patient_info_truncation_keeps_every_line():
+    packer = ContextPacker(patient_info_budget=40)
+    patient_info = "\n".join([
+        "Patient Information:",
+        "Medical Conditions: " + ", ".join(f"condition {i}" for i in range(60)),
+        "Medications: metformin",
+        "Vital Signs: blood pressure 145/90 mmHg",
+    ])
+
+    truncated = packer._truncate(patient_info, 40)
+
+    assert estimate_tokens(truncated) <= 40
+    lines = truncated.split("\n")
+    assert lines[0] == "Patient Information:"
+    assert lines[1].startswith("Medical Conditions: condition 0")
+    assert lines[2:] == ["Medications: metformin", "Vital Signs: blood pressure 145/90 mmHg"]
+
+
+def test_cut_falls_back_to_characters_for_one_long_word():
+    packer = ContextPacker()
+    assert packer._cut("x" * 100, 5) == "x" * 23
@@ -0,0 +1,84 @@
+import numpy as np
+
+from medical3 import CachedEmbeddings
+
+
+class CountingEmbeddings:
+    """Deterministic stand-in model: [offset + position in batch, len(text), 1.0]."""
+
+    def __init__(self, offset: float = 0.0):
+        self.offset = offset
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[self.offset + i, float(len(text)), 1.0] for i, text in enumerate(texts)]
+
+    def embed_query(self, text):
+        self.calls.append([text])
+        return [self.offset, float(len(text)), 1.0]
+
+
+def test_round_trip_serves_cached_vectors(tmp_path):
+    model = CountingEmbeddings(10)
+    cache = CachedEmbeddings(model, "model", str(tmp_path))
+
+    first = cache.embed_documents(["alpha text", "beta", "alpha text"])
+    assert first == [[10.0, 10.0, 1.0], [11.0, 4.0, 1.0], [10.0, 10.0, 1.0]]
+    assert model.calls == [["alpha text", "beta"]]
+
+    assert cache.embed_documents(["beta", "alpha text"]) == [first[1], first[0]]
+    assert len(model.calls) == 1
+
+    # A fresh instance reads the same vectors back from disk
+    reopened = CachedEmbeddings(CountingEmbeddings(99), "model", str(tmp_path))
+    assert reopened.embed_documents(["alpha text", "beta"]) == [first[0], first[1]]
+    assert reopened.stats() == {"hits": 2, "misses": 0}
+
+
+def test_cache_is_keyed_by_model_name(tmp_path):
+    CachedEmbeddings(CountingEmbeddings(10), "model-a", str(tmp_path)).embed_documents(["alpha"])
+    other = CountingEmbeddings(50)
+    assert CachedEmbeddings(other, "model-b", str(tmp_path)).embed_documents(["alpha"]) == [[50.0, 5.0, 1.0]]
+    assert other.calls == [["alpha"]]
+
+
+def test_queries_bypass_the_cache(tmp_path):
+    model = CountingEmbeddings()
+    cache = CachedEmbeddings(model, "model", str(tmp_path))
+    cache.embed_query("patient question")
+    cache.embed_queries(["patient question"])
+    assert cache.embed_documents(["patient question"]) == [[0.0, 16.0, 1.0]]
+    assert len(model.calls) == 3
+
+
+def test_recovers_from_torn_write(tmp_path):
+    cache = CachedEmbeddings(CountingEmbeddings(10), "model", str(tmp_path))
+    cache.embed_documents(["alpha", "beta"])
+
+    # A writer that died between writing vectors and committing the index leaves unindexed bytes
+    with open(cache.vectors_path, "ab") as f:
+        f.write(np.array([7.0, 7.0], dtype=np.float32).tobytes())
+
+    reopened = CachedEmbeddings(CountingEmbeddings(30), "model", str(tmp_path))
+    assert reopened.embed_documents(["gamma"]) == [[30.0, 5.0, 1.0]]
+    assert reopened.embed_documents(["alpha", "beta", "gamma"]) == [[10.0, 5.0, 1.0], [11.0, 4.0, 1.0], [30.0, 5.0, 1.0]]
+    assert reopened.stats()["misses"] == 1
+
+
+def test_writers_sharing_a_directory_keep_their_rows(tmp_path):
+    server = CachedEmbeddings(CountingEmbeddings(10), "model", str(tmp_path))
+    prewarm = CachedEmbeddings(CountingEmbeddings(30), "model", str(tmp_path))
+
+    server.embed_documents(["alpha text"])
+    prewarm.embed_documents(["beta", "gamma"])
+    server.embed_documents(["delta"])
+
+    expected = [[10.0, 10.0, 1.0], [30.0, 4.0, 1.0], [31.0, 5.0, 1.0], [10.0, 5.0, 1.0]]
+    texts = ["alpha text", "beta", "gamma", "delta"]
+    assert server.embed_documents(texts) == expected
+    assert prewarm.embed_documents(texts) == expected
+
+    reader = CachedEmbeddings(CountingEmbeddings(99), "model", str(tmp_path))
+    assert reader.embed_documents(texts) == expected
+    assert reader.stats() == {"hits": 4, "misses": 0}
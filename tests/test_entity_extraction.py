@@ -0,0 +1,63 @@
+from medical3 import LocalEntityExtractor, MedicalEntityExtractor, merge_entities
+
+NOTE = (
+    "58-year-old male with type 2 diabetes and HTN. Metformin 1000mg BID. "
+    "BP 145/90 mmHg. HbA1c 8.2%."
+)
+
+
+def test_extracts_regular_mentions():
+    entities, uncovered, coverage = LocalEntityExtractor().extract(NOTE)
+    assert entities == {
+        "medical_conditions": ["type 2 diabetes", "hypertension"],
+        "medications": ["Metformin 1000mg BID"],
+        "treatments": [],
+        "lab_tests": ["HbA1c 8.2%"],
+        "vital_signs": ["blood pressure 145/90 mmHg"],
+        "patient_demographics": ["58-year-old male"],
+    }
+    assert uncovered == []
+    assert coverage == 1.0
+
+
+def test_abbreviations_deduplicate_with_full_names():
+    entities, _, _ = LocalEntityExtractor().extract("Known COPD. Chronic obstructive pulmonary disease, stable.")
+    assert entities["medical_conditions"] == ["chronic obstructive pulmonary disease"]
+
+
+def test_negated_historical_and_family_mentions_are_left_to_the_llm():
+    text = "No history of asthma. History of pneumonia in 2015. Mother had breast cancer. Current: hypertension."
+    entities, uncovered, coverage = LocalEntityExtractor().extract(text)
+    assert entities["medical_conditions"] == ["hypertension"]
+    assert uncovered == ["No history of asthma.", "History of pneumonia in 2015.", "Mother had breast cancer."]
+    assert coverage == 0.25
+
+
+def test_symptoms_are_not_conditions():
+    entities, uncovered, _ = LocalEntityExtractor().extract("Patient has COPD. Reports shortness of breath.")
+    assert entities["medical_conditions"] == ["chronic obstructive pulmonary disease"]
+    assert uncovered == ["Reports shortness of breath."]
+
+
+def test_local_pass_skips_the_llm_only_when_confident():
+    extractor = MedicalEntityExtractor()
+
+    entities, remaining = extractor._local_pass(NOTE)
+    assert remaining is None
+    assert entities["medical_conditions"] == ["type 2 diabetes", "hypertension"]
+
+    # Partly covered: only the unexplained sentences go to the LLM
+    _, remaining = extractor._local_pass("Patient has COPD. Father with coronary artery disease.")
+    assert remaining == "Father with coronary artery disease."
+
+    # No local conditions: the whole note goes to the LLM
+    text = "Works as a teacher. Lives alone."
+    assert extractor._local_pass(text)[1] == text
+
+
+def test_merge_entities_unions_case_insensitively():
+    merged = merge_entities(
+        {"medical_conditions": ["Asthma"], "medications": []},
+        {"medical_conditions": ["asthma", "gout"], "lab_tests": ["eGFR 45"]},
+    )
+    assert merged == {"medical_conditions": ["Asthma", "gout"], "medications": [], "lab_tests": ["eGFR 45"]}
@@ -0,0 +1,31 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Modules that must import without constructing models or touching the network
+MODULES = ["medical3", "ingest", "prewarm", "bench_startup", "bench_offline"]
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_module_imports(module):
+    # A fresh interpreter, so annotations and module-level code are evaluated from scratch
+    result = subprocess.run(
+        [sys.executable, "-c", f"import {module}"], cwd=ROOT, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_heavy_dependencies_stay_unloaded():
+    result = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, medical3; "
+         "print(','.join(m for m in ('langchain_community', 'chromadb', 'sentence_transformers', 'pandas') "
+         "if m in sys.modules))"],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ""
@@ -0,0 +1,165 @@
+import asyncio
+
+import pytest
+
+import medical3
+from bench_offline import PubMedStub
+from medical3 import MedicalDataProcessor, PubMedCache
+
+STRUCTURED_ARTICLE = b"""<?xml version="1.0"?>
+<PubmedArticleSet>
+<PubmedArticle>
+  <MedlineCitation>
+    <PMID>31000001</PMID>
+    <Article>
+      <Journal><JournalIssue><PubDate><MedlineDate>2019 Nov-Dec</MedlineDate></PubDate></JournalIssue></Journal>
+      <ArticleTitle>SGLT2 inhibitors in <i>type 2</i> diabetes</ArticleTitle>
+      <Abstract>
+        <AbstractText Label="BACKGROUND">Glycemic control reduces complications.</AbstractText>
+        <AbstractText Label="METHODS">We pooled 12 trials with HbA1c &lt; 7<sup>%</sup> targets.</AbstractText>
+        <AbstractText Label="CONCLUSIONS">Empagliflozin lowered cardiovascular death.</AbstractText>
+      </Abstract>
+      <AuthorList>
+        <Author><LastName>Doe</LastName><ForeName>Jane</ForeName></Author>
+        <Author><CollectiveName>EMPA-REG Investigators</CollectiveName></Author>
+      </AuthorList>
+      <PublicationTypeList>
+        <PublicationType>Meta-Analysis</PublicationType>
+        <PublicationType>Review</PublicationType>
+      </PublicationTypeList>
+    </Article>
+    <MeshHeadingList>
+      <MeshHeading><DescriptorName>Diabetes Mellitus, Type 2</DescriptorName></MeshHeading>
+      <MeshHeading><DescriptorName>Humans</DescriptorName></MeshHeading>
+    </MeshHeadingList>
+  </MedlineCitation>
+</PubmedArticle>
+<PubmedArticle>
+  <MedlineCitation>
+    <PMID>31000002</PMID>
+    <Article>
+      <Journal><JournalIssue><PubDate><Year>2021</Year><Month>Mar</Month></PubDate></JournalIssue></Journal>
+      <ArticleTitle>Unstructured abstract</ArticleTitle>
+      <Abstract><AbstractText>Plain abstract text.</AbstractText></Abstract>
+    </Article>
+  </MedlineCitation>
+</PubmedArticle>
+</PubmedArticleSet>
+"""
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(medical3.time, "time", lambda: now[0])
+    return now
+
+
+def test_query_cache_round_trip_and_normalization(tmp_path):
+    cache = PubMedCache(str(tmp_path))
+    cache.put_query("Type 2  Diabetes", 5, ["1", "2"])
+    assert cache.get_query("type 2 diabetes", 5) == ["1", "2"]
+    assert cache.get_query("type 2 diabetes", 10) is None
+    assert cache.stats()["query_hits"] == 1
+
+
+def test_query_cache_expires_after_ttl(tmp_path, clock):
+    cache = PubMedCache(str(tmp_path), ttl_seconds=100)
+    cache.put_query("asthma", 5, ["1"])
+    clock[0] += 99
+    assert cache.get_query("asthma", 5) == ["1"]
+    clock[0] += 2
+    assert cache.get_query("asthma", 5) is None
+
+
+def test_empty_results_expire_sooner(tmp_path, clock):
+    cache = PubMedCache(str(tmp_path), ttl_seconds=1000, empty_ttl_seconds=10)
+    cache.put_query("rare condition", 5, [])
+    cache.put_query("asthma", 5, ["1"])
+    assert cache.get_query("rare condition", 5) == []
+    clock[0] += 11
+    assert cache.get_query("rare condition", 5) is None
+    assert cache.get_query("asthma", 5) == ["1"]
+
+
+def test_article_cache_round_trip(tmp_path):
+    processor = MedicalDataProcessor(cache_dir=None)
+    documents = processor._parse_pubmed_articles(STRUCTURED_ARTICLE)
+    cache = PubMedCache(str(tmp_path))
+    cache.put_articles(documents)
+    cached = cache.get_articles(["31000001", "31000002", "missing"])
+    assert sorted(cached) == ["31000001", "31000002"]
+    assert cached["31000001"].page_content == documents[0].page_content
+    assert cached["31000001"].metadata == documents[0].metadata
+
+
+def test_parse_structured_abstract():
+    documents = MedicalDataProcessor(cache_dir=None)._parse_pubmed_articles(STRUCTURED_ARTICLE)
+    assert [doc.metadata["pmid"] for doc in documents] == ["31000001", "31000002"]
+
+    structured = documents[0]
+    assert structured.metadata["title"] == "SGLT2 inhibitors in type 2 diabetes"
+    assert structured.metadata["publication_date"] == "2019 Nov-Dec"
+    assert structured.metadata["authors"] == "Jane Doe, EMPA-REG Investigators"
+    assert structured.metadata["mesh_terms"] == "Diabetes Mellitus, Type 2; Humans"
+    assert structured.metadata["publication_types"] == "Meta-Analysis; Review"
+    assert (
+        "Abstract: BACKGROUND: Glycemic control reduces complications.\n"
+        "METHODS: We pooled 12 trials with HbA1c < 7% targets.\n"
+        "CONCLUSIONS: Empagliflozin lowered cardiovascular death."
+    ) in structured.page_content
+
+    plain = documents[1]
+    assert plain.metadata["publication_date"] == "2021 Mar"
+    assert plain.page_content.endswith("Abstract: Plain abstract text.")
+
+
+def test_parse_keeps_articles_before_truncation():
+    truncated = STRUCTURED_ARTICLE[:STRUCTURED_ARTICLE.index(b"<PMID>31000002")]
+    documents = MedicalDataProcessor(cache_dir=None)._parse_pubmed_articles(truncated)
+    assert [doc.metadata["pmid"] for doc in documents] == ["31000001"]
+
+
+def test_retry_delay_is_capped():
+    processor = MedicalDataProcessor(cache_dir=None, backoff_factor=0.5, max_backoff=5)
+    assert processor._retry_delay(0) == 0.5
+    assert processor._retry_delay(2) == 2.0
+    assert processor._retry_delay(10) == 5
+    assert processor._retry_delay(0, "3") == 3.0
+    assert processor._retry_delay(0, "3600") == 5
+
+
+@pytest.fixture
+def stub():
+    server = PubMedStub(latency=0).start()
+    yield server
+    server.stop()
+
+
+def test_fetch_by_ids_batches_requests_and_uses_cache(stub, tmp_path):
+    pytest.importorskip("tqdm")
+    processor = MedicalDataProcessor(pubmed_base_url=stub.url, efetch_batch_size=2, rate_limit=1000, cache_dir=str(tmp_path))
+    pmids = [str(10000001 + i) for i in range(5)]
+
+    documents = processor.fetch_pubmed_by_ids(pmids)
+    assert [doc.metadata["pmid"] for doc in documents] == pmids
+    assert stub.requests == 3
+
+    assert processor.fetch_pubmed_by_ids(list(reversed(pmids)))[0].metadata["pmid"] == pmids[-1]
+    assert stub.requests == 3
+
+
+def test_async_fetch_for_queries_merges_duplicates(stub, tmp_path):
+    processor = MedicalDataProcessor(pubmed_base_url=stub.url, rate_limit=1000, cache_dir=str(tmp_path))
+
+    async def fetch():
+        try:
+            return await processor.afetch_pubmed_for_queries(["asthma therapy", "asthma inhaler"], max_results=6)
+        finally:
+            await processor.aclose()
+
+    documents = asyncio.run(fetch())
+    pmids = [doc.metadata["pmid"] for doc in documents]
+    assert len(pmids) == len(set(pmids)) == 9
+    shared = [doc for doc in documents if ";" in doc.metadata["queries"]]
+    assert len(shared) == 3
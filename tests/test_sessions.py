@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+import medical3
+from medical3 import PatientContext, SessionRegistry
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(medical3.time, "monotonic", lambda: now[0])
+    return now
+
+
+def context(ehr_hash: str, ehr_length: int = 0) -> PatientContext:
+    return PatientContext(ehr_hash, {"medical_conditions": []}, ehr_length)
+
+
+def test_evicts_least_recently_used(clock):
+    registry = SessionRegistry(max_sessions=2)
+    registry.put(context("a"))
+    registry.put(context("b"))
+    assert registry.get("a") is not None
+
+    registry.put(context("c"))
+    assert registry.get("b") is None
+    assert registry.get("a") is not None and registry.get("c") is not None
+    assert registry.stats()["evictions"] == 1
+
+
+def test_evicts_to_respect_memory_cap(clock):
+    overhead = medical3.PATIENT_CONTEXT_OVERHEAD_BYTES
+    registry = SessionRegistry(max_sessions=10, max_memory_mb=(3 * overhead + 1000) / (1024 * 1024))
+    for ehr_hash in "abc":
+        registry.put(context(ehr_hash, ehr_length=100))
+    assert registry.stats()["sessions"] == 3
+
+    registry.put(context("d", ehr_length=100))
+    assert registry.get("a") is None
+    assert registry.stats()["sessions"] == 3
+
+
+def test_keeps_a_single_oversized_session(clock):
+    registry = SessionRegistry(max_memory_mb=0.001)
+    registry.put(context("a"))
+    assert registry.get("a") is not None
+
+
+def test_idle_sessions_expire(clock):
+    registry = SessionRegistry(ttl_seconds=60)
+    registry.put(context("a"))
+    registry.put(context("b"))
+
+    clock[0] += 50
+    assert registry.get("a") is not None
+    clock[0] += 20
+    assert registry.get("b") is None
+    assert registry.get("a") is not None
+    assert registry.stats()["sessions"] == 1
+
+
+def test_get_or_create_builds_once_under_concurrency():
+    registry = SessionRegistry()
+    builds = []
+
+    def factory():
+        builds.append(1)
+        time.sleep(0.05)
+        return context("a")
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get_or_create("a", factory))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(builds) == 1
+    assert len({id(result) for result in results}) == 1
+
+
+def test_failed_build_is_not_registered():
+    registry = SessionRegistry()
+    assert registry.get_or_create("a", lambda: None) is None
+    assert registry.stats()["sessions"] == 0